@@ -0,0 +1,41 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+
+"""Config"""
+
+ENV_FILE: str = "../.env"
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_env() -> None:
+    """Reads the .env file (WEATHER_ENV_FILE, default ../.env) once, on first use instead of at import."""
+    global _loaded
+    with _lock:
+        if not _loaded:
+            load_dotenv(os.getenv("WEATHER_ENV_FILE", ENV_FILE))
+            _loaded = True
+
+
+def env(name: str, default: str | None = None) -> str | None:
+    load_env()
+    return os.getenv(name, default)
+
+
+def db_settings() -> dict:
+    """Arguments of pass_utils.connect_to_db."""
+    return {f"db_{name}": env(f"DB_{name.upper()}") for name in ("name", "user", "password", "port", "host")}
+
+
+def db_engine():
+    from pass_utils import connect_to_db  # sqlalchemy dopiero przy pierwszym połączeniu
+
+    return connect_to_db(**db_settings())
+
+
+def weather_api_keys() -> list:
+    """OpenWeather keys WEATHER_API_KEY_2 ... WEATHER_API_KEY_12 (key 1 is not used)."""
+    return [env(f"WEATHER_API_KEY_{number}") for number in range(2, 13)]
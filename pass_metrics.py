@@ -0,0 +1,216 @@
+import cProfile
+import functools
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable
+
+from pass_logging import logger
+
+"""Metrics"""
+
+PREFIX = "weather_"
+
+
+class Metrics:
+    """Counters, gauges and call timings of one run, keyed by name and labels; safe to use from threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters: dict = {}
+            self.gauges: dict = {}
+            self.timings: dict = {}  # key -> [count, sum, max]
+            self.started_at = time.time()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def max(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = max(self.gauges.get(key, value), value)
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            count, total, longest = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def summary(self) -> dict:
+        def rows(values: dict, render: Callable) -> list:
+            return [{"name": name, "labels": dict(labels), **render(value)} for (name, labels), value in values.items()]
+
+        with self._lock:
+            return {
+                "started_at": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+                "seconds": round(time.time() - self.started_at, 3),
+                "counters": rows(self.counters, lambda value: {"value": value}),
+                "gauges": rows(self.gauges, lambda value: {"value": value}),
+                "timings": rows(self.timings, lambda value: {
+                    "count": value[0], "sum_s": round(value[1], 4), "max_s": round(value[2], 4),
+                    "mean_s": round(value[1] / value[0], 4),
+                }),
+            }
+
+    def prometheus(self, **common_labels) -> str:
+        """Prometheus text exposition format, for node_exporter's textfile collector."""
+        def line(name: str, labels: tuple, value: float) -> str:
+            merged = {**common_labels, **dict(labels)}
+            rendered = ",".join(f'{label}="{_escape(text)}"' for label, text in merged.items())
+            return f"{PREFIX}{name}{{{rendered}}} {value}" if rendered else f"{PREFIX}{name} {value}"
+
+        with self._lock:
+            lines = [line(name, labels, value) for (name, labels), value in sorted(self.counters.items())]
+            lines += [line(name, labels, value) for (name, labels), value in sorted(self.gauges.items())]
+            for (name, labels), (count, total, longest) in sorted(self.timings.items()):
+                lines += [line(f"{name}_count", labels, count), line(f"{name}_sum", labels, round(total, 6)),
+                          line(f"{name}_max", labels, round(longest, 6))]
+            lines.append(line("run_timestamp_seconds", (), round(self.started_at)))
+        return "\n".join(lines) + "\n"
+
+    def export(self, config: dict, **common_labels) -> None:
+        """Writes METRICS_TEXTFILE (Prometheus) and METRICS_JSON (run summary) if configured."""
+        textfile = config.get("METRICS_TEXTFILE") or os.getenv("WEATHER_METRICS_TEXTFILE")
+        summary_file = config.get("METRICS_JSON") or os.getenv("WEATHER_METRICS_JSON")
+        if textfile:
+            _write_atomic(textfile, self.prometheus(**common_labels))
+        if summary_file:
+            _write_atomic(summary_file, json.dumps({"labels": common_labels, **self.summary()}, indent=2))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(content)
+    os.replace(tmp_path, path)  # textfile collector nie czyta niedokończonego pliku
+
+
+metrics = Metrics()
+
+
+class _Profiling:
+    """Opt-in profiling: PROFILE / WEATHER_PROFILE = "cprofile", "tracemalloc" or both, comma separated."""
+
+    def __init__(self):
+        self.modes: set = set()
+        self.sample: float = 1.0
+        self.folder: str = "./profiles"
+        self._tracing = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.configure({})
+
+    def configure(self, config: dict) -> None:
+        modes = config.get("PROFILE") or os.getenv("WEATHER_PROFILE", "")
+        self.modes = {mode.strip() for mode in modes.split(",") if mode.strip()}
+        self.sample = float(config.get("PROFILE_SAMPLE") or os.getenv("WEATHER_PROFILE_SAMPLE", 1.0))
+        self.folder = config.get("PROFILE_FOLDER") or os.getenv("WEATHER_PROFILE_FOLDER", "./profiles")
+
+    @contextmanager
+    def profile(self, stage: str, call: str):
+        if not self.modes or getattr(self._local, "active", False) or random.random() >= self.sample:
+            yield  # wywołanie wewnątrz profilowanego etapu należy już do jego profilu
+            return
+
+        os.makedirs(self.folder, exist_ok=True)
+        name = f"{stage}_{call}_{os.getpid()}_{threading.get_ident()}_{time.time_ns()}"
+        profiler = cProfile.Profile() if "cprofile" in self.modes else None
+        traced = "tracemalloc" in self.modes
+        if traced:
+            self._start_tracing()
+        if profiler:
+            try:
+                profiler.enable()
+            except ValueError:  # Python 3.12+: tylko jeden aktywny profiler w procesie
+                profiler = None
+        self._local.active = True
+        try:
+            yield
+        finally:
+            self._local.active = False
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.folder, f"{name}.prof"))
+            if traced:
+                self._stop_tracing(stage, call, name)
+
+    def _start_tracing(self) -> None:
+        with self._lock:
+            if self._tracing == 0:
+                tracemalloc.start(10)
+            self._tracing += 1
+
+    def _stop_tracing(self, stage: str, call: str, name: str) -> None:
+        with self._lock:
+            _, peak = tracemalloc.get_traced_memory()  # szczyt wspólny dla równoległych wywołań
+            top = tracemalloc.take_snapshot().statistics("lineno")[:15]
+            self._tracing -= 1
+            if self._tracing == 0:
+                tracemalloc.stop()
+        metrics.max("traced_peak_bytes", peak, stage=stage, call=call)
+        with open(os.path.join(self.folder, f"{name}.tracemalloc.txt"), "w") as file:
+            file.write("\n".join(str(statistic) for statistic in top) + "\n")
+
+
+profiling = _Profiling()
+
+
+def instrumented(stage: str, call: str | None = None) -> Callable:
+    """Times every call (weather_call_seconds), counts failures and runs the sampled profiler around it."""
+    def decorator(func: Callable) -> Callable:
+        name = call or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer("call_seconds", stage=stage, call=name), profiling.profile(stage, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def stage_run(stage: str):
+    """Times one whole stage of a run (weather_stage_seconds) with the profiler around it."""
+    started = time.perf_counter()
+    with profiling.profile(stage, "stage"):
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            metrics.set("stage_seconds", round(seconds, 3), stage=stage)
+            logger.info(f"Etap {stage}: {seconds:.2f} s")
@@ -1,78 +1,407 @@
 from __future__ import absolute_import, unicode_literals
+import asyncio
 import concurrent.futures
+import hashlib
+import heapq
 import os
 import sqlalchemy
 import random
+import threading
+import time
+import requests
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 from sqlalchemy import create_engine
-from sqlalchemy import Table, MetaData, select, and_  # text
-from geoalchemy2 import functions
-from shapely import wkt
+from sqlalchemy import select, table, column, text
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from typing import Callable
+from typing import TYPE_CHECKING, Callable
 from pass_logging import logger
 
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+
+class ParallelExecutionError(Exception):
+    """Some items of a make_parallel batch failed; the others still ran.
+
+    `errors` maps the item position to its exception, `results` holds the results of the rest (None where failed).
+    """
+
+    def __init__(self, errors: dict, results: list):
+        self.errors = errors
+        self.results = results
+        first = next(iter(errors.values()))
+        super().__init__(f"{len(errors)} z {len(results)} zadań zakończyło się błędem, pierwszy: {first!r}")
+
+
+class WorkerBudget:
+    """Process-wide cap on pool workers shared by every make_parallel call, nested calls included."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, wanted: int) -> int:
+        with self._lock:
+            granted = max(0, min(wanted, self.total - self.used))
+            self.used += granted
+            return granted
+
+    def release(self, count: int) -> None:
+        with self._lock:
+            self.used -= count
+
+
+WORKER_BUDGET = WorkerBudget(int(os.getenv("PARALLEL_WORKER_BUDGET", os.cpu_count() * 4)))
+
+
+def _exhaust_budget() -> None:
+    """Pool process initializer: work started inside a worker process runs inline."""
+    WORKER_BUDGET.used = WORKER_BUDGET.total
+
+
+def _run_chunk(func: Callable, chunk: list, kwargs: dict) -> list:
+    outcomes = []
+    for index, item in chunk:
+        try:
+            outcomes.append((index, True, func(item, **kwargs)))
+        except Exception as e:  # jeden błędny element nie przerywa paczki
+            outcomes.append((index, False, e))
+    return outcomes
+
 
 def make_parallel(
-        func: Callable, items: list, workers: int = os.cpu_count() * 2, **kwargs: object
-) -> list:
-    """przetwarzanie listy  z ThreadPoolExecutor"""
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = [executor.submit(func, i, **kwargs) for i in items]
-        return [f.result() for f in concurrent.futures.as_completed(futures)]
+        func: Callable, items: list, workers: int = os.cpu_count() * 2, backend: str = "thread",
+        key: Callable | None = None, max_in_flight: int | None = None, chunksize: int = 1,
+        return_exceptions: bool = False, **kwargs: object
+) -> list | dict:
+    """przetwarzanie listy w wątkach, procesach (backend="process") lub w bieżącym wątku (backend="inline")
+
+    Results follow the order of `items`, or form a dict keyed by `key(item)`. At most `max_in_flight`
+    chunks of `chunksize` items are submitted at a time. Workers are taken from WORKER_BUDGET
+    (PARALLEL_WORKER_BUDGET); a call that gets one worker or fewer, e.g. nested in a busy pool, runs inline.
+    Failed items raise one ParallelExecutionError after the whole batch, or stay in the results as
+    exceptions with `return_exceptions=True`.
+    """
+    items = list(items)
+    indexed = list(enumerate(items))
+    chunks = [indexed[start:start + chunksize] for start in range(0, len(indexed), max(1, chunksize))]
+    results: list = [None] * len(items)
+    errors: dict = {}
+
+    def collect(outcomes: list) -> None:
+        for index, ok, value in outcomes:
+            if ok:
+                results[index] = value
+            else:
+                errors[index] = value
+                results[index] = value if return_exceptions else None
+
+    granted = WORKER_BUDGET.reserve(min(workers, len(chunks))) if backend != "inline" else 0
+    try:
+        if granted <= 1:
+            for chunk in chunks:
+                collect(_run_chunk(func, chunk, kwargs))
+        else:
+            executor_class, options = {
+                "thread": (concurrent.futures.ThreadPoolExecutor, {}),
+                "process": (concurrent.futures.ProcessPoolExecutor, {"initializer": _exhaust_budget}),
+            }[backend]
+            limit = max_in_flight or granted * 4
+            with executor_class(max_workers=granted, **options) as executor:
+                pending: dict = {}
+                remaining = iter(chunks)
+                for chunk in remaining:
+                    pending[executor.submit(_run_chunk, func, chunk, kwargs)] = chunk
+                    if len(pending) < limit:
+                        continue
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        collect(_future_outcomes(future, pending.pop(future)))
+                for future in concurrent.futures.as_completed(pending):
+                    collect(_future_outcomes(future, pending[future]))
+    finally:
+        WORKER_BUDGET.release(granted)
+
+    if errors and not return_exceptions:
+        raise ParallelExecutionError(errors, results)
+    if key is not None:
+        return {key(item): result for item, result in zip(items, results)}
+    return results
+
+
+def _future_outcomes(future: concurrent.futures.Future, chunk: list) -> list:
+    try:
+        return future.result()
+    except Exception as e:  # np. BrokenProcessPool albo błąd serializacji: cała paczka ma ten błąd
+        return [(index, False, e) for index, _ in chunk]
+
+
+def create_http_session(
+        pool_size: int = 10, retries: int = 5, backoff_factor: float = 0.5,
+        status_forcelist: tuple = (429, 500, 502, 503, 504)
+) -> requests.Session:
+    """Session with a keep-alive connection pool and retry with backoff on 5xx, 429 and connection errors."""
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=("GET", "HEAD"),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_ENGINES: dict = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def _forget_engines_after_fork() -> None:
+    """Child side of fork: drops the inherited pools without closing their connections.
+
+    The sockets are shared with the parent; closing them here, or letting the pool do it when the engine is
+    garbage collected, would break the parent's live connections.
+    """
+    global _ENGINES_LOCK
+    _ENGINES_LOCK = threading.Lock()  # mógł być zajęty przez inny wątek rodzica w chwili fork
+    for engine in _ENGINES.values():
+        engine.dispose(close=False)
+    _ENGINES.clear()
+
+
+os.register_at_fork(after_in_child=_forget_engines_after_fork)
 
 
 def connect_to_db(db_name: str, db_user: str, db_password: str, db_port: str, db_host: str) -> sqlalchemy.Engine:
-    return create_engine(f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}")
+    """Process-wide pooled engine, one per database; pool tuned with DB_POOL_* environment variables."""
+    url = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+    with _ENGINES_LOCK:
+        if url not in _ENGINES:
+            _ENGINES[url] = create_engine(
+                url,
+                pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+                max_overflow=int(os.getenv("DB_POOL_MAX_OVERFLOW", 5)),
+                pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+                pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+                pool_pre_ping=True,
+            )
+        return _ENGINES[url]
 
 
-class RandomKeyPicker:
-    def __init__(self, keys):
-        self.keys = keys
-        self.counts = {key: 0 for key in keys}
+class TokenBucket:
+    """`capacity` calls per `period` seconds, refilled continuously."""
 
-    def pick_random_key(self) -> str:
-        min_count = min(self.counts.values())
-        least_chosen_key = [key for key, count in self.counts.items() if count == min_count]
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
 
-        chosen_key = random.choice(least_chosen_key)
-        self.counts[chosen_key] += 1
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
 
-        return chosen_key
+    def consume(self) -> None:
+        self.tokens -= 1
 
 
+class ApiKeyScheduler:
+    """Thread-safe API key scheduler with per-key rate limits.
+
+    Picks the least used key that has quota left (heap, O(log n)), keeps a token bucket per key for
+    calls/minute and calls/day, and benches keys that answered 401/429 until their cool-down ends.
+    """
+
+    BENCH_SECONDS = {401: 3600.0, 429: 60.0}
+
+    def __init__(self, keys: list, per_minute: int | None = 60, per_day: int | None = None):
+        self.keys = [key for key in keys if key]
+        if not self.keys:
+            raise ValueError("Brak kluczy API")
+
+        self._lock = threading.Lock()
+        self._buckets = {
+            key: [TokenBucket(limit, period) for limit, period in ((per_minute, 60), (per_day, 86400)) if limit]
+            for key in self.keys
+        }
+        self._calls = {key: 0 for key in self.keys}
+        self._errors = {key: 0 for key in self.keys}
+        self._benched_until = {key: 0.0 for key in self.keys}
+        self._version = {key: 0 for key in self.keys}  # unieważnia stare wpisy w kopcach
+        self._ready = [(0, random.random(), key, 0) for key in self.keys]
+        self._waiting = []
+        heapq.heapify(self._ready)
+
+    def _try_acquire(self) -> tuple[str | None, float]:
+        now = time.monotonic()
+        while self._waiting and self._waiting[0][0] <= now:
+            _, key, version = heapq.heappop(self._waiting)
+            if version == self._version[key]:
+                heapq.heappush(self._ready, (self._calls[key], random.random(), key, version))
+
+        while self._ready:
+            _, _, key, version = heapq.heappop(self._ready)
+            if version != self._version[key]:
+                continue
+
+            wait = max((bucket.wait_time(now) for bucket in self._buckets[key]), default=0.0)
+            if wait > 0:
+                heapq.heappush(self._waiting, (now + wait, key, version))
+                continue
+
+            for bucket in self._buckets[key]:
+                bucket.consume()
+            self._calls[key] += 1
+            heapq.heappush(self._ready, (self._calls[key], random.random(), key, version))
+            return key, 0.0
+
+        return None, self._waiting[0][0] - now
+
+    def acquire(self) -> str:
+        """Blocks until some key has quota left and returns it."""
+        while True:
+            with self._lock:
+                key, wait = self._try_acquire()
+            if key:
+                return key
+            time.sleep(wait)
+
+    async def acquire_async(self) -> str:
+        while True:
+            with self._lock:
+                key, wait = self._try_acquire()
+            if key:
+                return key
+            await asyncio.sleep(wait)
+
+    def report(self, key: str, status_code: int, retry_after: str | None = None) -> None:
+        """Benches `key` after a 401/429 response."""
+        if status_code not in self.BENCH_SECONDS:
+            return
+
+        seconds = float(retry_after) if retry_after and retry_after.isdigit() else self.BENCH_SECONDS[status_code]
+        with self._lock:
+            self._errors[key] += 1
+            self._version[key] += 1
+            self._benched_until[key] = time.monotonic() + seconds
+            heapq.heappush(self._waiting, (self._benched_until[key], key, self._version[key]))
+        logger.warning(f"Klucz API {self.mask(key)} odpowiedział {status_code}, odstawiony na {seconds:.0f} s")
+
+    def usage(self) -> dict:
+        """Per-key counters, with the keys masked."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                self.mask(key): {
+                    "calls": self._calls[key],
+                    "errors": self._errors[key],
+                    "benched_for_s": round(max(0.0, self._benched_until[key] - now), 1),
+                }
+                for key in self.keys
+            }
+
+    @staticmethod
+    def mask(key: str) -> str:
+        return f"{key[:4]}…{key[-2:]}"
+
 
 def get_centroids(
         db_connection: sqlalchemy.engine.base.Engine,
         grid_table: str = "poland_5km",
-        grid_table_schema: str = 'weather'
-) -> gpd.GeoDataFrame:
-    logger.info(f"...getting centroids from grid table {grid_table} starts")
-    metadata = MetaData()
-    db_grid_table = Table(grid_table, metadata, schema=grid_table_schema,
-                          autoload_with=db_connection)
+        grid_table_schema: str = 'weather',
+        aoi_ids: list = (12, 4),
+        aoi_table: str = 'wojewodztwa',
+        cache_folder: str | None = None,
+        cache_ttl: float = 24 * 3600,
+) -> "gpd.GeoDataFrame":
+    """Centroids of the grid cells intersecting the AOI polygons `aoi_ids`.
+
+    With `cache_folder` the result is kept on disk: within `cache_ttl` seconds it is returned without
+    touching the database, afterwards only a cheap change fingerprint of both tables is checked.
+    """
+    cache_path = None
+    if cache_folder:
+        key = f"{grid_table_schema}.{grid_table}|{aoi_table}|{','.join(str(i) for i in sorted(aoi_ids))}"
+        cache_path = os.path.join(cache_folder, f"centroids_{hashlib.sha1(key.encode()).hexdigest()[:16]}.npz")
+
+        cached = _read_centroid_cache(cache_path)
+        if cached is not None and time.time() - cached["created"] < cache_ttl:
+            logger.info(f"...centroids from cache {cache_path}")
+            return _centroids_frame(cached["id"], cached["x"], cached["y"])
+
+    fingerprint = _tables_fingerprint(db_connection, grid_table_schema, [grid_table, aoi_table])
+    if cache_path and cached is not None and cached["fingerprint"] == fingerprint:
+        _write_centroid_cache(cache_path, cached["id"], cached["x"], cached["y"], fingerprint)
+        logger.info(f"...grid unchanged, centroids from cache {cache_path}")
+        return _centroids_frame(cached["id"], cached["x"], cached["y"])
 
-    connection = db_connection.connect()
+    from geoalchemy2 import functions  # geoalchemy2 i geopandas tylko dla OpenWeather
 
-    db_aoi_table = Table('wojewodztwa', metadata, schema=grid_table_schema,
-                         autoload_with=db_connection)
+    logger.info(f"...getting centroids from grid table {grid_table} starts")
+    db_grid_table = table(grid_table, column('id'), column('geom'), schema=grid_table_schema)
+    db_aoi_table = table(aoi_table, column('id'), column('geom'), schema=grid_table_schema)
+    centroid = functions.ST_Centroid(db_grid_table.c.geom)
 
     query = select(
         db_grid_table.c.id,
-        functions.ST_AsText(functions.ST_Centroid(db_grid_table.c.geom)).label('geom')
-    ).where(and_(
-        db_aoi_table.c.id.in_([12, 4]),
-    )
+        functions.ST_X(centroid).label('x'),
+        functions.ST_Y(centroid).label('y'),
+    ).distinct().where(
+        db_aoi_table.c.id.in_(list(aoi_ids))
     ).select_from(
         db_grid_table.join(db_aoi_table, functions.ST_Intersects(db_grid_table.c.geom, db_aoi_table.c.geom))
     )
 
-    result = connection.execute(query)
-    connection.close()
+    with db_connection.connect() as connection:
+        rows = connection.execute(query).all()
 
-    df = pd.DataFrame(result, columns=result.keys())
-    df['geom'] = df['geom'].apply(wkt.loads)
+    ids, xs, ys = (np.asarray(values) for values in zip(*rows)) if rows else (np.empty(0),) * 3
+    if cache_path:
+        _write_centroid_cache(cache_path, ids, xs.astype(np.float64), ys.astype(np.float64), fingerprint)
 
     logger.info(f"...getting centroids from grid ends")
-    return gpd.GeoDataFrame(df, geometry='geom')
+    return _centroids_frame(ids, xs, ys)
+
+
+def _centroids_frame(ids: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> "gpd.GeoDataFrame":
+    import geopandas as gpd
+
+    return gpd.GeoDataFrame({'id': ids}, geometry=gpd.points_from_xy(xs, ys), crs="EPSG:4326").rename_geometry('geom')
+
+
+def _tables_fingerprint(db_connection, schema: str, tables: list) -> str:
+    """Row-change counters and sizes of the tables, read from the catalog without scanning them."""
+    with db_connection.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT s.relname, s.n_tup_ins, s.n_tup_upd, s.n_tup_del, pg_relation_size(s.relid) "
+            "FROM pg_stat_user_tables s WHERE s.schemaname = :schema AND s.relname = ANY(:tables) "
+            "ORDER BY s.relname"
+        ), {"schema": schema, "tables": list(tables)}).all()
+    return ";".join("|".join(str(value) for value in row) for row in rows)
+
+
+def _read_centroid_cache(path: str) -> dict | None:
+    try:
+        with np.load(path) as data:
+            return {
+                "id": data["id"], "x": data["x"], "y": data["y"],
+                "fingerprint": str(data["fingerprint"]), "created": float(data["created"]),
+            }
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _write_centroid_cache(path: str, ids, xs, ys, fingerprint: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        np.savez(file, id=ids, x=xs, y=ys, fingerprint=np.array(fingerprint), created=np.array(time.time()))
+    os.replace(tmp_path, path)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WEATHER_ENV_FILE", os.devnull)  # testy nie czytają ../.env
+
+import pytest
+
+
+@pytest.fixture
+def pg():
+    """PostgreSQL stand-in on DuckDB (tests/pg_standin.py) with the weather_icon schema."""
+    pytest.importorskip("duckdb")
+    from pg_standin import StandInEngine
+
+    engine = StandInEngine()
+    engine.execute("CREATE SCHEMA weather_icon; CREATE SCHEMA weather_ow")
+    return engine
@@ -0,0 +1,167 @@
+"""PostgreSQL stand-in on DuckDB for the upload and rollup SQL.
+
+The statements run on DuckDB after a few rewrites of what it lacks: to_regclass, advisory locks,
+`CREATE TEMP TABLE ... (LIKE ...) ON COMMIT DROP`, COPY FROM STDIN, PostGIS types and the point-in-region test
+(regions are stored as lon/lat boxes), ctid. Transactions of `begin()` are real DuckDB transactions.
+"""
+import io
+import re
+
+import duckdb
+import pandas as pd
+
+_LIKE = re.compile(r"CREATE TEMP TABLE (IF NOT EXISTS )?(\S+) \(LIKE (\S+) INCLUDING DEFAULTS\)")
+_COPY = re.compile(r"COPY (\S+) \((.*)\) FROM STDIN")
+_PARAM = re.compile(r"(?<![:\w]):(\w+)")
+_DML = ("INSERT", "UPDATE", "DELETE")
+
+
+class Result:
+    def __init__(self, rows: list, rowcount: int = -1):
+        self.rows = rows
+        self.rowcount = rowcount
+
+    def scalar(self):
+        return self.rows[0][0] if self.rows else None
+
+    def scalars(self):
+        return [row[0] for row in self.rows]
+
+    def one(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class Cursor:
+    def __init__(self, db: duckdb.DuckDBPyConnection):
+        self.db = db
+
+    def copy_expert(self, sql: str, stream) -> None:
+        table, columns = _COPY.match(sql).groups()
+        names = [name.strip().strip('"').replace('""', '"') for name in columns.split(",")]
+        frame = pd.read_csv(io.StringIO(stream.read()), header=None, names=names, dtype=str,
+                            keep_default_na=False, na_values=[""])
+        self.db.register("_copy", frame)
+        try:
+            self.db.execute(f"INSERT INTO {table} ({columns}) SELECT * FROM _copy")
+        finally:
+            self.db.unregister("_copy")
+
+    def close(self) -> None:
+        pass
+
+
+class Connection:
+    def __init__(self, engine: "StandInEngine"):
+        self.engine = engine
+        self.db = engine.db
+        self.drop_on_commit: set = set()
+        self.statements: list = []
+
+    @property
+    def connection(self):  # surowe połączenie DBAPI (psycopg2) dla COPY
+        return self
+
+    def cursor(self) -> Cursor:
+        return Cursor(self.db)
+
+    def execute(self, clause, params: dict | None = None) -> Result:
+        sql, params = str(clause), params or {}
+        self.statements.append(sql)
+        if "pg_advisory_xact_lock" in sql:
+            return Result([(None,)])
+        if "to_regclass" in sql:
+            return Result([(self.engine.exists(params["name"]),)])
+
+        if sql.rstrip().endswith("ON COMMIT DROP"):
+            sql = sql.rstrip().removesuffix("ON COMMIT DROP")
+            self.drop_on_commit.add(re.search(r"CREATE TEMP TABLE (?:IF NOT EXISTS )?(\S+)", sql).group(1))
+        sql = _LIKE.sub(lambda m: f"CREATE TEMP TABLE {m.group(1) or ''}{m.group(2)} AS SELECT * FROM {m.group(3)} "
+                                  f"LIMIT 0", sql)
+        sql = sql.replace("geometry(Point, 4326)", "VARCHAR")
+        sql = sql.replace("(tableoid, ctid)", "rowid").replace("tableoid, ctid", "rowid").replace("ctid", "rowid")
+
+        used = set(_PARAM.findall(sql))
+        sql = _PARAM.sub(lambda m: f"${m.group(1)}", sql)
+        args = {name: value for name, value in params.items() if name in used}
+        cursor = self.db.execute(sql, args) if args else self.db.execute(sql)
+        try:
+            rows = cursor.fetchall()
+        except duckdb.Error:
+            rows = []
+        dml = sql.lstrip().upper().startswith(_DML) and rows and len(rows[0]) == 1
+        return Result(rows, rows[0][0] if dml else -1)
+
+    def finish(self) -> None:
+        for table in self.drop_on_commit:
+            self.db.execute(f"DROP TABLE IF EXISTS {table}")
+        self.drop_on_commit.clear()
+
+
+class _Transaction:
+    def __init__(self, engine: "StandInEngine", transactional: bool):
+        self.engine = engine
+        self.transactional = transactional
+
+    def __enter__(self) -> Connection:
+        self.connection = Connection(self.engine)
+        self.engine.connections.append(self.connection)
+        if self.transactional:
+            self.engine.db.begin()
+        return self.connection
+
+    def __exit__(self, exc_type, *args) -> bool:
+        if not self.transactional:
+            self.connection.finish()
+        elif exc_type is None:
+            self.connection.finish()
+            self.engine.db.commit()
+        else:
+            self.engine.db.rollback()
+        return False
+
+
+class StandInEngine:
+    """The part of sqlalchemy.Engine the uploader uses: begin() for a transaction, connect() without one."""
+
+    def __init__(self):
+        self.db = duckdb.connect()
+        self.connections: list = []
+        self.db.execute("CREATE MACRO ST_MakePoint(x, y) AS struct_pack(x := x, y := y)")
+        self.db.execute("CREATE MACRO ST_SetSRID(g, srid) AS g")
+        self.db.execute("CREATE MACRO ST_SRID(g) AS 4326")
+        self.db.execute("CREATE MACRO ST_Transform(g, srid) AS g")
+        self.db.execute("CREATE MACRO ST_Intersects(box, p) AS "
+                        "p.x BETWEEN box.xmin AND box.xmax AND p.y BETWEEN box.ymin AND box.ymax")
+
+    def begin(self) -> _Transaction:
+        return _Transaction(self, transactional=True)
+
+    def connect(self) -> _Transaction:
+        return _Transaction(self, transactional=False)
+
+    def execute(self, sql: str, *args):
+        return self.db.execute(sql, *args)
+
+    def frame(self, sql: str) -> pd.DataFrame:
+        return self.db.execute(sql).fetchdf()
+
+    def exists(self, name: str) -> bool:
+        schema, _, relation = (part.strip('"') for part in name.rpartition("."))
+        for catalog, column in (("duckdb_tables()", "table_name"), ("duckdb_views()", "view_name"),
+                                ("duckdb_indexes()", "index_name")):
+            query = f"SELECT count(*) FROM {catalog} WHERE {column} = ?" + (" AND schema_name = ?" if schema else "")
+            if self.db.execute(query, [relation] + ([schema] if schema else [])).fetchone()[0]:
+                return True
+        return False
+
+    def add_regions(self, schema: str, table: str, boxes: dict) -> None:
+        """Region table (id, geom) with lon/lat boxes {id: (lon_min, lon_max, lat_min, lat_max)}."""
+        self.db.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+        self.db.execute(f"CREATE TABLE {schema}.{table} (id integer, "
+                        f"geom struct(xmin double, xmax double, ymin double, ymax double))")
+        for region_id, (xmin, xmax, ymin, ymax) in boxes.items():
+            self.db.execute(f"INSERT INTO {schema}.{table} VALUES (?, {{'xmin': ?, 'xmax': ?, 'ymin': ?, 'ymax': ?}})",
+                            [region_id, xmin, xmax, ymin, ymax])
@@ -0,0 +1,166 @@
+import bz2
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pass_metrics import metrics
+from weather.weather_downloader import IconEuApiDownloader, IconEuStreamDownloader
+
+NAME = "icon-eu_europe_regular-lat-lon_single-level_2025010100_003_T_2M.grib2.bz2"
+
+
+class StandInServer(ThreadingHTTPServer):
+    """DWD stand-in serving one file with an ETag, conditional GET and Range/If-Range."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.body = bz2.compress(os.urandom(256 * 1024))
+        self.etag = '"v1"'
+        self.exists = True
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/{NAME}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def respond(self, head: bool):
+        server = self.server
+        server.requests.append((self.command, dict(self.headers)))
+        if not server.exists:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.send_header("ETag", server.etag)
+            self.end_headers()
+            return
+
+        body, status = server.body, 200
+        range_header, if_range = self.headers.get("Range"), self.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == server.etag):
+            start = int(range_header.removeprefix("bytes=").rstrip("-"))
+            body, status = server.body[start:], 206
+        self.send_response(status)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(tmp_path):
+    return IconEuApiDownloader({
+        "DATE": "20250101", "FORECAST_HOUR": "00", "FORECAST_HOURS": ["003"], "LEVELS_T_SO": [], "LEVELS_W_SO": [],
+        "BASE_URL": "http://127.0.0.1", "DOWNLOAD_FOLDER_ICON": str(tmp_path), "DOWNLOAD_WORKERS": 1,
+        "HTTP_RETRIES": 0, "MANIFEST_PATH": str(tmp_path / "manifest.sqlite"),
+    })
+
+
+def test_download_is_revalidated_with_etag(server, downloader, tmp_path):
+    path = downloader.get_single_file(server.url)
+    assert open(path, "rb").read() == server.body
+    assert downloader.read_meta(path) == {"etag": server.etag, "last_modified": None, "size": len(server.body)}
+
+    server.requests.clear()
+    assert downloader.is_up_to_date(server.url, path)
+    assert server.requests[0][1]["If-None-Match"] == server.etag
+
+    server.etag = '"v2"'
+    assert not downloader.is_up_to_date(server.url, path)
+
+
+def test_file_without_meta_is_revalidated_with_etag_next_time(server, downloader, tmp_path):
+    path = tmp_path / NAME
+    path.write_bytes(server.body)  # pobrany przed wprowadzeniem plików .meta
+
+    assert downloader.is_up_to_date(server.url, str(path))
+    assert server.requests[-1][0] == "HEAD"
+    assert downloader.read_meta(str(path))["etag"] == server.etag
+
+    server.requests.clear()
+    assert downloader.is_up_to_date(server.url, str(path))
+    assert [(method, headers.get("If-None-Match")) for method, headers in server.requests] == [("GET", server.etag)]
+
+
+def test_fetch_resumes_part_file_with_range(server, downloader, tmp_path):
+    path = str(tmp_path / NAME)
+    with open(f"{path}.part", "wb") as file:
+        file.write(server.body[:1000])
+    downloader.write_meta(path, {"ETag": server.etag}, size=None)
+
+    downloader.fetch(server.url, path)
+
+    method, headers = server.requests[-1]
+    assert (headers["Range"], headers["If-Range"]) == ("bytes=1000-", server.etag)
+    assert open(path, "rb").read() == server.body
+    assert not os.path.exists(f"{path}.part")
+
+
+def test_fetch_restarts_when_file_changed_since_part(server, downloader, tmp_path):
+    path = str(tmp_path / NAME)
+    with open(f"{path}.part", "wb") as file:
+        file.write(b"stale bytes of the previous version")
+    downloader.write_meta(path, {"ETag": '"v0"'}, size=None)
+
+    downloader.fetch(server.url, path)
+
+    assert open(path, "rb").read() == server.body
+    assert downloader.read_meta(path)["etag"] == server.etag
+
+
+def test_file_removed_from_server_is_kept_only_if_complete(server, downloader, tmp_path):
+    server.exists = False
+    path = str(tmp_path / NAME)
+
+    with open(path, "wb") as file:
+        file.write(server.body[: len(server.body) // 2])  # pobrany przed zapisywaniem metadanych
+    assert not downloader.is_up_to_date(server.url, path)
+
+    with open(path, "wb") as file:
+        file.write(server.body)
+    assert downloader.is_up_to_date(server.url, path)
+    assert downloader.read_meta(path)["size"] == len(server.body)
+
+
+@pytest.mark.parametrize("body", [bz2.compress(os.urandom(256 * 1024))[:-1000], b"not bz2" * 1000],
+                         ids=["truncated", "corrupt"])
+def test_stream_with_bad_archive_is_skipped(server, tmp_path, body):
+    server.body = body
+    downloader = IconEuStreamDownloader({
+        "DATE": "20250101", "FORECAST_HOUR": "00", "FORECAST_HOURS": ["003"], "LEVELS_T_SO": [], "LEVELS_W_SO": [],
+        "BASE_URL": "http://127.0.0.1", "DOWNLOAD_FOLDER_ICON": str(tmp_path), "DOWNLOAD_WORKERS": 1,
+        "HTTP_RETRIES": 0, "MANIFEST_PATH": str(tmp_path / "manifest.sqlite"), "PIPELINE_CACHE": True,
+        "AREA": {"lat_min": 49, "lat_max": 55, "lon_min": 14, "lon_max": 25},
+    })
+    metrics.reset()
+
+    assert downloader.get_single_stream(server.url) is None
+    assert downloader.decoded_fields == {}
+    assert metrics.counters[metrics._key("items_failed_total", {"stage": "download"})] == 1
+    assert not list(tmp_path.glob("*.tmp")) and not (tmp_path / NAME).exists()
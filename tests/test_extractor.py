@@ -0,0 +1,47 @@
+import bz2
+import os
+import time
+
+from pass_metrics import metrics
+from weather.weather_extractor import IconEuExtractor, extract_bz2_file, remove_stale_tmp_files
+
+
+def test_remove_stale_tmp_files_keeps_files_being_written(tmp_path):
+    stale = tmp_path / "icon.grib2.111.tmp"
+    running = tmp_path / "icon.grib2.222.tmp"
+    archive = tmp_path / "icon.grib2.bz2"
+    for path in (stale, running, archive):
+        path.write_bytes(b"x")
+    old = time.time() - 2 * 60 * 60
+    os.utime(stale, (old, old))
+
+    removed = remove_stale_tmp_files(str(tmp_path))
+
+    assert removed == [str(stale)]
+    assert running.exists() and archive.exists()
+
+
+def test_extract_bz2_file_replaces_output_atomically(tmp_path):
+    data = os.urandom(3 * 1024 * 1024)
+    archive = tmp_path / "icon.grib2.bz2"
+    archive.write_bytes(bz2.compress(data))
+
+    stat = extract_bz2_file(str(archive), str(tmp_path), chunk_size=64 * 1024)
+
+    assert stat["file"] == str(tmp_path / "icon.grib2")
+    assert (tmp_path / "icon.grib2").read_bytes() == data
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_failed_extraction_is_counted(tmp_path):
+    (tmp_path / "good.grib2.bz2").write_bytes(bz2.compress(b"grib"))
+    (tmp_path / "broken.grib2.bz2").write_bytes(bz2.compress(b"grib")[:-8])  # urwany plik
+    extractor = IconEuExtractor({"DOWNLOAD_FOLDER_ICON": str(tmp_path), "DATE": "20250101", "FORECAST_HOUR": "00",
+                                 "EXTRACT_WORKERS": 2})
+    metrics.reset()
+
+    extractor.extract()
+
+    assert [stat["file"] for stat in extractor.stats] == [str(tmp_path / "good.grib2")]
+    assert metrics.counters[metrics._key("items_failed_total", {"stage": "extract"})] == 1
+    assert not list(tmp_path.glob("*.tmp"))
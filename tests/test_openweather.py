@@ -0,0 +1,65 @@
+import requests
+from shapely.geometry import Point
+
+from pass_utils import ApiKeyScheduler
+from weather.weather_downloader import OpenWeatherApiDownloader
+from weather.weather_extractor import responses_to_frame
+
+PAYLOAD = {
+    "coord": {"lon": 21.0, "lat": 52.2}, "weather": [{"id": 800, "main": "Clear", "description": "clear sky",
+                                                      "icon": "01d"}],
+    "main": {"temp": 3.5, "feels_like": 1.0, "temp_min": 2.0, "temp_max": 4.0, "pressure": 1015, "humidity": 80},
+    "visibility": 10000, "wind": {"speed": 3.1, "deg": 250}, "clouds": {"all": 0}, "sys": {"country": "PL"},
+    "name": "Warszawa",
+}
+
+
+class Response:
+    def __init__(self, status_code: int, payload: dict):
+        self.status_code = status_code
+        self.headers = {}
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class Session:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def get(self, url, timeout=None):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def downloader(*responses) -> OpenWeatherApiDownloader:
+    instance = OpenWeatherApiDownloader.__new__(OpenWeatherApiDownloader)  # bez połączenia z bazą
+    instance.picker = ApiKeyScheduler(["a", "b"], per_minute=None)
+    instance.base_url = "http://127.0.0.1"
+    instance.session = Session(*responses)
+    return instance
+
+
+def test_point_rejected_by_every_key_is_skipped():
+    rejected = {"cod": 401, "message": "Invalid API key"}
+    assert downloader(Response(401, rejected), Response(429, rejected)).get_single_coords((1, Point(21, 52)),
+                                                                                         "weather") is None
+
+
+def test_request_error_skips_the_point():
+    assert downloader(requests.ConnectionError("reset")).get_single_coords((1, Point(21, 52)), "weather") is None
+
+
+def test_retry_with_next_key_returns_data():
+    response = downloader(Response(429, {"cod": 429}), Response(200, PAYLOAD)).get_single_coords((7, Point(21, 52)),
+                                                                                                  "weather")
+    assert response == [7, PAYLOAD]
+
+
+def test_extractor_skips_points_without_response():
+    frame = responses_to_frame([[7, PAYLOAD], None])
+    assert frame["id_geom"].tolist() == [7]
+    assert frame["temp"].tolist() == [3.5]
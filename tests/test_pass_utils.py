@@ -0,0 +1,29 @@
+import os
+
+import pass_utils
+
+
+class Engine:
+    def __init__(self):
+        self.disposed = []
+
+    def dispose(self, close: bool = True):
+        self.disposed.append(close)
+
+
+def test_fork_child_disposes_inherited_engines_without_closing(monkeypatch):
+    engine = Engine()
+    monkeypatch.setitem(pass_utils._ENGINES, "postgresql://test", engine)
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # proces potomny: wynik przez potok, bez sprzątania pytest
+        try:
+            os.write(write_end, repr((engine.disposed, len(pass_utils._ENGINES))).encode())
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end) as pipe:
+        assert pipe.read() == repr(([False], 0))
+    assert engine.disposed == [] and pass_utils._ENGINES["postgresql://test"] is engine
@@ -0,0 +1,47 @@
+import bz2
+import os
+
+from weather import weather_extractor
+from weather.weather_extractor import IconEuExtractor
+from weather.weather_pipeline import run_streaming
+
+NAMES = [f"icon-eu_europe_regular-lat-lon_single-level_2025010100_{step}_T_2M.grib2.bz2" for step in ("000", "003")]
+
+
+class StandInStages:
+    """Downloader, transformer and uploader of a streaming run over local archives."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.uploaded = []
+
+    def get_links(self):
+        return [os.path.join(self.folder, name) for name in NAMES]
+
+    def get_single_file(self, url):
+        return url
+
+    def transform_step(self, hour, step_files):
+        return step_files
+
+    def upload_single_file(self, path):
+        self.uploaded.append(path)
+        return path
+
+
+def test_streaming_extract_runs_in_processes(tmp_path, monkeypatch):
+    for name in NAMES:
+        (tmp_path / name).write_bytes(bz2.compress(name.encode()))
+    pids = []
+    record = weather_extractor.record_extract_stats
+    monkeypatch.setattr(weather_extractor, "record_extract_stats",
+                        lambda stat: pids.append(stat["pid"]) or record(stat))
+    extractor = IconEuExtractor({"DOWNLOAD_FOLDER_ICON": str(tmp_path), "DATE": "20250101", "FORECAST_HOUR": "00",
+                                 "EXTRACT_BACKEND": "process"})
+    stages = StandInStages(str(tmp_path))
+
+    run_streaming(stages, extractor, stages, stages, {"PIPELINE_WORKERS": {"extract": 2}})
+
+    assert sorted(stages.uploaded) == [str(tmp_path / name.removesuffix(".bz2")) for name in NAMES]
+    assert len(pids) == 2 and os.getpid() not in pids
+    assert (tmp_path / NAMES[0].removesuffix(".bz2")).read_bytes() == NAMES[0].encode()
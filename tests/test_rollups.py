@@ -0,0 +1,149 @@
+import random
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from weather import weather_rollups
+from weather.weather_rollups import Rollups
+from weather.weather_uploader import ICON_TABLE_KEY, copy_upsert
+
+STEPS: list = [0, 3, 6, 9, 12, 15, 18, 21, 24, 27, 30, 36, 42, 48]
+
+
+@pytest.fixture
+def rollups(pg, monkeypatch):
+    monkeypatch.setattr(weather_rollups, "_READY", set())  # każdy test ma własną bazę
+    pg.add_regions("weather", "wojewodztwa", {1: (14, 19, 49, 55), 2: (19, 25, 49, 52)})
+    rollups = Rollups("weather_icon", "weather_data_v2", "weather_data_derived", ["latitude", "longitude"],
+                      regions="weather.wojewodztwa")
+    with pg.begin() as connection:
+        rollups.ensure(connection)
+    return rollups
+
+
+def grid() -> tuple:
+    lat, lon = np.meshgrid(np.arange(49, 54, 1, dtype=np.float32), np.arange(14, 24, 2, dtype=np.float32),
+                           indexing="ij")
+    return lat.ravel(), lon.ravel()
+
+
+def step_frames(run_on: datetime, seed: int) -> tuple:
+    """Temperature of every step and the precipitation of the interval ending at it, as post-processing gives."""
+    rng = np.random.default_rng(seed)
+    lat, lon = grid()
+    temperature, derived = {}, {}
+    for i, step in enumerate(STEPS):
+        update_on = pd.Timestamp(run_on) + pd.Timedelta(hours=step)
+        values = rng.normal(280, 5, lat.size).astype(np.float32)
+        values[rng.random(lat.size) < 0.1] = np.nan
+        temperature[step] = pd.DataFrame({"latitude": lat, "longitude": lon, "Temperature": values,
+                                          "update_on": update_on})
+        interval = step - STEPS[i - 1] if i else 0
+        derived[step] = pd.DataFrame({
+            "latitude": lat, "longitude": lon,
+            "Total precipitation": rng.gamma(1, 1, lat.size).astype(np.float32) if interval else np.float32(0),
+            "interval_hours": np.float32(interval), "update_on": update_on,
+        })
+    return temperature, derived
+
+
+def upload(pg, rollups: Rollups, frame: pd.DataFrame, run_on: datetime, derived: bool, tiles: int = 3) -> None:
+    """One file as IconEUDBUploader.upload_single_file loads it: values, then the rollups, in one transaction."""
+    table = rollups.derived_table if derived else rollups.table
+    with pg.begin() as connection:
+        for part in np.array_split(np.arange(len(frame)), tiles):
+            batch = frame.iloc[part].reset_index(drop=True)
+            copy_upsert(connection, batch, "weather_icon", table, ICON_TABLE_KEY)
+            rollups.stage(connection, batch, derived)
+        rollups.merge(connection, run_on, derived)
+
+
+def verify(pg, rollups: Rollups, run_on: datetime) -> dict:
+    with pg.connect() as connection:
+        return rollups.verify(connection, run_on)
+
+
+def test_steps_loaded_in_any_order_and_again_match_full_recomputation(pg, rollups):
+    for seed, run_on in enumerate([datetime(2025, 1, 1, 0), datetime(2025, 1, 1, 6)]):
+        temperature, derived = step_frames(run_on, seed)
+        files = [(frame, False) for frame in temperature.values()] + [(frame, True) for frame in derived.values()]
+        random.Random(seed).shuffle(files)
+        for frame, is_derived in files + files[:6]:  # kilka plików załadowanych drugi raz
+            upload(pg, rollups, frame, run_on, is_derived)
+
+        results = verify(pg, rollups, run_on)
+        assert results[rollups.daily]["ok"], results
+        assert results[rollups.daily_regions]["ok"], results
+
+    pg.execute("UPDATE weather_icon.weather_data_v2_daily SET temperature_max = temperature_max + 1 "
+               "WHERE latitude = 50 AND longitude = 20 AND day = '2025-01-02' AND run_on = '2025-01-01 06:00'")
+    results = verify(pg, rollups, datetime(2025, 1, 1, 6))
+    assert results[rollups.daily]["different"] == 1
+    assert results[rollups.daily_regions]["ok"]  # tabela regionów nie zmieniona
+
+
+def test_rederived_interval_replaces_precipitation_instead_of_adding(pg, rollups):
+    run_on = datetime(2025, 1, 1, 0)
+    temperature, derived = step_frames(run_on, 0)
+    late = derived.pop(9)  # krok 9 doszedł później: interwał kroku 12 obejmował najpierw 6 h
+    first = derived[12].copy()
+    first["Total precipitation"] += late["Total precipitation"]
+    first["interval_hours"] = np.float32(6)
+    for step, frame in derived.items():
+        upload(pg, rollups, first if step == 12 else frame, run_on, True)
+    for frame in temperature.values():
+        upload(pg, rollups, frame, run_on, False)
+    before = pg.frame("SELECT sum(precipitation_sum) AS total FROM weather_icon.weather_data_v2_daily")["total"][0]
+
+    upload(pg, rollups, pd.concat([late, derived[12]], ignore_index=True), run_on, True)  # przeliczone interwały
+
+    results = verify(pg, rollups, run_on)
+    assert results[rollups.daily]["ok"], results
+    assert results[rollups.daily_regions]["ok"], results
+    after = pg.frame("SELECT sum(precipitation_sum) AS total FROM weather_icon.weather_data_v2_daily")["total"][0]
+    assert after == pytest.approx(before, rel=1e-5)  # ta sama suma, tylko inaczej podzielona
+
+
+def test_retransformed_step_replaces_temperature_instead_of_widening(pg, rollups):
+    run_on = datetime(2025, 1, 1, 0)
+    temperature, _ = step_frames(run_on, 0)
+    for frame in temperature.values():
+        upload(pg, rollups, frame, run_on, False)
+
+    changed = temperature[12].copy()  # krok przeliczony po zmianie danych, nowa suma kontrolna w manifeście
+    changed["Temperature"] = changed["Temperature"].fillna(280) - 30
+    changed.loc[0, "Temperature"] = np.nan
+    upload(pg, rollups, changed, run_on, False)
+
+    results = verify(pg, rollups, run_on)
+    assert results[rollups.daily]["ok"], results
+    assert results[rollups.daily_regions]["ok"], results
+    day = pg.frame("SELECT min(temperature_min) AS low FROM weather_icon.weather_data_v2_daily "
+                   "WHERE day = '2025-01-01'")
+    assert day["low"][0] == pytest.approx(changed["Temperature"].min())
+
+
+def test_latest_views_show_the_newest_completed_run(pg, rollups):
+    runs = [datetime(2025, 1, 1, 0), datetime(2025, 1, 1, 6)]
+    for seed, run_on in enumerate(runs):
+        temperature, _ = step_frames(run_on, seed)
+        for frame in list(temperature.values())[:4]:
+            upload(pg, rollups, frame, run_on, False)
+
+    def latest() -> list:
+        return [pg.frame(f"SELECT DISTINCT run_on FROM weather_icon.{table}_latest")["run_on"].tolist()
+                for table in (rollups.daily, rollups.daily_regions)]
+
+    assert latest() == [[], []]  # żaden przebieg nie jest jeszcze pełny
+    with pg.begin() as connection:
+        rollups.complete(connection, runs[0])
+    assert latest() == [[pd.Timestamp(runs[0])]] * 2  # nowszy przebieg wciąż się ładuje
+    with pg.begin() as connection:
+        rollups.complete(connection, runs[1])
+        rollups.prune(connection, 1)
+    assert latest() == [[pd.Timestamp(runs[1])]] * 2
+    for table in rollups.tables[:3]:
+        runs_left = pg.frame(f"SELECT DISTINCT run_on FROM weather_icon.{table}")["run_on"].tolist()
+        assert runs_left == [pd.Timestamp(runs[1])], table
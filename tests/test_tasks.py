@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+pytest.importorskip("celery")
+
+from weather import weather_factories, weather_tasks  # noqa: E402
+
+
+class StandInStages:
+    """Downloader, extractor, transformer and uploader of a run that only move small files around."""
+
+    FORECAST_HOURS = ["000", "003", "006"]
+
+    def __init__(self, config):
+        self.config = config
+        self.calls = config["CALLS"]
+
+    # downloader
+    def get_links(self):
+        return [f"http://dwd.invalid/icon_{hour}_{name}.grib2.bz2" for hour in self.FORECAST_HOURS
+                for name in ("T_2M", "TOT_PREC")]
+
+    def get_single_file(self, url):
+        path = os.path.join(self.config["DOWNLOAD_FOLDER_ICON"], url.rsplit("/", 1)[-1])
+        with open(path, "w") as file:
+            file.write(url)
+        self.calls.append(("download", os.path.basename(path)))
+        return path
+
+    # extractor
+    def extract_single_file(self, path):
+        output = path.removesuffix(".bz2")
+        os.replace(path, output)
+        self.calls.append(("extract", os.path.basename(output)))
+        return output
+
+    # transformer
+    def transform_step(self, hour, step_files):
+        path = os.path.join(self.config["TMP_FOLDER"], f"combined_grib_data_2025010100_{hour}.arrow")
+        with open(path, "w") as file:
+            file.write("\n".join(sorted(step_files)))
+        self.calls.append(("transform", hour, len(step_files)))
+        return path
+
+    # uploader
+    def upload_single_file(self, path):
+        self.calls.append(("upload", os.path.basename(path)))
+        return path
+
+    def complete_rollups(self):
+        self.calls.append(("complete",))
+
+
+class StandInHandler:
+    stages: dict = {}
+
+    def _stages(self, config):
+        return self.stages.setdefault(id(config), StandInStages(config))
+
+    get_downloader = get_extractor = get_transformer = get_uploader = _stages
+
+    def get_postprocessor(self, config):
+        return None
+
+
+@pytest.fixture
+def stand_in_run(tmp_path, monkeypatch):
+    calls = []
+
+    class FactoryStandIn:
+        handler = StandInHandler()
+
+        def __init__(self):
+            self.config = {
+                "DOWNLOAD_FOLDER_ICON": str(tmp_path / "downloaded_files"), "TMP_FOLDER": str(tmp_path / "tmp"),
+                "MANIFEST_PATH": str(tmp_path / "downloaded_files" / "manifest.sqlite"), "CALLS": calls,
+            }
+            for folder in (self.config["DOWNLOAD_FOLDER_ICON"], self.config["TMP_FOLDER"]):
+                os.makedirs(folder, exist_ok=True)
+
+    monkeypatch.setattr(weather_factories, "FactoryStandIn", FactoryStandIn, raising=False)
+    monkeypatch.setattr(weather_tasks, "_CONTEXTS", {})
+    for name, value in {"task_always_eager": True, "broker_url": "memory://",
+                        "result_backend": "cache+memory://"}.items():
+        monkeypatch.setitem(weather_tasks.app.conf, name, value)
+    return calls
+
+
+def test_run_goes_through_all_tasks_eagerly(stand_in_run, tmp_path):
+    key = weather_tasks.start_run.delay("FactoryStandIn", run_date="20250101", run_hour="00").get()
+
+    assert key == "FactoryStandIn:2025010100"
+    calls = stand_in_run
+    assert sum(call[0] == "download" for call in calls) == 6
+    assert sum(call[0] == "extract" for call in calls) == 6
+    assert sorted(call for call in calls if call[0] == "transform") == [
+        ("transform", hour, 2) for hour in StandInStages.FORECAST_HOURS
+    ]
+    assert sorted(call[1] for call in calls if call[0] == "upload") == [
+        f"combined_grib_data_2025010100_{hour}.arrow" for hour in StandInStages.FORECAST_HOURS
+    ]
+    assert calls[-1] == ("complete",)  # finish_run po wszystkich krokach
+    assert [name for name, queue in weather_tasks.QUEUES.items() if queue == "db"] == [
+        "weather.upload_step", "weather.finish_run",  # zapisy do bazy tylko w kolejce db
+    ]
+    assert not list(tmp_path.rglob(".weather_run_*"))  # znaczniki przebiegu usunięte po zakończeniu
+
+
+def test_node_without_shared_folders_refuses_the_run(stand_in_run, tmp_path):
+    run = weather_tasks.make_run("FactoryStandIn", "20250101", "00")
+    run["storage"] = weather_tasks.mark_shared_storage(weather_tasks.run_config(run))
+    assert weather_tasks.context(run).run is run
+
+    local = {"DOWNLOAD_FOLDER_ICON": str(tmp_path / "node2" / "downloaded_files"),
+             "TMP_FOLDER": str(tmp_path / "node2" / "tmp")}  # ten sam przebieg na dysku lokalnym innego węzła
+    with pytest.raises(weather_tasks.SharedStorageError, match="node2"):
+        weather_tasks.check_shared_storage(run, local)
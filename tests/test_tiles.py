@@ -0,0 +1,90 @@
+import bz2
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pygrib")
+
+from weather.weather_benchmark import generate_icon_files, icon_config  # noqa: E402
+from weather.weather_downloader import IconEuApiDownloader  # noqa: E402
+from weather.weather_intermediate import iter_step_batches  # noqa: E402
+from weather.weather_tiles import field_tiles  # noqa: E402
+from weather.weather_transformer import IconEuTransformer  # noqa: E402
+
+HOUR = "003"
+BUDGET_MB = 1  # kilka kafelków na krok POLAND
+
+
+@pytest.fixture(scope="module")
+def step_files(tmp_path_factory):
+    """Synthetic ICON-EU GRIB2 files of one forecast step (benchmark generator), decompressed."""
+    workdir = str(tmp_path_factory.mktemp("icon"))
+    config = icon_config("POLAND", 2, "http://127.0.0.1", workdir)
+    links = [link for link in IconEuApiDownloader(config).get_links() if f"_{HOUR}_" in link]
+    generate_icon_files(workdir, links)
+
+    paths = []
+    for link in links:
+        archive = os.path.join(workdir, link.rsplit("/", 1)[-1])
+        path = archive.removesuffix(".bz2")
+        with bz2.open(archive) as source, open(path, "wb") as target:
+            target.write(source.read())
+        paths.append(path)
+    return workdir, paths
+
+
+def transformer(workdir: str, name: str, **overrides) -> IconEuTransformer:
+    config = icon_config("POLAND", 2, "http://127.0.0.1", workdir)
+    config.update({"TMP_FOLDER": os.path.join(workdir, name), "MANIFEST_PATH": os.path.join(workdir, f"{name}.sqlite"),
+                   **overrides})
+    return IconEuTransformer(config)
+
+
+def read_step(path: str) -> tuple:
+    batches = list(iter_step_batches(path))
+    frame = pd.concat(batches, ignore_index=True)
+    return frame[sorted(frame.columns)], len(batches)
+
+
+@pytest.mark.parametrize("overrides", [{}, {"STORAGE_MODE": "cells"}, {"AREAS": {"POLAND": "a", "GERMANY": "b"}}],
+                         ids=["points", "cells", "areas"])
+def test_tiled_step_equals_untiled_step(step_files, overrides):
+    workdir, paths = step_files
+    name = "_".join(overrides) or "points"
+    whole = transformer(workdir, f"whole_{name}", **overrides).transform_step(HOUR, paths)
+    tiled = transformer(workdir, f"tiled_{name}", TILE_MEMORY_BUDGET_MB=BUDGET_MB, **overrides).transform_step(
+        HOUR, paths)
+
+    for whole_path, tiled_path in zip(np.atleast_1d(whole), np.atleast_1d(tiled)):
+        expected, expected_batches = read_step(whole_path)
+        actual, tiles = read_step(tiled_path)
+        assert len(expected) and expected_batches == 1 and tiles > 1
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_tiled_in_memory_step_equals_untiled_step(step_files):
+    workdir, paths = step_files
+    outputs = []
+    for name, overrides in (("memory_whole", {}), ("memory_tiled", {"TILE_MEMORY_BUDGET_MB": BUDGET_MB})):
+        step = transformer(workdir, name, IN_MEMORY_PIPELINE=True, **overrides)
+        step.decoded_fields.update({path: step.decode_single_file(path) for path in paths})
+        outputs.append(read_step(step.transform_step(HOUR, paths)))
+
+    (expected, _), (actual, tiles) = outputs
+    assert tiles > 1
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_fields_on_different_grids_are_not_tiled_with_a_warning(caplog):
+    fields = [
+        {"name": name, "index": np.arange(start, start + 10_000), "latitude": np.repeat(np.arange(100.0), 100),
+         "longitude": np.tile(np.arange(100.0), 100), "values": np.zeros(10_000)}
+        for name, start in (("Temperature", 0), ("Soil moisture", 5))
+    ]
+    with caplog.at_level(logging.WARNING):
+        tiles = list(field_tiles(fields, budget_mb=0.001))
+    assert len(tiles) == 1 and tiles[0] is fields
+    assert "różnych siatkach" in caplog.text
@@ -0,0 +1,107 @@
+import pandas as pd
+import pytest
+
+from weather import weather_uploader
+from weather.weather_intermediate import iter_step_batches, step_file_name, synthetic_step, with_geometry, write_step
+from weather.weather_uploader import (OW_TABLE_KEY, DuplicateKeysError, IconEUDBUploader, copy_upsert,
+                                      deduplicate_table, ensure_table, ensure_upsert_key)
+
+
+def ow_frame(temps: list, ids: list | None = None) -> pd.DataFrame:
+    return pd.DataFrame({
+        "id_geom": pd.array(ids or range(len(temps)), dtype="int64"),
+        "update_time": pd.Timestamp("2025-01-01 12:00"),
+        "temp": pd.array(temps, dtype="float32"),
+    })
+
+
+def test_copy_upsert_creates_key_and_updates_existing_rows(pg):
+    with pg.begin() as connection:
+        assert copy_upsert(connection, ow_frame([1.0, 2.0]), "weather_ow", "weather_OW", OW_TABLE_KEY) == 2
+    with pg.begin() as connection:
+        copy_upsert(connection, ow_frame([5.0, 7.0, 9.0], [1, 2, 1]), "weather_ow", "weather_OW", OW_TABLE_KEY)
+
+    statements = pg.connections[-1].statements
+    assert [sql.split(" (")[0].split(" {")[0] for sql in statements if not sql.startswith("SELECT")] == [
+        'CREATE TEMP TABLE IF NOT EXISTS "staging_weather_OW"', 'TRUNCATE "staging_weather_OW"',
+        'INSERT INTO "weather_ow"."weather_OW"',
+    ]
+    assert "ON CONFLICT (\"id_geom\", \"update_time\") DO UPDATE SET \"temp\" = EXCLUDED.\"temp\"" in statements[-1]
+    rows = pg.frame('SELECT id_geom, temp FROM weather_ow."weather_OW" ORDER BY id_geom')
+    assert rows.values.tolist() == [[0, 1.0], [1, 5.0], [2, 7.0]]  # DISTINCT ON: jeden wiersz na klucz
+    assert pg.exists('"weather_ow"."weather_OW_upsert_key"')
+
+
+def test_table_with_appended_duplicates_needs_deduplication(pg):
+    pg.execute('CREATE TABLE weather_ow."weather_OW" (id_geom bigint, update_time timestamp, temp real)')
+    pg.execute("INSERT INTO weather_ow.\"weather_OW\" VALUES (1, '2025-01-01 12:00', 1), (1, '2025-01-01 12:00', 2), "
+               "(2, '2025-01-01 12:00', 3), (NULL, NULL, 4), (NULL, NULL, 5)")
+
+    with pytest.raises(DuplicateKeysError, match="deduplicate weather_ow weather_OW --key id_geom,update_time"):
+        with pg.begin() as connection:
+            ensure_table(connection, ow_frame([0.0]), "weather_ow", "weather_OW", OW_TABLE_KEY)
+    assert not pg.exists('"weather_ow"."weather_OW_upsert_key"')
+
+    with pg.begin() as connection:
+        assert deduplicate_table(connection, "weather_ow", "weather_OW", OW_TABLE_KEY) == 1
+    with pg.begin() as connection:
+        ensure_upsert_key(connection, "weather_ow", "weather_OW", OW_TABLE_KEY)
+    assert pg.exists('"weather_ow"."weather_OW_upsert_key"')
+    rows = pg.frame('SELECT id_geom, temp FROM weather_ow."weather_OW" ORDER BY temp')
+    assert rows["temp"].tolist() == [2.0, 3.0, 4.0, 5.0]  # ostatni dopisany wiersz klucza, NULL bez zmian
+
+    with pg.begin() as connection:
+        copy_upsert(connection, ow_frame([8.0], [1]), "weather_ow", "weather_OW", OW_TABLE_KEY)
+    assert pg.frame('SELECT temp FROM weather_ow."weather_OW" WHERE id_geom = 1')["temp"].tolist() == [8.0]
+
+
+def icon_step(rows: int) -> pd.DataFrame:
+    frame = synthetic_step(rows)
+    frame["update_on"] = pd.Timestamp("2025-01-01 03:00")
+    return frame
+
+
+@pytest.mark.parametrize("storage_mode", ["points", "cells"])
+def test_step_with_several_batches_uploads_in_one_transaction(pg, tmp_path, monkeypatch, storage_mode):
+    monkeypatch.setattr(weather_uploader, "db_engine", lambda: pg)
+    monkeypatch.setattr(weather_uploader, "_KNOWN_CELLS", {})
+    uploader = IconEUDBUploader({
+        "DOWNLOAD_FOLDER_ICON": str(tmp_path), "TMP_FOLDER": str(tmp_path), "DATE": "20250101", "FORECAST_HOUR": "00",
+        "STORAGE_MODE": storage_mode, "UPLOAD_BACKEND": "copy",
+    })
+    step = icon_step(2_500)
+    path = str(tmp_path / step_file_name("20250101", "00", "003", "arrow"))
+    write_step(step, path, batch_rows=1_000)
+    assert len(list(iter_step_batches(path))) == 3
+
+    uploader.upload_single_file(path)
+    uploader.upload_single_file(path)  # ponowne ładowanie aktualizuje te same wiersze
+
+    table = "weather_icon.weather_data_v2" if storage_mode == "points" else "weather_icon.weather_values"
+    assert pg.frame(f"SELECT count(*) AS n FROM {table}")["n"][0] == len(step)
+    statements = pg.connections[-1].statements
+    assert sum(sql.startswith("CREATE TEMP TABLE IF NOT EXISTS") for sql in statements) >= 3
+    assert not pg.exists("staging_weather_data_v2") and not pg.exists("staging_weather_values")
+
+
+def test_cells_storage_builds_points_only_for_new_cells(pg, tmp_path, monkeypatch):
+    monkeypatch.setattr(weather_uploader, "db_engine", lambda: pg)
+    monkeypatch.setattr(weather_uploader, "_KNOWN_CELLS", {})
+    built = []
+    monkeypatch.setattr(weather_uploader, "with_geometry",
+                        lambda frame: built.append(len(frame)) or with_geometry(frame))
+    uploader = IconEUDBUploader({
+        "DOWNLOAD_FOLDER_ICON": str(tmp_path), "TMP_FOLDER": str(tmp_path), "DATE": "20250101", "FORECAST_HOUR": "00",
+        "STORAGE_MODE": "cells",
+    })
+    step = icon_step(2_500)
+    first = str(tmp_path / step_file_name("20250101", "00", "003", "arrow"))
+    write_step(step.iloc[:1_500], first, batch_rows=1_000)
+    second = str(tmp_path / step_file_name("20250101", "00", "006", "arrow"))
+    write_step(step, second, batch_rows=1_000)
+
+    uploader.upload_single_file(first)
+    uploader.upload_single_file(second)
+
+    assert built == [1_000, 500, 500, 500]  # komórki pierwszego kroku już znane, potem tylko nowe
+    assert pg.frame("SELECT count(*) AS n FROM weather_icon.grid_cells")["n"][0] == len(step)
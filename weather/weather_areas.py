@@ -34,3 +34,21 @@ class Area(Enum):
     def get_bounds(self):
         return self.value
 
+
+def decode_bounds(config: dict) -> dict:
+    """Bounds the GRIB fields are cropped to: AREA, or the box around every area of AREAS."""
+    areas = config.get("AREAS")
+    if not areas:
+        return config["AREA"]
+    bounds = [Area[name].get_bounds() for name in areas]
+    return {
+        "lat_min": min(area["lat_min"] for area in bounds),
+        "lat_max": max(area["lat_max"] for area in bounds),
+        "lon_min": min(area["lon_min"] for area in bounds),
+        "lon_max": max(area["lon_max"] for area in bounds),
+    }
+
+
+def area_outputs(config: dict) -> dict:
+    """Area name -> bounds of every output of a multi-area run ({} for a single AREA)."""
+    return {name: Area[name].get_bounds() for name in config.get("AREAS") or {}}
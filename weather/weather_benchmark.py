@@ -0,0 +1,613 @@
+"""Offline benchmark of the weather pipeline on synthetic data.
+
+Synthetic ICON-EU GRIB2 files (regular_ll 1377 x 657, simple packing, bz2) and fake OpenWeather
+responses are served from a local HTTP server. Uploads go to an in-process stand-in of the database
+unless BENCH_TARGET=postgis, in which case the DB_* configuration is used.
+
+    python -m weather.weather_benchmark --areas POLAND GERMANY EUROPE --steps 4 --output bench.json
+    python -m weather.weather_benchmark --compare old.json new.json
+    python -m weather.weather_benchmark --areas EUROPE --tile-budget-mb 64   # przetwarzanie w kafelkach
+    python -m weather.weather_benchmark --startup --startup-budget-ms 100   # czas importu CLI (-X importtime)
+
+Every scenario runs in its own process, so the reported peak RSS belongs to that scenario only.
+"""
+import argparse
+import bz2
+import json
+import os
+import platform
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pyarrow as pa
+
+ICON_GRID: dict = {"ni": 1377, "nj": 657, "lat1": 29.5, "lon1": -23.5, "increment": 0.0625}
+
+# suffix -> (discipline, category, number, type of surface, scale factor of level, level)
+ICON_PARAMETERS: dict = {
+    "T_2M": (0, 0, 0, 103, 0, 2),
+    "TOT_PREC": (0, 1, 52, 1, 0, 0),
+    "T_SO": (2, 3, 18, 106, 2, 0),
+    "W_SO": (2, 3, 20, 106, 2, 0),
+}
+
+SCENARIOS: tuple = ("icon-stages", "icon-process", "ow")
+
+# nie powinny być importowane przy starcie CLI, dopiero przez etap, który ich używa
+HEAVY_MODULES: tuple = ("pygrib", "geopandas", "shapely", "pandas", "numpy", "sqlalchemy", "pyarrow", "requests")
+
+
+def _signed32(value: float) -> bytes:
+    """GRIB2 signed integers are sign-magnitude, not two's complement."""
+    value = int(round(value))
+    return struct.pack(">I", (abs(value) | 0x80000000) if value < 0 else value)
+
+
+def _signed16(value: int) -> bytes:
+    return struct.pack(">H", (abs(value) | 0x8000) if value < 0 else value)
+
+
+def encode_grib2(values: np.ndarray, variable: str, date: str, hour: str, step: int, decimal_scale: int = 2) -> bytes:
+    """One GRIB2 message on the ICON-EU grid: templates 3.0, 4.0 and 5.0 (16-bit simple packing)."""
+    discipline, category, number, surface, level_scale, level = ICON_PARAMETERS[variable]
+    ni, nj, lat1, lon1, increment = (ICON_GRID[name] for name in ("ni", "nj", "lat1", "lon1", "increment"))
+    lat2, lon2 = lat1 + (nj - 1) * increment, lon1 + (ni - 1) * increment
+
+    section1 = struct.pack(">IBHHBBBHBBBBBBB", 21, 1, 78, 255, 19, 0, 1,
+                           int(date[:4]), int(date[4:6]), int(date[6:]), int(hour), 0, 0, 0, 1)
+    section3 = (
+        struct.pack(">IBBIBBH", 72, 3, 0, ni * nj, 0, 0, 0)
+        + struct.pack(">BBIBIBI", 6, 0, 0, 0, 0, 0, 0)
+        + struct.pack(">IIII", ni, nj, 0, 0xFFFFFFFF)
+        + _signed32(lat1 * 1e6) + _signed32(lon1 * 1e6) + bytes([0x30])
+        + _signed32(lat2 * 1e6) + _signed32(lon2 * 1e6)
+        + struct.pack(">II", round(increment * 1e6), round(increment * 1e6)) + bytes([0x40])
+    )
+    section4 = (
+        struct.pack(">IBHH", 34, 4, 0, 0)
+        + struct.pack(">BBBBBHBBI", category, number, 2, 255, 255, 0, 0, 1, step)
+        + struct.pack(">BBI", surface, level_scale, level)
+        + struct.pack(">BBI", 255, 255, 0xFFFFFFFF)
+    )
+
+    scaled = np.round(np.asarray(values, dtype=np.float64) * 10 ** decimal_scale)
+    reference = scaled.min()
+    packed = np.clip(scaled - reference, 0, 65535).astype(">u2").tobytes()
+    section5 = struct.pack(">IBIH", 21, 5, ni * nj, 0) + struct.pack(">f", reference) \
+        + _signed16(0) + _signed16(decimal_scale) + bytes([16, 0])
+    section6 = struct.pack(">IBB", 6, 6, 255)
+    section7 = struct.pack(">IB", 5 + len(packed), 7) + packed
+
+    body = section1 + section3 + section4 + section5 + section6 + section7 + b"7777"
+    return b"GRIB\0\0" + bytes([discipline, 2]) + struct.pack(">Q", 16 + len(body)) + body
+
+
+def synthetic_field(variable: str, step: int, rng: np.random.Generator) -> np.ndarray:
+    ni, nj, lat1, lon1, increment = (ICON_GRID[name] for name in ("ni", "nj", "lat1", "lon1", "increment"))
+    lat = np.radians(lat1 + increment * np.arange(nj))[:, None]
+    lon = np.radians(lon1 + increment * np.arange(ni))[None, :]
+    wave = np.sin(4 * lon + step / 6) * np.cos(3 * lat)
+    noise = rng.normal(0, 0.3, (nj, ni))
+    if variable == "TOT_PREC":
+        return np.clip(2 * wave + noise, 0, None) * step / 3
+    if variable == "W_SO":
+        return 300 + 50 * wave + 10 * noise
+    return 273.15 + 25 * np.cos(lat) + 5 * wave + noise  # T_2M, T_SO
+
+
+def generate_icon_files(folder: str, links: list, seed: int = 0) -> int:
+    """Writes one bz2-compressed GRIB2 file per link, named like the DWD file; returns the bytes written."""
+    from weather.weather_manifest import parse_icon_filename
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    total = 0
+    for link in links:
+        filename = link.rsplit("/", 1)[-1]
+        parsed = parse_icon_filename(filename)
+        step = int(parsed["step"])
+        values = synthetic_field(parsed["variable"], step, rng)
+        data = bz2.compress(encode_grib2(values, parsed["variable"], parsed["run_date"], parsed["run_hour"], step))
+        with open(os.path.join(folder, filename), "wb") as file:
+            file.write(data)
+        total += len(data)
+    return total
+
+
+def ow_response(lat: float, lon: float) -> dict:
+    """OpenWeather /data/2.5/weather response for a point, deterministic for the coordinates."""
+    rng = np.random.default_rng(abs(hash((round(lat, 4), round(lon, 4)))) % 2 ** 32)
+    temp = float(rng.normal(12, 6))
+    response = {
+        "coord": {"lon": lon, "lat": lat},
+        "weather": [{"id": 500, "main": "Rain", "description": "light rain", "icon": "10d"}],
+        "main": {"temp": temp, "feels_like": temp - 1, "temp_min": temp - 2, "temp_max": temp + 2,
+                 "pressure": int(rng.integers(990, 1030)), "humidity": int(rng.integers(30, 100))},
+        "visibility": 10000,
+        "wind": {"speed": float(rng.gamma(2, 2)), "deg": int(rng.integers(0, 360))},
+        "clouds": {"all": int(rng.integers(0, 100))},
+        "dt": int(time.time()),
+        "sys": {"country": "PL"},
+        "name": "Synthetic",
+    }
+    if rng.random() < 0.3:
+        response["rain"] = {"1h": float(rng.gamma(1, 1))}
+    return response
+
+
+class _BenchmarkRequestHandler(SimpleHTTPRequestHandler):
+    """Serves generated files by name (any directory prefix) and fakes the OpenWeather API."""
+
+    def translate_path(self, path):
+        return os.path.join(self.directory, os.path.basename(urlparse(path).path))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith("/weather"):
+            query = parse_qs(url.query)
+            body = json.dumps(ow_response(float(query["lat"][0]), float(query["lon"][0]))).encode()
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer:
+    """Threaded HTTP server on a free local port, stopped on exit."""
+
+    def __init__(self, folder: str):
+        handler = lambda *args, **kwargs: _BenchmarkRequestHandler(*args, directory=folder, **kwargs)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        return False
+
+
+class _NullResult:
+    def scalar(self):
+        return True  # relation_exists: tabele "istnieją", więc bez DDL
+
+    def scalars(self):
+        return iter(())
+
+    def one(self):
+        return 0, 0
+
+
+class _NullCursor:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def copy_expert(self, sql, stream, size=8192):
+        while True:
+            data = stream.read(size * 8)
+            if not data:
+                break
+            with self.engine.lock:
+                self.engine.copied_bytes += len(data)
+
+    def close(self):
+        pass
+
+
+class NullEngine:
+    """In-process database stand-in: runs the client side of every upload (CSV/EWKB rendering, COPY
+    streaming) and discards the data. Counts statements and COPY bytes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.copied_bytes = 0
+        self.connection = self  # DBAPI connection of the "Connection"
+
+    def begin(self):
+        return self
+
+    connect = begin
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, statement, parameters=None):
+        with self.lock:
+            self.statements += 1
+        return _NullResult()
+
+    def cursor(self):
+        return _NullCursor(self)
+
+
+def peak_rss_mb() -> dict:
+    to_mb = 1 / 1024 if sys.platform != "darwin" else 1 / 1024 ** 2
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * to_mb, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * to_mb, 1),
+    }
+
+
+def _timed(func, latencies: list):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    return wrapper
+
+
+def _latency(latencies: list) -> dict:
+    if not latencies:
+        return {}
+    values = np.asarray(latencies)
+    return {"p50_s": round(float(np.percentile(values, 50)), 4), "p95_s": round(float(np.percentile(values, 95)), 4),
+            "max_s": round(float(values.max()), 4)}
+
+
+def _stage(name: str, seconds: float, files: int = 0, nbytes: int = 0, rows: int = 0,
+           latencies: list | None = None) -> dict:
+    return {
+        "stage": name,
+        "seconds": round(seconds, 3),
+        "files": files,
+        "files_per_s": round(files / seconds, 2) if seconds else None,
+        "mb": round(nbytes / 1e6, 2),
+        "mb_per_s": round(nbytes / 1e6 / seconds, 2) if seconds else None,
+        "rows": rows,
+        "rows_per_s": round(rows / seconds) if seconds else None,
+        "latency": _latency(latencies or []),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _folder_bytes(folder: str, suffix: str) -> tuple:
+    paths = [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(suffix)]
+    return len(paths), sum(os.path.getsize(path) for path in paths)
+
+
+def _step_rows(folder: str) -> int:
+    from weather.weather_intermediate import list_step_files
+
+    rows = 0
+    for path in list_step_files(folder, "arrow"):
+        with pa.memory_map(path, "r") as source:
+            reader = pa.ipc.open_file(source)
+            rows += sum(reader.get_batch(index).num_rows for index in range(reader.num_record_batches))
+    return rows
+
+
+def icon_config(area: str, steps: int, server_url: str, workdir: str) -> dict:
+    from weather.weather_areas import Area
+    from weather.weather_factories import FactoryWeatherICONPolandForecast
+
+    config = FactoryWeatherICONPolandForecast().config
+    config.update({
+        "DATE": "20250101",
+        "FORECAST_HOURS": config["FORECAST_HOURS"][:steps],
+        "BASE_URL": f"{server_url}/icon-eu/grib",
+        "DOWNLOAD_FOLDER_ICON": os.path.join(workdir, "downloaded_files"),
+        "TMP_FOLDER": os.path.join(workdir, "tmp"),
+        "MANIFEST_PATH": os.path.join(workdir, "manifest.sqlite"),
+        "AREA": Area[area].get_bounds(),
+    })
+    if os.getenv("BENCH_TILE_MEMORY_BUDGET_MB"):
+        config["TILE_MEMORY_BUDGET_MB"] = float(os.environ["BENCH_TILE_MEMORY_BUDGET_MB"])
+    return config
+
+
+def _attach_database(component) -> None:
+    """Points an uploader at the stand-in unless BENCH_TARGET=postgis."""
+    if os.getenv("BENCH_TARGET", "standin") != "postgis":
+        for name in ("engine", "db_connection"):
+            if hasattr(component, name):
+                setattr(component, name, NullEngine())
+
+
+def _serve_icon(area: str, steps: int, workdir: str):
+    from weather.weather_downloader import IconEuApiDownloader
+
+    config = icon_config(area, steps, "http://placeholder", workdir)
+    served = os.path.join(workdir, "served")
+    links = IconEuApiDownloader(config).get_links()
+    generated_bytes = generate_icon_files(served, links)
+    return served, generated_bytes
+
+
+def run_icon_stages(area: str, steps: int, workdir: str) -> dict:
+    from weather.weather_interfaces import HandlerIconEuWeather
+
+    served, generated_bytes = _serve_icon(area, steps, workdir)
+    stages = []
+    with LocalServer(served) as server:
+        config = icon_config(area, steps, server.url, workdir)
+        handler = HandlerIconEuWeather()
+        downloader = handler.get_downloader(config=config)
+        extractor = handler.get_extractor(config=config)
+        transformer = handler.get_transformer(config=config)
+        uploader = handler.get_uploader(config=config)
+        _attach_database(uploader)
+
+        latencies = {name: [] for name in ("download", "transform", "upload")}
+        downloader.get_single_file = _timed(downloader.get_single_file, latencies["download"])
+        transformer.transform_step = _timed(transformer.transform_step, latencies["transform"])
+        uploader.upload_single_file = _timed(uploader.upload_single_file, latencies["upload"])
+
+        started = time.perf_counter()
+        downloader.get_data()
+        files, nbytes = _folder_bytes(config["DOWNLOAD_FOLDER_ICON"], ".bz2")
+        stages.append(_stage("download", time.perf_counter() - started, files, nbytes,
+                             latencies=latencies["download"]))
+
+        started = time.perf_counter()
+        extractor.extract()
+        files, nbytes = _folder_bytes(config["DOWNLOAD_FOLDER_ICON"], ".grib2")
+        stages.append(_stage("extract", time.perf_counter() - started, files, nbytes,
+                             latencies=[stat["seconds"] for stat in getattr(extractor, "stats", [])]))
+
+        started = time.perf_counter()
+        transformer.transform_data()
+        rows = _step_rows(config["TMP_FOLDER"])
+        files, nbytes = _folder_bytes(config["TMP_FOLDER"], ".arrow")
+        stages.append(_stage("transform", time.perf_counter() - started, files, nbytes, rows,
+                             latencies=latencies["transform"]))
+
+        started = time.perf_counter()
+        uploader.upload_data()
+        copied = getattr(uploader.engine, "copied_bytes", 0)
+        stages.append(_stage("upload", time.perf_counter() - started, files, copied, rows,
+                             latencies=latencies["upload"]))
+
+    return {"generated_mb": round(generated_bytes / 1e6, 2), "stages": stages}
+
+
+def run_icon_process(area: str, steps: int, workdir: str, mode: str = "batch") -> dict:
+    from weather.weather_factories import FactoryWeatherICONPolandForecast
+    from weather.weather_interfaces import HandlerIconEuWeather
+
+    served, generated_bytes = _serve_icon(area, steps, workdir)
+
+    class BenchmarkHandler(HandlerIconEuWeather):
+        def get_uploader(self, **kwargs):
+            uploader = super().get_uploader(**kwargs)
+            _attach_database(uploader)
+            return uploader
+
+    with LocalServer(served) as server:
+        class BenchmarkArea(FactoryWeatherICONPolandForecast):
+            handler = BenchmarkHandler()
+
+            def get_config(self) -> dict:
+                return {**icon_config(area, steps, server.url, workdir), "PIPELINE_MODE": mode}
+
+        weather_area = BenchmarkArea()
+        started = time.perf_counter()
+        weather_area.process()
+        seconds = time.perf_counter() - started
+
+    rows = _step_rows(weather_area.config["TMP_FOLDER"])
+    files = len(FactoryWeatherICONPolandForecast().config["FORECAST_HOURS"][:steps]) * len(ICON_PARAMETERS)
+    return {"generated_mb": round(generated_bytes / 1e6, 2), "mode": mode,
+            "stages": [_stage("process", seconds, files, generated_bytes, rows)]}
+
+
+def run_ow(points: int, workdir: str) -> dict:
+    from pass_utils import make_parallel
+    from weather.weather_extractor import responses_to_frame
+    from weather.weather_uploader import OpenWeatherApiUploader
+    from weather.weather_interfaces import HandlerOWREGIONWeather
+    import shapely
+
+    rng = np.random.default_rng(0)
+    centroids = list(zip(range(points), shapely.points(rng.uniform(14.07, 24.15, points),
+                                                       rng.uniform(49.0, 54.84, points))))
+    stages = []
+    with LocalServer(workdir) as server:
+        config = {
+            "TMP_DF": [],
+            "URL_ELEM": "weather",
+            "OW_BASE_URL": f"{server.url}/data/2.5",
+            "API_KEYS": [f"benchmark-key-{number}" for number in range(4)],
+            "API_KEY_RATE_LIMITS": {"per_minute": None},
+            "UPLOAD_BACKEND": "copy",
+        }
+        handler = HandlerOWREGIONWeather()
+        downloader = handler.get_downloader(config=config)
+
+        latencies = []
+        started = time.perf_counter()
+        responses = make_parallel(_timed(downloader.get_single_coords, latencies), centroids,
+                                  url_elem=config["URL_ELEM"])
+        stages.append(_stage("download", time.perf_counter() - started, points,
+                             sum(len(json.dumps(response[1])) for response in responses), latencies=latencies))
+
+    started = time.perf_counter()
+    config["TMP_DF"] = responses_to_frame(responses)
+    stages.append(_stage("extract", time.perf_counter() - started, rows=len(config["TMP_DF"])))
+
+    uploader = OpenWeatherApiUploader(config)
+    _attach_database(uploader)
+    started = time.perf_counter()
+    uploader.upload_data()
+    stages.append(_stage("upload", time.perf_counter() - started, nbytes=getattr(uploader.db_connection,
+                                                                              "copied_bytes", 0),
+                         rows=len(config["TMP_DF"])))
+    return {"points": points, "stages": stages}
+
+
+def run_scenario(scenario: str, area: str, steps: int, points: int, mode: str) -> dict:
+    with tempfile.TemporaryDirectory(prefix="weather_bench_") as workdir:
+        if scenario == "icon-stages":
+            result = run_icon_stages(area, steps, workdir)
+        elif scenario == "icon-process":
+            result = run_icon_process(area, steps, workdir, mode)
+        else:
+            result = run_ow(points, workdir)
+    return {"scenario": scenario, "area": area if scenario != "ow" else None, **result,
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def _database_environment() -> dict:
+    environment = dict(os.environ)
+    if environment.get("BENCH_TARGET", "standin") != "postgis":  # stand-in: silnik bez połączenia z bazą
+        for name, value in (("DB_NAME", "benchmark"), ("DB_USER", "benchmark"), ("DB_PASSWORD", "benchmark"),
+                            ("DB_HOST", "127.0.0.1"), ("DB_PORT", "5432")):
+            environment.setdefault(name, value)
+    return environment
+
+
+def run_all(areas: list, scenarios: list, steps: int, points: int, mode: str) -> dict:
+    """Runs every scenario in a fresh interpreter and collects the JSON each one prints last."""
+    runs = []
+    for scenario in scenarios:
+        for area in (areas if scenario != "ow" else [None]):
+            command = [sys.executable, "-m", "weather.weather_benchmark", "--run", scenario,
+                       "--steps", str(steps), "--points", str(points), "--mode", mode]
+            if area:
+                command += ["--areas", area]
+            completed = subprocess.run(command, capture_output=True, text=True, env=_database_environment(),
+                                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            if completed.returncode != 0:
+                runs.append({"scenario": scenario, "area": area, "error": completed.stderr.strip()[-2000:]})
+                continue
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+            print(f"{scenario} {area or ''}: " + ", ".join(
+                f"{stage['stage']} {stage['seconds']} s" for stage in runs[-1]["stages"]), file=sys.stderr)
+    return {"meta": _meta(steps, points, mode), "runs": runs}
+
+
+def _meta(steps: int, points: int, mode: str) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "target": os.getenv("BENCH_TARGET", "standin"),
+        "steps": steps,
+        "points": points,
+        "mode": mode,
+        "tile_budget_mb": os.getenv("BENCH_TILE_MEMORY_BUDGET_MB"),
+    }
+
+
+def startup_profile(module: str = "weather.weather_cli", repeat: int = 3) -> dict:
+    """Import time of `module` in a fresh interpreter (best of `repeat`, from -X importtime), its slowest
+    imports and the HEAVY_MODULES it pulled in."""
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                   capture_output=True, text=True, check=True,
+                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        imports = []
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            _, cumulative, name = line.split("|")
+            imports.append((int(cumulative), name.strip()))
+        total = next(cumulative for cumulative, name in imports if name == module)
+        if best is None or total < best[0]:
+            best = (total, imports)
+
+    total, imports = best
+    loaded = {name.split(".")[0] for _, name in imports}
+    return {
+        "module": module,
+        "import_ms": round(total / 1000, 1),
+        "heavy_modules": [name for name in HEAVY_MODULES if name in loaded],
+        "slowest": [{"module": name, "ms": round(cumulative / 1000, 1)}
+                    for cumulative, name in sorted(imports, reverse=True) if name != module][:10],
+    }
+
+
+def compare(old: dict, new: dict) -> list:
+    """Relative change of stage seconds between two result files (positive = slower)."""
+    def index(results):
+        return {(run["scenario"], run.get("area"), stage["stage"]): stage["seconds"]
+                for run in results["runs"] for stage in run.get("stages", [])}
+
+    before, after = index(old), index(new)
+    return [
+        {"scenario": key[0], "area": key[1], "stage": key[2], "before_s": before[key], "after_s": after[key],
+         "change": round(after[key] / before[key] - 1, 3) if before[key] else None}
+        for key in before if key in after
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--areas", nargs="+", default=["POLAND", "GERMANY", "EUROPE"])
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--steps", type=int, default=4, help="liczba kroków prognozy (4 pliki na krok)")
+    parser.add_argument("--points", type=int, default=2000, help="liczba punktów OpenWeather")
+    parser.add_argument("--mode", default="batch", choices=["batch", "streaming"], help="PIPELINE_MODE dla process")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--startup", nargs="?", const="weather.weather_cli", metavar="MODULE",
+                        help="czas importu modułu zamiast scenariuszy")
+    parser.add_argument("--startup-budget-ms", type=float, help="kod wyjścia 1 przy przekroczeniu lub ciężkich importach")
+    parser.add_argument("--tile-budget-mb", type=float, help="TILE_MEMORY_BUDGET_MB scenariuszy ICON")
+    parser.add_argument("--run", choices=SCENARIOS, help=argparse.SUPPRESS)  # jeden scenariusz w tym procesie
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            print(json.dumps(compare(json.load(old), json.load(new)), indent=2))
+        return
+
+    if args.startup:
+        profile = startup_profile(args.startup)
+        print(json.dumps(profile, indent=2))
+        if args.startup_budget_ms is not None and (
+                profile["import_ms"] > args.startup_budget_ms or profile["heavy_modules"]):
+            print(f"Budżet startu przekroczony: {profile['import_ms']} ms (limit {args.startup_budget_ms} ms), "
+                  f"ciężkie moduły: {profile['heavy_modules']}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    if args.tile_budget_mb:  # scenariusze w osobnych procesach dziedziczą środowisko
+        os.environ["BENCH_TILE_MEMORY_BUDGET_MB"] = str(args.tile_budget_mb)
+
+    if args.run:
+        print(json.dumps(run_scenario(args.run, args.areas[0], args.steps, args.points, args.mode)))
+        return
+
+    results = run_all(args.areas, args.scenarios, args.steps, args.points, args.mode)
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Wyniki zapisane do {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
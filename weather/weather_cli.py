@@ -1,6 +1,3 @@
-import sqlalchemy
-
-from sqlalchemy import text
 from weather.weather_factories import FactoryWeatherICONPolandToday, FactoryWeatherICONPolandForecast, \
     FactoryWeatherOWSUBREGIONToday
 
@@ -15,6 +12,14 @@ def handle_icon_weather_forecast() -> None:
     weather_current.process()
 
 
+def handle_icon_forecast_runs(run_hours: tuple = ("00", "06", "12", "18")) -> None:
+    """Dispatches the ICON forecast runs to the Celery workers instead of running them here."""
+    from weather.weather_tasks import start_run  # celery tylko tam, gdzie zlecamy zadania
+
+    for run_hour in run_hours:
+        start_run.delay("FactoryWeatherICONPolandForecast", run_hour=run_hour)
+
+
 def handle_ow_weather_today() -> None:
     weather_current = FactoryWeatherOWSUBREGIONToday()
     weather_current.process()
@@ -0,0 +1,252 @@
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from pass_logging import logger
+from weather.weather_grid import get_crop_index
+from weather.weather_manifest import parse_icon_filename
+
+DIMENSIONS: tuple = ("variable", "level", "step", "latitude", "longitude")
+
+
+class ForecastCube:
+    """One decoded ICON run as a float32 array (variable, level, step, latitude, longitude).
+
+    Variables are the ICON file suffixes (T_2M, TOT_PREC, ...); single-level variables use level 0 and
+    missing combinations are NaN. `data` may be a read-only memory map shared by several consumers.
+    """
+
+    def __init__(self, data: np.ndarray, variables: list, levels: list, steps: list, latitude: np.ndarray,
+                 longitude: np.ndarray, run_on: datetime, grid: dict | None = None, parameter_names: dict | None = None):
+        self.data = data
+        self.variables = list(variables)
+        self.levels = [int(level) for level in levels]
+        self.steps = [int(step) for step in steps]
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.run_on = run_on
+        self.grid = grid or {}  # Ni, row_offset, col_offset: cell_id w pełnej siatce
+        self.parameter_names = parameter_names or {}
+
+    @property
+    def shape(self) -> tuple:
+        return self.data.shape
+
+    @property
+    def valid_times(self) -> list:
+        return [self.run_on + timedelta(hours=step) for step in self.steps]
+
+    def __repr__(self):
+        sizes = ", ".join(f"{name}: {size}" for name, size in zip(DIMENSIONS, self.shape))
+        return f"ForecastCube({self.run_on:%Y%m%d%H}, {sizes})"
+
+    def sel(self, variable=None, level=None, step=None, time=None, bbox: dict | None = None) -> "ForecastCube":
+        """Subset by labels; single labels and bbox give views of `data`, lists give copies.
+
+        `time` selects steps by valid time (a datetime or a list of them); `bbox` uses the Area bounds keys.
+        """
+        if time is not None:
+            times = self.valid_times
+            step = [self.steps[times.index(value)] for value in time] if isinstance(time, list) \
+                else self.steps[times.index(time)]
+
+        variables, variable_index = _select(self.variables, variable)
+        levels, level_index = _select(self.levels, level)
+        steps, step_index = _select(self.steps, step)
+        rows, cols = slice(None), slice(None)
+        if bbox is not None:
+            rows = _axis_slice(self.latitude, bbox["lat_min"], bbox["lat_max"])
+            cols = _axis_slice(self.longitude, bbox["lon_min"], bbox["lon_max"])
+
+        data = self.data
+        for axis, index in enumerate((variable_index, level_index, step_index)):
+            if isinstance(index, list):  # listy kopiują, więc po jednej osi naraz
+                data = np.take(data, index, axis=axis)
+            else:
+                data = data[(slice(None),) * axis + (index,)]
+        data = data[..., rows, cols]
+
+        grid = dict(self.grid)
+        if bbox is not None and grid:
+            grid["row_offset"] = grid.get("row_offset", 0) + (rows.start or 0)
+            grid["col_offset"] = grid.get("col_offset", 0) + (cols.start or 0)
+        return ForecastCube(data, variables, levels, steps, self.latitude[rows], self.longitude[cols], self.run_on,
+                            grid, {name: self.parameter_names[name] for name in variables if name in self.parameter_names})
+
+    def field(self, variable: str, step: int, level: int | None = None) -> np.ndarray:
+        """2-D (latitude, longitude) view of one variable at one step; by default its first level with data."""
+        v, s = self.variables.index(variable), self.steps.index(int(step))
+        if level is not None:
+            return self.data[v, self.levels.index(int(level)), s]
+        return self.data[v, self._data_level(v, s), s]
+
+    def _data_level(self, v: int, s: int) -> int:
+        for position in range(len(self.levels)):
+            if not np.isnan(self.data[v, position, s]).all():
+                return position
+        return 0
+
+    def cell_ids(self, rows: slice = slice(None)) -> np.ndarray:
+        rows = self.grid.get("row_offset", 0) + np.arange(self.latitude.size)[rows]
+        cols = self.grid.get("col_offset", 0) + np.arange(self.longitude.size)
+        return (rows[:, None] * self.grid.get("Ni", self.longitude.size) + cols[None, :]).ravel().astype(np.int32)
+
+    def to_frame(self, step: int) -> pd.DataFrame:
+        """Wide frame of one step with the columns IconEuTransformer writes (cell_id, latitude, longitude,
+        one column per GRIB parameter name, update_on), rows ordered by latitude, longitude."""
+        return next(self.to_frames(step))
+
+    def to_frames(self, step: int, max_points: int | None = None):
+        """to_frame in blocks of whole latitude rows, at most `max_points` points each (at least one row);
+        only the block being built is read from the memory map."""
+        s = self.steps.index(int(step))
+        levels = [self._data_level(v, s) for v in range(len(self.variables))]
+        width = max(self.longitude.size, 1)
+        rows = max(1, (max_points or self.latitude.size * width) // width)
+
+        for start in range(0, max(self.latitude.size, 1), rows):
+            block = slice(start, start + rows)
+            latitude, longitude = np.meshgrid(self.latitude[block], self.longitude, indexing="ij")
+            columns = {"cell_id": self.cell_ids(block), "latitude": latitude.ravel(), "longitude": longitude.ravel()}
+            for v, variable in enumerate(self.variables):
+                columns[self.parameter_names.get(variable, variable)] = \
+                    np.asarray(self.data[v, levels[v], s, block]).ravel()
+            columns["update_on"] = np.full(latitude.size, np.datetime64(self.run_on + timedelta(hours=int(step)), "ns"))
+
+            order = np.lexsort((columns["longitude"], columns["latitude"]))
+            yield pd.DataFrame({name: column[order] for name, column in columns.items()})
+
+    def metadata(self) -> dict:
+        return {
+            "dimensions": DIMENSIONS,
+            "variables": self.variables,
+            "levels": self.levels,
+            "steps": self.steps,
+            "latitude": self.latitude.tolist(),
+            "longitude": self.longitude.tolist(),
+            "run_on": self.run_on.isoformat(),
+            "grid": self.grid,
+            "parameter_names": self.parameter_names,
+        }
+
+    def save(self, folder: str) -> None:
+        """Writes data.npy and meta.json; replaced as a whole, readers of the previous cube keep their map."""
+        tmp_folder = f"{folder.rstrip(os.sep)}.{os.getpid()}.tmp"
+        os.makedirs(tmp_folder, exist_ok=True)
+        target = np.lib.format.open_memmap(os.path.join(tmp_folder, "data.npy"), mode="w+",
+                                           dtype=np.float32, shape=self.shape)
+        target[...] = self.data
+        target.flush()
+        del target
+        _write_metadata(tmp_folder, self.metadata())
+        _replace_folder(tmp_folder, folder)
+
+    @classmethod
+    def load(cls, folder: str, mmap_mode: str | None = "r") -> "ForecastCube":
+        with open(os.path.join(folder, "meta.json")) as file:
+            meta = json.load(file)
+        data = np.load(os.path.join(folder, "data.npy"), mmap_mode=mmap_mode)
+        return cls(data, meta["variables"], meta["levels"], meta["steps"], np.asarray(meta["latitude"]),
+                   np.asarray(meta["longitude"]), datetime.fromisoformat(meta["run_on"]), meta["grid"],
+                   meta["parameter_names"])
+
+    @classmethod
+    def from_grib_files(cls, file_paths: list, bounds, cache_folder: str | None = None,
+                        folder: str | None = None) -> "ForecastCube":
+        """Decodes the GRIB2 files of one run straight into the cube; with `folder` the cube is built in a
+        memory-mapped file there and returned as a read-only map."""
+        parsed = [(path, parse_icon_filename(path)) for path in file_paths]
+        parsed = [(path, names) for path, names in parsed if names]
+        if not parsed:
+            raise ValueError("Brak plików ICON do zbudowania kostki")
+
+        variables = sorted({names["variable"] for _, names in parsed})
+        levels = sorted({int(names["level"] or 0) for _, names in parsed})
+        steps = sorted({int(names["step"]) for _, names in parsed})
+        run_on = datetime.strptime(parsed[0][1]["run_date"] + parsed[0][1]["run_hour"], "%Y%m%d%H")
+
+        import pygrib
+
+        cube, tmp_folder = None, None
+        for path, names in parsed:
+            with pygrib.open(path) as grbs:
+                for grb in grbs:
+                    crop = get_crop_index(grb, bounds, cache_folder)
+                    if not crop.is_rectangular:
+                        raise ValueError("ForecastCube wymaga regularnej siatki (prostokątnego wycinka)")
+                    ny, nx = crop.rows.stop - crop.rows.start, crop.cols.stop - crop.cols.start
+
+                    if cube is None:
+                        shape = (len(variables), len(levels), len(steps), ny, nx)
+                        if folder:
+                            tmp_folder = f"{folder.rstrip(os.sep)}.{os.getpid()}.tmp"
+                            os.makedirs(tmp_folder, exist_ok=True)
+                            data = np.lib.format.open_memmap(os.path.join(tmp_folder, "data.npy"), mode="w+",
+                                                             dtype=np.float32, shape=shape)
+                            data[...] = np.nan
+                        else:
+                            data = np.full(shape, np.nan, dtype=np.float32)
+                        grid = {"Ni": int(crop.shape[1]), "row_offset": crop.rows.start,
+                                "col_offset": crop.cols.start}
+                        cube = cls(data, variables, levels, steps, crop.latitude[::nx], crop.longitude[:nx],
+                                   run_on, grid, {})
+
+                    values = np.ma.filled(np.ma.asarray(grb.values, dtype=np.float32), np.nan)
+                    cube.data[variables.index(names["variable"]), levels.index(int(names["level"] or 0)),
+                              steps.index(int(names["step"]))] = crop.apply(values).reshape(ny, nx)
+                    cube.parameter_names.setdefault(names["variable"], grb.parameterName)
+
+        if folder:
+            cube.data.flush()
+            del cube.data
+            _write_metadata(tmp_folder, cube.metadata())
+            _replace_folder(tmp_folder, folder)
+            logger.info(f"Zapisano kostkę prognozy: {folder}")
+            return cls.load(folder)
+        return cube
+
+
+def _select(labels: list, wanted) -> tuple:
+    """Labels and index of a selection: None = all, a label = that one (axis kept), a list = those."""
+    if wanted is None:
+        return labels, slice(None)
+    if isinstance(wanted, slice):
+        positions = range(len(labels))[wanted]
+        return [labels[position] for position in positions], slice(positions.start, positions.stop, positions.step)
+    if isinstance(wanted, (list, tuple)):
+        positions = [labels.index(_label(labels, value)) for value in wanted]
+        return [labels[position] for position in positions], positions
+    position = labels.index(_label(labels, wanted))
+    return [labels[position]], slice(position, position + 1)
+
+
+def _label(labels: list, value):
+    return int(value) if labels and isinstance(labels[0], int) else value
+
+
+def _axis_slice(axis: np.ndarray, low: float, high: float) -> slice:
+    if axis.size > 1 and axis[0] > axis[-1]:  # oś malejąca
+        start = axis.size - np.searchsorted(axis[::-1], high, side="right")
+        stop = axis.size - np.searchsorted(axis[::-1], low, side="left")
+    else:
+        start, stop = np.searchsorted(axis, low, side="left"), np.searchsorted(axis, high, side="right")
+    return slice(int(start), int(stop))
+
+
+def _write_metadata(folder: str, meta: dict) -> None:
+    with open(os.path.join(folder, "meta.json"), "w") as file:
+        json.dump(meta, file)
+
+
+def _replace_folder(tmp_folder: str, folder: str) -> None:
+    if os.path.exists(folder):
+        old_folder = f"{folder.rstrip(os.sep)}.{os.getpid()}.old"
+        os.replace(folder, old_folder)
+        os.replace(tmp_folder, folder)
+        shutil.rmtree(old_folder, ignore_errors=True)  # otwarte mapy starej kostki działają do zamknięcia
+    else:
+        os.replace(tmp_folder, folder)
@@ -1,48 +1,18 @@
+import bz2
+import json
 import os
+import time
 
 import requests
 from abc import ABC, abstractmethod
-from dotenv import load_dotenv
 from datetime import datetime
 
+from pass_config import db_engine, weather_api_keys
 from pass_logging import logger
-from pass_utils import make_parallel, RandomKeyPicker, get_centroids, connect_to_db
-
-load_dotenv('../.env')
-
-db_name: str = os.getenv('DB_NAME')
-db_user: str = os.getenv('DB_USER')
-db_password: str = os.getenv('DB_PASSWORD')
-db_port: str = os.getenv('DB_PORT')
-db_host: str = os.getenv('DB_HOST')
-WEATHER_API_KEY_1: str = os.getenv('WEATHER_API_KEY_1')
-WEATHER_API_KEY_2: str = os.getenv('WEATHER_API_KEY_2')
-WEATHER_API_KEY_3: str = os.getenv('WEATHER_API_KEY_3')
-WEATHER_API_KEY_4: str = os.getenv('WEATHER_API_KEY_4')
-WEATHER_API_KEY_5: str = os.getenv('WEATHER_API_KEY_5')
-WEATHER_API_KEY_6: str = os.getenv('WEATHER_API_KEY_6')
-WEATHER_API_KEY_7: str = os.getenv('WEATHER_API_KEY_7')
-WEATHER_API_KEY_8: str = os.getenv('WEATHER_API_KEY_8')
-WEATHER_API_KEY_9: str = os.getenv('WEATHER_API_KEY_9')
-WEATHER_API_KEY_10: str = os.getenv('WEATHER_API_KEY_10')
-WEATHER_API_KEY_11: str = os.getenv('WEATHER_API_KEY_11')
-WEATHER_API_KEY_12: str = os.getenv('WEATHER_API_KEY_12')
-
-WEATHER_API_KEYS: list = [
-    # WEATHER_API_KEY_1,
-    WEATHER_API_KEY_2,
-    WEATHER_API_KEY_3,
-    WEATHER_API_KEY_4,
-    WEATHER_API_KEY_5,
-    WEATHER_API_KEY_6,
-    WEATHER_API_KEY_7,
-    WEATHER_API_KEY_8,
-    WEATHER_API_KEY_9,
-    WEATHER_API_KEY_10,
-    WEATHER_API_KEY_11,
-    WEATHER_API_KEY_12,
-]
-
+from pass_metrics import instrumented, metrics
+from pass_utils import make_parallel, ApiKeyScheduler, get_centroids, create_http_session
+from weather.weather_areas import decode_bounds
+from weather.weather_manifest import RunManifest
 
 class Downloader(ABC):
     @abstractmethod
@@ -52,32 +22,58 @@ class Downloader(ABC):
 
 
 class OpenWeatherApiDownloader(Downloader):
-    db_connection = connect_to_db(db_name, db_user, db_password, db_port, db_host)
 
     def __init__(self, config):
-        self.picker = RandomKeyPicker(config["API_KEYS"])
+        self.config = config
+        self.db_connection = db_engine()
+        self.picker = ApiKeyScheduler(config["API_KEYS"], **config.get("API_KEY_RATE_LIMITS", {}))
         self.url_elem: str = config["URL_ELEM"]
+        self.base_url: str = config.get("OW_BASE_URL", "https://api.openweathermap.org/data/2.5")
         self.tmp_df = config["TMP_DF"]
+        self.centroids_limit: int | None = config.get("CENTROIDS_LIMIT")
+        self.session = create_http_session(pool_size=os.cpu_count() * 2, status_forcelist=(500, 502, 503, 504))
 
     def get_data(self):
-        self.tmp_df.extend(
-            make_parallel(
-                func=self.get_single_coords,
-                items=[(row.id, row.geom) for index, row in get_centroids(self.db_connection).head(2).iterrows()],
-                # TODO UNLOCK FOR EVERY ITEM
-                url_elem=self.url_elem
-            )
+        centroids = get_centroids(
+            self.db_connection,
+            aoi_ids=self.config.get("AOI_IDS", (12, 4)),
+            cache_folder=self.config.get("CENTROIDS_CACHE_FOLDER"),
+            cache_ttl=self.config.get("CENTROIDS_CACHE_TTL", 24 * 3600),
         )
+        if self.centroids_limit is not None:
+            centroids = centroids.head(self.centroids_limit)
 
+        responses = make_parallel(
+            func=self.get_single_coords,
+            items=list(zip(centroids["id"], centroids.geometry)),
+            url_elem=self.url_elem
+        )
+        received = [response for response in responses if response is not None]
+        if len(received) < len(responses):
+            logger.warning(f"Pominięto punkty bez danych: {len(responses) - len(received)} z {len(responses)}")
+        self.tmp_df.extend(received)
+        self.config["API_KEY_USAGE"] = self.picker.usage()
+        logger.info(f"Użycie kluczy API: {self.config['API_KEY_USAGE']}")
+
+    @instrumented("download", "openweather")
     def get_single_coords(self, id_geom, url_elem):
         id_pt, geom = id_geom
-        url: str = f'https://api.openweathermap.org/data/2.5/{url_elem}?lat={geom.y}&lon={geom.x}&appid={self.picker.pick_random_key()}&units=metric'
 
         try:
-            # logger.info(f"...requesting data {url}")
-            return [id_pt, requests.get(url).json()]
-        except requests.exceptions.RequestException as e:
-            raise SystemExit(e)
+            for _ in range(len(self.picker.keys)):
+                key = self.picker.acquire()
+                url: str = f'{self.base_url}/{url_elem}?lat={geom.y}&lon={geom.x}&appid={key}&units=metric'
+                # logger.info(f"...requesting data {url}")
+                response = self.session.get(url, timeout=(10, 30))
+                if response.status_code not in (401, 429):
+                    return [id_pt, response.json()]
+                self.picker.report(key, response.status_code, response.headers.get("Retry-After"))
+                metrics.inc("retries_total", stage="download", reason=response.status_code)
+            logger.warning(f"Wszystkie klucze API odrzucone dla punktu {id_pt} ({response.status_code}), pomijam")
+        except (requests.exceptions.RequestException, ValueError) as e:  # ValueError: odpowiedź nie jest JSON
+            logger.warning(f"Nie można pobrać danych dla punktu {id_pt}: {e}")
+        metrics.inc("items_failed_total", stage="download")
+        return None
 
 
 class IconEuApiDownloader(Downloader):
@@ -96,17 +92,16 @@ class IconEuApiDownloader(Downloader):
         self.FORECAST_HOURS = config["FORECAST_HOURS"]
         self.BASE_URL = config["BASE_URL"]
         self.DOWNLOAD_FOLDER_ICON = config["DOWNLOAD_FOLDER_ICON"]
+        self.workers: int = config.get("DOWNLOAD_WORKERS", os.cpu_count() * 2)
+        self.timeout: tuple = config.get("HTTP_TIMEOUT", (10, 60))  # (connect, read) w sekundach
+        self.retries: int = config.get("HTTP_RETRIES", 5)
+        self.backoff: float = config.get("HTTP_BACKOFF", 0.5)
+        self.session = create_http_session(pool_size=self.workers, retries=self.retries, backoff_factor=self.backoff)
+        self.manifest = RunManifest.from_config(config)
 
     def get_data(self) -> list:
 
-        links: list = self.generate_icon_links(
-            date=self.DATE,
-            hour=self.FORECAST_HOUR,
-            levels_t_so=self.LEVELS_T_SO,
-            levels_w_so=self.LEVELS_W_SO,
-            forecast_hours=self.FORECAST_HOURS,
-            base_url=self.BASE_URL,
-        )
+        links: list = self.get_links()
 
         os.makedirs(self.DOWNLOAD_FOLDER_ICON, exist_ok=True)
 
@@ -114,31 +109,143 @@ class IconEuApiDownloader(Downloader):
         make_parallel(
             func=self.get_single_file,  # Uses method from provided code
             items=links,
+            workers=self.workers,
         )
         logger.info("Downloading completed!")
 
-    def get_single_file(self, url):
-        try:
-            filename = url.split("/")[-1]
-            file_path = os.path.join(self.DOWNLOAD_FOLDER_ICON, filename)
+    def get_links(self) -> list:
+        return self.generate_icon_links(
+            date=self.DATE,
+            hour=self.FORECAST_HOUR,
+            levels_t_so=self.LEVELS_T_SO,
+            levels_w_so=self.LEVELS_W_SO,
+            forecast_hours=self.FORECAST_HOURS,
+            base_url=self.BASE_URL,
+        )
 
-            os.makedirs(self.DOWNLOAD_FOLDER_ICON, exist_ok=True)
+    @instrumented("download")
+    def get_single_file(self, url) -> str | None:
+        filename = url.split("/")[-1]
+        file_path = os.path.join(self.DOWNLOAD_FOLDER_ICON, filename)
 
-            if os.path.exists(file_path):
-                logger.info(f"Plik już istnieje, pomijam pobieranie: {filename}")
-                return
+        os.makedirs(self.DOWNLOAD_FOLDER_ICON, exist_ok=True)
 
-            response = requests.get(url, stream=True)
-            response.raise_for_status()  # Wyjątek w razie błędu HTTP
+        if self.manifest.is_done("download", file_path):
+            logger.info(f"Plik już pobrany w tym przebiegu, pomijam: {filename}")
+            metrics.inc("items_skipped_total", stage="download")
+            return file_path
 
-            with open(file_path, "wb") as file:
-                for chunk in response.iter_content(chunk_size=8192):
+        try:
+            if os.path.exists(file_path) and self.is_up_to_date(url, file_path):
+                logger.info(f"Plik już istnieje, pomijam pobieranie: {filename}")
+                metrics.inc("items_skipped_total", stage="download")
+                self.manifest.record("download", file_path)
+                return file_path
+        except requests.RequestException as e:
+            logger.info(f"Nie można sprawdzić pliku {url}, pobieram ponownie: {e}")
+
+        for attempt in range(self.retries + 1):
+            try:
+                self.fetch(url, file_path)
+                metrics.inc("files_total", stage="download")
+                self.manifest.record("download", file_path)
+                logger.info(f"Pobrano: {filename}")
+                return file_path
+
+            except (requests.ConnectionError, requests.Timeout) as e:  # także przerwany strumień
+                if attempt == self.retries:
+                    logger.info(f"Nie można pobrać pliku z {url} po {attempt + 1} próbach: {e}")
+                    metrics.inc("items_failed_total", stage="download")
+                    return None
+                metrics.inc("retries_total", stage="download", reason="connection")
+                time.sleep(self.backoff * 2 ** attempt)
+
+            except requests.RequestException as e:
+                logger.info(f"Nie można pobrać pliku z {url}: {e}")
+                metrics.inc("items_failed_total", stage="download")
+                return None
+
+    def fetch(self, url: str, file_path: str) -> None:
+        """Downloads to `<file>.part`, resuming with a Range request, and renames it into place when complete."""
+        part_path = f"{file_path}.part"
+        meta = self.read_meta(file_path)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+        headers = {}
+        if offset and (meta.get("etag") or meta.get("last_modified")):
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = meta.get("etag") or meta["last_modified"]  # cały plik, jeśli się zmienił
+
+        with self.session.get(url, stream=True, headers=headers, timeout=self.timeout) as response:
+            if response.status_code == 416:  # .part jest już kompletny albo nieaktualny
+                os.remove(part_path)
+                return self.fetch(url, file_path)
+            response.raise_for_status()
+
+            if response.status_code != 206:
+                self.write_meta(file_path, response.headers, size=None)
+
+            retries = getattr(response.raw, "retries", None)
+            if retries is not None and retries.history:  # ponowienia wykonane przez urllib3
+                metrics.inc("retries_total", len(retries.history), stage="download", reason="http")
+
+            with open(part_path, "ab" if response.status_code == 206 else "wb") as file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
                     file.write(chunk)
+                    metrics.inc("bytes_total", len(chunk), stage="download")
+
+        os.replace(part_path, file_path)
+        self.write_meta(file_path, response.headers, size=os.path.getsize(file_path))
+
+    def is_up_to_date(self, url: str, file_path: str) -> bool:
+        """Revalidates an existing file with ETag/Last-Modified, or by length for files without metadata."""
+        meta = self.read_meta(file_path)
+        size = os.path.getsize(file_path)
+
+        if not meta.get("size"):
+            response = self.session.head(url, timeout=self.timeout)
+            if response.status_code == 404:  # DWD usunął już plik, zostaje kopia lokalna, jeśli jest cała
+                if not is_complete_bz2(file_path):
+                    logger.warning(f"Plik {file_path} jest niekompletny, a nie ma go już na serwerze")
+                    return False
+                self.write_meta(file_path, response.headers, size=size)
+                return True
+            if not (response.ok and int(response.headers.get("Content-Length", -1)) == size):
+                return False
+            self.write_meta(file_path, response.headers, size=size)  # następne przebiegi rewalidują ETagiem
+            return True
+
+        if meta["size"] != size:
+            return False
+
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        if not headers:
+            return True
+
+        with self.session.get(url, stream=True, headers=headers, timeout=self.timeout) as response:
+            return response.status_code in (304, 404)
 
-            logger.info(f"Pobrano: {filename}")
+    @staticmethod
+    def read_meta(file_path: str) -> dict:
+        try:
+            with open(f"{file_path}.meta") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
 
-        except requests.RequestException as e:
-            logger.info(f"Nie można pobrać pliku z {url}: {e}")
+    @staticmethod
+    def write_meta(file_path: str, response_headers, size: int | None) -> None:
+        meta = {
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "size": size,
+        }
+        with open(f"{file_path}.meta", "w") as file:
+            json.dump(meta, file)
 
     @staticmethod
     def generate_icon_links(date, hour, levels_t_so, levels_w_so, forecast_hours, base_url):
@@ -164,6 +271,117 @@ class IconEuApiDownloader(Downloader):
         return links
 
 
+class IconEuStreamDownloader(IconEuApiDownloader):
+    """Downloads, decompresses and decodes ICON-EU files in memory, keeping only the cropped arrays.
+
+    Decoded fields land in config["DECODED_FIELDS"] keyed by the .grib2 file name; with PIPELINE_CACHE
+    the compressed files are also written to DOWNLOAD_FOLDER_ICON.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.area = decode_bounds(config)
+        self.cache_files: bool = config.get("PIPELINE_CACHE", False)
+        self.crop_index_folder: str = config.get(
+            "CROP_INDEX_FOLDER", os.path.join(self.DOWNLOAD_FOLDER_ICON, "crop_index")
+        )
+        self.decoded_fields: dict = config.setdefault("DECODED_FIELDS", {})
+        # pola całego przebiegu czekają w pamięci na transformację, w trybie kafelków jako float32
+        self.field_dtype: str = "float32" if config.get("TILE_MEMORY_BUDGET_MB") else "float64"
+
+    def get_data(self) -> list:
+
+        links: list = self.get_links()
+
+        if self.cache_files:
+            os.makedirs(self.DOWNLOAD_FOLDER_ICON, exist_ok=True)
+
+        logger.info(f"Downloading and decoding {len(links)} files in memory...")
+        make_parallel(func=self.get_single_stream, items=links, workers=self.workers)
+        logger.info(f"Decoding completed: {len(self.decoded_fields)} files")
+
+    def get_single_file(self, url) -> str | None:
+        return self.get_single_stream(url)
+
+    @instrumented("download", "stream")
+    def get_single_stream(self, url) -> str | None:
+        """Returns the DECODED_FIELDS key of the file, None if it could not be downloaded."""
+        import pygrib
+        from weather.weather_transformer import decode_grib_message, iter_grib_messages
+
+        filename = url.split("/")[-1]
+        cache_path = os.path.join(self.DOWNLOAD_FOLDER_ICON, filename)
+        tmp_cache_path = f"{cache_path}.{os.getpid()}.tmp"
+
+        try:
+            response = self.session.get(url, stream=True, timeout=self.timeout)
+            response.raise_for_status()
+
+            with open(tmp_cache_path, "wb") if self.cache_files else _NullWriter() as cache_file:
+                fields = [
+                    decode_grib_message(pygrib.fromstring(message), self.area, self.crop_index_folder,
+                                        dtype=self.field_dtype)
+                    for message in iter_grib_messages(self._decompress(response, cache_file))
+                ]
+
+            if self.cache_files:
+                os.replace(tmp_cache_path, cache_path)
+
+            key = os.path.splitext(filename)[0]
+            self.decoded_fields[key] = fields
+            metrics.inc("files_total", stage="download")
+            logger.info(f"Pobrano i zdekodowano: {filename}")
+            return key
+
+        except requests.RequestException as e:
+            logger.info(f"Nie można pobrać pliku z {url}: {e}")
+            metrics.inc("items_failed_total", stage="download")
+            return None
+        except (OSError, EOFError, ValueError, RuntimeError) as e:  # urwany lub uszkodzony bz2, błąd pygrib
+            logger.error(f"Nie można zdekodować pliku z {url}, pomijam: {e}")
+            metrics.inc("items_failed_total", stage="download")
+            return None
+        finally:
+            if os.path.exists(tmp_cache_path):
+                os.remove(tmp_cache_path)
+
+    @staticmethod
+    def _decompress(response, cache_file):
+        decompressor = bz2.BZ2Decompressor()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            cache_file.write(chunk)
+            metrics.inc("bytes_total", len(chunk), stage="download")
+            while chunk:
+                if decompressor.eof:  # kolejny strumień bz2 w tym samym pliku
+                    decompressor = bz2.BZ2Decompressor()
+                yield decompressor.decompress(chunk)
+                chunk = decompressor.unused_data if decompressor.eof else b""
+        if not decompressor.eof:  # połączenie zamknięte przed końcem strumienia
+            raise EOFError("Strumień bz2 urwany przed końcem")
+
+
+def is_complete_bz2(file_path: str, chunk_size: int = 1024 * 1024) -> bool:
+    """Decompresses the whole archive without keeping it; False for a truncated or corrupt file."""
+    try:
+        with bz2.open(file_path, "rb") as file:
+            while file.read(chunk_size):
+                pass
+        return True
+    except (OSError, EOFError, ValueError):
+        return False
+
+
+class _NullWriter:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def write(self, data):
+        pass
+
+
 if __name__ == "__main__":
-    downloader = OpenWeatherApiDownloader(config={"URL_ELEM": "weather", "API_KEYS": WEATHER_API_KEYS})
+    downloader = OpenWeatherApiDownloader(config={"URL_ELEM": "weather", "API_KEYS": weather_api_keys()})
     print(downloader.get_data())
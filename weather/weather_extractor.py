@@ -1,12 +1,21 @@
 import bz2
 import os
+import shutil
+import time
+from concurrent.futures import Executor
 from datetime import datetime
+from operator import itemgetter
 
+import numpy as np
 import pandas as pd
 from abc import ABC, abstractmethod
 
 from pass_logging import logger
+from pass_metrics import metrics
 from pass_utils import make_parallel
+from weather.weather_manifest import RunManifest
+
+STALE_TMP_SECONDS: int = 60 * 60  # plik .tmp bez zapisu przez godzinę należy do przerwanego procesu
 
 
 class Extractor(ABC):
@@ -16,36 +25,100 @@ class Extractor(ABC):
         ...
 
 
+OW_SCHEMA: dict = {
+    'id_geom': 'int64',
+    'temp': 'float32',
+    'temp_max': 'float32',
+    'temp_min': 'float32',
+    'feels_like': 'float32',
+    'pressure': 'float32',
+    'humidity': 'float32',
+    'clouds': 'float32',
+    'weather_id': 'Int32',
+    'weather_type': 'category',
+    'weather_desc': 'string',
+    'weather_icon': 'category',
+    'visibility': 'float32',
+    'country': 'category',
+    'city': 'string',
+    'precip_type': 'category',
+    'precip_value': 'float32',
+    'update_time': 'datetime64[ns]',
+    'speed': 'float32',
+    'deg': 'float32',
+    'gust': 'float32',
+    'lon': 'float32',
+    'lat': 'float32',
+}
+
+OW_SOURCE_COLUMNS: dict = {
+    'main': {'temp': 'temp', 'temp_max': 'temp_max', 'temp_min': 'temp_min', 'feels_like': 'feels_like',
+             'pressure': 'pressure', 'humidity': 'humidity'},
+    'clouds': {'all': 'clouds'},
+    'weather': {'id': 'weather_id', 'main': 'weather_type', 'description': 'weather_desc', 'icon': 'weather_icon'},
+    'sys': {'country': 'country'},
+    'wind': {'speed': 'speed', 'deg': 'deg', 'gust': 'gust'},
+    'coord': {'lon': 'lon', 'lat': 'lat'},
+    'rain': {'1h': 'rain'},
+    'snow': {'1h': 'snow'},
+}
+
+
 class OpenWeatherApiExtractor(Extractor):
     def __init__(self, config):
         self.config = config  # Store the config as an instance variable
         self.tmp_df = self.config['TMP_DF']
 
     def extract(self):
-        id_pt, data = self.tmp_df[0]
-
-        self.config['TMP_DF'] = pd.DataFrame([{
-            'id_geom': id_pt,
-            'temp': data['main']['temp'],
-            'temp_max': data['main']['temp_max'],
-            'temp_min': data['main']['temp_min'],
-            'feels_like': data['main']['feels_like'],
-            'pressure': data['main']['pressure'],
-            'humidity': data['main']['humidity'],
-            'clouds': data['clouds']['all'],
-            'weather_id': data['weather'][0]['id'],
-            'weather_type': data['weather'][0]['main'],
-            'weather_desc': data['weather'][0]['description'],
-            'weather_icon': data['weather'][0]['icon'],
-            'visibility': data['visibility'],
-            'country': data['sys']['country'],
-            'city': data['name'],
-            "precip_type": "rain" if 'rain' in data else ("snow" if 'snow' in data else "no"),
-            "precip_value": data['rain']['1h'] if 'rain' in data else (data['snow']['1h'] if 'snow' in data else 0),
-            "update_time": datetime.now(),
-            **data['wind'],
-            **data['coord']
-        }])
+        self.config['TMP_DF'] = responses_to_frame(self.tmp_df)
+        logger.info(f"Przetworzono odpowiedzi OpenWeather: {len(self.config['TMP_DF'])} z {len(self.tmp_df)}")
+
+
+def responses_to_frame(responses: list) -> pd.DataFrame:
+    """Turns a batch of `[id, json]` OpenWeather responses into one typed frame (schema: OW_SCHEMA).
+
+    Points without a response (None, see OpenWeatherApiDownloader.get_single_coords) are skipped.
+    """
+    responses = [response for response in responses if response is not None]
+    if not responses:
+        return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in OW_SCHEMA.items()})
+
+    ids, payloads = zip(*responses)
+    top = pd.DataFrame.from_records(list(payloads), columns=[*OW_SOURCE_COLUMNS, 'visibility', 'name'])
+    top['weather'] = top['weather'].dropna().map(itemgetter(0))  # lista warunków, pierwszy jest główny
+
+    frame = pd.concat(
+        [_expand(top[column], keys) for column, keys in OW_SOURCE_COLUMNS.items()]
+        + [top[['visibility', 'name']].rename(columns={'name': 'city'})],
+        axis=1,
+    )
+    frame['id_geom'] = np.asarray(ids)
+    frame['precip_type'] = np.select([frame['rain'].notna(), frame['snow'].notna()], ["rain", "snow"], default="no")
+    frame['precip_value'] = frame['rain'].fillna(frame['snow']).fillna(0)
+    frame['update_time'] = datetime.now()
+
+    frame = frame[frame['temp'].notna()]  # odpowiedzi z błędem (np. {"cod": 401}) nie mają danych
+    return frame[list(OW_SCHEMA)].astype(OW_SCHEMA).reset_index(drop=True)
+
+
+def _expand(column: pd.Series, keys: dict) -> pd.DataFrame:
+    """Expands a column of nested dicts into the `keys` columns; rows without the object get NaN."""
+    present = column.dropna()
+    expanded = pd.DataFrame.from_records(present.tolist(), index=present.index, columns=list(keys))
+    return expanded.reindex(column.index).rename(columns=keys)
+
+
+class PassThroughExtractor(Extractor):
+    """Used when the downloader already decompressed the data in memory."""
+
+    def __init__(self, config):
+        pass
+
+    def extract(self):
+        logger.info("Dane rozpakowane w pamięci, pomijam rozpakowywanie plików")
+
+    def extract_single_file(self, file_path: str) -> str:
+        return file_path
 
 
 class IconEuExtractor(Extractor):
@@ -53,35 +126,157 @@ class IconEuExtractor(Extractor):
 
     def __init__(self, config):
         self.output_folder: str = config["DOWNLOAD_FOLDER_ICON"]
+        self.day: str = config["DATE"]
+        self.run_hour: str = config["FORECAST_HOUR"]
+        self.backend: str = config.get("EXTRACT_BACKEND", "thread")  # "thread" | "process"
+        self.workers: int = config.get("EXTRACT_WORKERS", os.cpu_count())
+        self.chunk_size: int = config.get("EXTRACT_CHUNK_SIZE", 1024 * 1024)
+        self.manifest = RunManifest.from_config(config)
+        self.stats: list[dict] = []
 
     def extract(self):
 
-        file_paths: list[str] = [os.path.join(self.output_folder, filename)
-                                 for filename in os.listdir(self.output_folder) if filename.endswith(".bz2")]
+        remove_stale_tmp_files(self.output_folder)  # resztki przerwanego rozpakowywania
+
+        file_paths: list[str] = [
+            row["path"] for row in self.manifest.artifacts("download", self.day, self.run_hour)
+            if os.path.exists(row["path"])
+        ]
+        if not file_paths:  # pliki pobrane przed wprowadzeniem manifestu
+            file_paths = [os.path.join(self.output_folder, filename)
+                          for filename in os.listdir(self.output_folder) if filename.endswith(".bz2")]
         if not file_paths:
             logger.warning("Brak plików .bz2 w katalogu.")
             return
-        make_parallel(self.extract_single_file, items=file_paths, )
+
+        pending = [file_path for file_path in file_paths
+                   if not self.manifest.is_done("extract", self.output_path(file_path))]
+        logger.info(f"Pliki już rozpakowane: {len(file_paths) - len(pending)}, do rozpakowania: {len(pending)}")
+
+        started = time.perf_counter()
+        stats = [stat for stat in make_parallel(
+            extract_bz2_file,
+            items=pending,
+            workers=self.workers,
+            backend=self.backend,
+            output_folder=self.output_folder,
+            chunk_size=self.chunk_size,
+        ) if stat]
+        for stat in stats:
+            record_extract_stats(stat)
+            self.manifest.record("extract", stat["file"])
+        metrics.inc("items_skipped_total", len(file_paths) - len(pending), stage="extract")
+        if len(stats) < len(pending):  # błąd zalogowany w extract_bz2_file, także w procesie potomnym
+            logger.warning(f"Nie udało się rozpakować {len(pending) - len(stats)} z {len(pending)} plików")
+            metrics.inc("items_failed_total", len(pending) - len(stats), stage="extract")
+        self.stats = stats
+        log_throughput(stats, time.perf_counter() - started)
         logger.info("Rozpakowywanie zakończone!")
 
-    def extract_single_file(self, file_path: str) -> str | None:
-        """Extracts a single file and returns its decompressed path."""
+    def output_path(self, file_path: str) -> str:
+        return os.path.join(self.output_folder, os.path.splitext(os.path.basename(file_path))[0])
+
+    def extract_single_file(self, file_path: str, executor: Executor | None = None) -> str | None:
+        """Extracts a single file and returns its decompressed path.
 
-        output_file_path = os.path.join(self.output_folder, os.path.splitext(os.path.basename(file_path))[0])
+        With `executor` (the process pool of a streaming run with EXTRACT_BACKEND="process") the archive is
+        decompressed there and only its stats come back.
+        """
 
-        if os.path.exists(output_file_path):
+        output_file_path = self.output_path(file_path)
+
+        if self.manifest.is_done("extract", output_file_path):
             logger.info(f"Plik już rozpakowany: {output_file_path}")
+            metrics.inc("items_skipped_total", stage="extract")
             return output_file_path
 
+        if executor is not None:
+            stat = executor.submit(extract_bz2_file, file_path, self.output_folder, self.chunk_size).result()
+        else:
+            stat = extract_bz2_file(file_path, self.output_folder, self.chunk_size)
+        if not stat:
+            metrics.inc("items_failed_total", stage="extract")
+            return None
+        record_extract_stats(stat)
+        self.manifest.record("extract", stat["file"])
+        return stat["file"]
+
+
+def remove_stale_tmp_files(folder: str, max_age_s: float = STALE_TMP_SECONDS) -> list:
+    """Removes `*.tmp` files in `folder` not written to for `max_age_s` and returns their paths.
+
+    The folder is shared by concurrent runs (Today and Forecast), so temp files of a running extraction,
+    whatever process writes them, are left alone.
+    """
+    removed = []
+    now = time.time()
+    for filename in os.listdir(folder):
+        path = os.path.join(folder, filename)
+        if not filename.endswith(".tmp"):
+            continue
         try:
-            with bz2.BZ2File(file_path, 'rb') as compressed_file, open(output_file_path, 'wb') as decompressed_file:
-                decompressed_file.write(compressed_file.read())
-            logger.info(f"Rozpakowano: {output_file_path}")
-            return output_file_path
+            if now - os.path.getmtime(path) >= max_age_s:
+                os.remove(path)
+                removed.append(path)
+        except FileNotFoundError:  # rozpakowywanie właśnie się zakończyło
+            continue
+    if removed:
+        logger.info(f"Usunięto {len(removed)} porzuconych plików tymczasowych z {folder}")
+    return removed
 
-        except (IOError, OSError, bz2.BZ2File) as e:
-            logger.error(f"Błąd podczas rozpakowywania pliku {file_path}: {e}", exc_info=True)
-            return None
+
+def extract_bz2_file(file_path: str, output_folder: str, chunk_size: int = 1024 * 1024) -> dict | None:
+    """Streams one .bz2 archive to disk in bounded chunks and renames it into place when complete.
+
+    Module-level so it can run in a ProcessPoolExecutor; returns throughput stats for the file.
+    """
+    output_file_path = os.path.join(output_folder, os.path.splitext(os.path.basename(file_path))[0])
+    tmp_file_path = f"{output_file_path}.{os.getpid()}.tmp"
+    started = time.perf_counter()
+
+    try:
+        with bz2.open(file_path, 'rb') as compressed_file, open(tmp_file_path, 'wb') as decompressed_file:
+            shutil.copyfileobj(compressed_file, decompressed_file, chunk_size)
+            size = decompressed_file.tell()
+        os.replace(tmp_file_path, output_file_path)
+
+    except (OSError, EOFError, ValueError) as e:
+        logger.error(f"Błąd podczas rozpakowywania pliku {file_path}: {e}", exc_info=True)
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        return None
+
+    seconds = time.perf_counter() - started
+    stat = {
+        "file": output_file_path,
+        "compressed_bytes": os.path.getsize(file_path),
+        "bytes": size,
+        "seconds": seconds,
+        "mb_per_s": size / 1e6 / seconds if seconds else 0.0,
+        "pid": os.getpid(),
+    }
+    logger.info(f"Rozpakowano: {output_file_path} ({size / 1e6:.1f} MB, {stat['mb_per_s']:.1f} MB/s)")
+    return stat
+
+
+def record_extract_stats(stat: dict) -> None:
+    """Metrics of one extraction; recorded in the parent, as worker processes do not share `metrics`."""
+    metrics.observe("call_seconds", stat["seconds"], stage="extract", call="extract_bz2_file")
+    metrics.inc("files_total", stage="extract")
+    metrics.inc("bytes_total", stat["bytes"], stage="extract")
+    metrics.inc("compressed_bytes_total", stat["compressed_bytes"], stage="extract")
+
+
+def log_throughput(stats: list[dict], wall_seconds: float) -> None:
+    if not stats:
+        return
+    total_mb = sum(stat["bytes"] for stat in stats) / 1e6
+    busy_seconds = sum(stat["seconds"] for stat in stats)
+    logger.info(
+        f"Rozpakowano {len(stats)} plików, {total_mb:.1f} MB w {wall_seconds:.1f} s: "
+        f"{total_mb / wall_seconds if wall_seconds else 0.0:.1f} MB/s łącznie, "
+        f"{total_mb / busy_seconds if busy_seconds else 0.0:.1f} MB/s na rdzeń"
+    )
 
 
 if __name__ == "__main__":
@@ -1,12 +1,12 @@
-import os
 from abc import ABC, abstractmethod
 from datetime import datetime, timezone
 
-from dotenv import load_dotenv
-
 from weather import weather_interfaces
+from weather.weather_pipeline import run_streaming
+from pass_config import weather_api_keys
 from pass_logging import logger
-from weather_areas import Area
+from pass_metrics import metrics, profiling, stage_run
+from weather.weather_areas import Area
 
 
 class WeatherArea(ABC):
@@ -29,13 +29,35 @@ class WeatherArea(ABC):
         extractor = self.handler.get_extractor(config=self.config)
         transformer = self.handler.get_transformer(config=self.config)
         uploader = self.handler.get_uploader(config=self.config)
+        postprocessor = self.handler.get_postprocessor(config=self.config)
 
         logger.info(f"...starting process ")
-
-        downloader.get_data()
-        extractor.extract()
-        transformer.transform_data()
-        uploader.upload_data()
+        metrics.reset()
+        profiling.configure(self.config)
+
+        try:
+            if self.config.get("PIPELINE_MODE", "batch") == "streaming":
+                with stage_run("pipeline"):
+                    run_streaming(downloader, extractor, transformer, uploader, self.config)
+                if postprocessor:  # serie pochodne potrzebują wszystkich kroków przebiegu
+                    with stage_run("postprocess"):
+                        postprocessor.postprocess()
+                with stage_run("upload"):  # pliki pochodne i pominięte kroki, potem przebieg oznaczony jako pełny
+                    uploader.upload_data()
+            else:
+                with stage_run("download"):
+                    downloader.get_data()
+                with stage_run("extract"):
+                    extractor.extract()
+                with stage_run("transform"):
+                    transformer.transform_data()
+                if postprocessor:
+                    with stage_run("postprocess"):
+                        postprocessor.postprocess()
+                with stage_run("upload"):
+                    uploader.upload_data()
+        finally:
+            metrics.export(self.config, pipeline=type(self).__name__)
 
         logger.info(f"...process completed")
 
@@ -53,7 +75,37 @@ class FactoryWeatherICONPolandToday(WeatherArea):
             'BASE_URL': "https://opendata.dwd.de/weather/nwp/icon-eu/grib",
             'DOWNLOAD_FOLDER_ICON': "./downloaded_files",
             'TMP_FOLDER': './tmp',
-            'AREA': Area.POLAND.get_bounds()
+            'AREA': Area.POLAND.get_bounds(),
+            'AREAS': None,  # np. {"POLAND": "weather_data_v2", "GERMANY": "weather_data_v2_germany"}: jedno dekodowanie
+            'DECODE_MODE': "columnar",  # "columnar" | "records"
+            'EXTRACT_BACKEND': "process",  # "thread" | "process"
+            'IN_MEMORY_PIPELINE': False,  # pobieranie -> rozpakowanie -> dekodowanie bez plików pośrednich
+            'PIPELINE_CACHE': False,  # w trybie w pamięci zapisuj też pliki .bz2
+            # "copy": upsert po kluczu zamiast dopisywania; tabelę z duplikatami trzeba przedtem raz oczyścić
+            # (python -m weather.weather_uploader deduplicate, polecenie podaje komunikat DuplicateKeysError)
+            'UPLOAD_BACKEND': "to_postgis",  # "to_postgis" | "copy"
+            'UPLOAD_WORKERS': 4,  # kroki prognozy ładowane równolegle, każdy we własnej transakcji
+            'PARTITION_BY_DAY': False,  # nowa tabela partycjonowana zakresami update_on
+            'STORAGE_MODE': "points",  # "points" (weather_data_v2) | "cells" (grid_cells + weather_values)
+            'INTERMEDIATE_FORMAT': "arrow",  # "arrow" (Arrow IPC, zstd) | "fgb" (FlatGeobuf)
+            'CUBE_FOLDER': None,  # np. "./cubes": cały przebieg dekodowany raz do ForecastCube (mmap)
+            'TILE_MEMORY_BUDGET_MB': None,  # np. 256 dla RUSSIA/EUROPE: krok w kafelkach wierszy siatki, float32
+            'POSTPROCESS': False,  # serie pochodne całego przebiegu -> DERIVED_TABLE
+            'POSTPROCESS_ACCUMULATED': {"Total precipitation rate": "Total precipitation"},  # TOT_PREC narasta od startu
+            'POSTPROCESS_HOURLY': ["Temperature", "Soil temperature"],  # interpolacja co godzinę; [] = tylko kroki
+            'DERIVED_TABLE': "weather_data_derived",
+            'ROLLUPS': False,  # dzienne agregaty per komórka i region (<tabela>_daily...) aktualizowane przy ładowaniu
+            'ROLLUP_TEMPERATURE': "Temperature",  # min/max z kroków
+            'ROLLUP_PRECIPITATION': "Total precipitation",  # suma interwałów z DERIVED_TABLE, wymaga POSTPROCESS
+            'ROLLUP_REGIONS': "weather.wojewodztwa",  # poligony regionów (id, geom); None = tylko komórki
+            'ROLLUP_KEEP_RUNS': 8,  # przebiegi trzymane w tabelach agregatów
+            'MANIFEST_PATH': "./downloaded_files/manifest.sqlite",  # stan etapów dla ponownych uruchomień
+            'PIPELINE_MODE': "batch",  # "batch" (etap po etapie) | "streaming" (etapy nakładają się)
+            'PIPELINE_QUEUE_SIZE': 16,
+            'METRICS_TEXTFILE': "./metrics/weather_icon_today.prom",  # katalog textfile collectora node_exportera
+            'METRICS_JSON': "./metrics/weather_icon_today.json",
+            'PROFILE': "",  # "cprofile", "tracemalloc" lub oba po przecinku (albo WEATHER_PROFILE)
+            'PROFILE_SAMPLE': 1.0,  # część profilowanych wywołań
         }
 
     handler = weather_interfaces.HandlerIconEuWeather()
@@ -74,55 +126,59 @@ class FactoryWeatherICONPolandForecast(WeatherArea):
             'BASE_URL': "https://opendata.dwd.de/weather/nwp/icon-eu/grib",
             'DOWNLOAD_FOLDER_ICON': "./downloaded_files",
             'TMP_FOLDER': './tmp',
-            'AREA': Area.POLAND.get_bounds()
+            'AREA': Area.POLAND.get_bounds(),
+            'AREAS': None,  # np. {"POLAND": "weather_data_v2", "GERMANY": "weather_data_v2_germany"}: jedno dekodowanie
+            'DECODE_MODE': "columnar",  # "columnar" | "records"
+            'EXTRACT_BACKEND': "process",  # "thread" | "process"
+            'IN_MEMORY_PIPELINE': False,  # pobieranie -> rozpakowanie -> dekodowanie bez plików pośrednich
+            'PIPELINE_CACHE': False,  # w trybie w pamięci zapisuj też pliki .bz2
+            # "copy": upsert po kluczu zamiast dopisywania; tabelę z duplikatami trzeba przedtem raz oczyścić
+            # (python -m weather.weather_uploader deduplicate, polecenie podaje komunikat DuplicateKeysError)
+            'UPLOAD_BACKEND': "to_postgis",  # "to_postgis" | "copy"
+            'UPLOAD_WORKERS': 4,  # kroki prognozy ładowane równolegle, każdy we własnej transakcji
+            'PARTITION_BY_DAY': False,  # nowa tabela partycjonowana zakresami update_on
+            'STORAGE_MODE': "points",  # "points" (weather_data_v2) | "cells" (grid_cells + weather_values)
+            'INTERMEDIATE_FORMAT': "arrow",  # "arrow" (Arrow IPC, zstd) | "fgb" (FlatGeobuf)
+            'CUBE_FOLDER': None,  # np. "./cubes": cały przebieg dekodowany raz do ForecastCube (mmap)
+            'TILE_MEMORY_BUDGET_MB': None,  # np. 256 dla RUSSIA/EUROPE: krok w kafelkach wierszy siatki, float32
+            'POSTPROCESS': False,  # serie pochodne całego przebiegu -> DERIVED_TABLE
+            'POSTPROCESS_ACCUMULATED': {"Total precipitation rate": "Total precipitation"},  # TOT_PREC narasta od startu
+            'POSTPROCESS_HOURLY': ["Temperature", "Soil temperature"],  # interpolacja co godzinę; [] = tylko kroki
+            'DERIVED_TABLE': "weather_data_derived",
+            'ROLLUPS': False,  # dzienne agregaty per komórka i region (<tabela>_daily...) aktualizowane przy ładowaniu
+            'ROLLUP_TEMPERATURE': "Temperature",  # min/max z kroków
+            'ROLLUP_PRECIPITATION': "Total precipitation",  # suma interwałów z DERIVED_TABLE, wymaga POSTPROCESS
+            'ROLLUP_REGIONS': "weather.wojewodztwa",  # poligony regionów (id, geom); None = tylko komórki
+            'ROLLUP_KEEP_RUNS': 8,  # przebiegi trzymane w tabelach agregatów
+            'MANIFEST_PATH': "./downloaded_files/manifest.sqlite",  # stan etapów dla ponownych uruchomień
+            'PIPELINE_MODE': "batch",  # "batch" (etap po etapie) | "streaming" (etapy nakładają się)
+            'PIPELINE_QUEUE_SIZE': 16,
+            'METRICS_TEXTFILE': "./metrics/weather_icon_forecast.prom",  # katalog textfile collectora node_exportera
+            'METRICS_JSON': "./metrics/weather_icon_forecast.json",
+            'PROFILE': "",  # "cprofile", "tracemalloc" lub oba po przecinku (albo WEATHER_PROFILE)
+            'PROFILE_SAMPLE': 1.0,  # część profilowanych wywołań
         }
 
     handler = weather_interfaces.HandlerIconEuWeather()
 
 
-load_dotenv('../.env')
-
-db_name: str = os.getenv('DB_NAME')
-db_user: str = os.getenv('DB_USER')
-db_password: str = os.getenv('DB_PASSWORD')
-db_port: str = os.getenv('DB_PORT')
-db_host: str = os.getenv('DB_HOST')
-WEATHER_API_KEY_1: str = os.getenv('WEATHER_API_KEY_1')
-WEATHER_API_KEY_2: str = os.getenv('WEATHER_API_KEY_2')
-WEATHER_API_KEY_3: str = os.getenv('WEATHER_API_KEY_3')
-WEATHER_API_KEY_4: str = os.getenv('WEATHER_API_KEY_4')
-WEATHER_API_KEY_5: str = os.getenv('WEATHER_API_KEY_5')
-WEATHER_API_KEY_6: str = os.getenv('WEATHER_API_KEY_6')
-WEATHER_API_KEY_7: str = os.getenv('WEATHER_API_KEY_7')
-WEATHER_API_KEY_8: str = os.getenv('WEATHER_API_KEY_8')
-WEATHER_API_KEY_9: str = os.getenv('WEATHER_API_KEY_9')
-WEATHER_API_KEY_10: str = os.getenv('WEATHER_API_KEY_10')
-WEATHER_API_KEY_11: str = os.getenv('WEATHER_API_KEY_11')
-WEATHER_API_KEY_12: str = os.getenv('WEATHER_API_KEY_12')
-
-WEATHER_API_KEYS: list = [
-    # WEATHER_API_KEY_1,
-    WEATHER_API_KEY_2,
-    WEATHER_API_KEY_3,
-    WEATHER_API_KEY_4,
-    WEATHER_API_KEY_5,
-    WEATHER_API_KEY_6,
-    WEATHER_API_KEY_7,
-    WEATHER_API_KEY_8,
-    WEATHER_API_KEY_9,
-    WEATHER_API_KEY_10,
-    WEATHER_API_KEY_11,
-    WEATHER_API_KEY_12,
-]
-
-
 class FactoryWeatherOWSUBREGIONToday(WeatherArea):
 
     def get_config(self) -> dict:
         return {
             'TMP_DF': [],
             "URL_ELEM": "weather",
-            "API_KEYS": WEATHER_API_KEYS,
+            "CENTROIDS_LIMIT": 2,  # None = wszystkie centroidy siatki
+            "AOI_IDS": [12, 4],  # id województw z weather.wojewodztwa
+            "CENTROIDS_CACHE_FOLDER": "./cache",
+            "CENTROIDS_CACHE_TTL": 24 * 3600,  # w sekundach; po tym czasie sprawdzany jest odcisk tabel
+            # "copy": upsert po kluczu zamiast dopisywania; tabelę z duplikatami trzeba przedtem raz oczyścić
+            # (python -m weather.weather_uploader deduplicate, polecenie podaje komunikat DuplicateKeysError)
+            "UPLOAD_BACKEND": "to_sql",  # "to_sql" | "copy"
+            "API_KEYS": weather_api_keys(),
+            "API_KEY_RATE_LIMITS": {"per_minute": 60, "per_day": 32000},  # limity na jeden klucz
+            "METRICS_TEXTFILE": "./metrics/weather_ow.prom",
+            "METRICS_JSON": "./metrics/weather_ow.json",
             'AREA': Area.POLAND.get_bounds()
         }
 
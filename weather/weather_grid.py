@@ -0,0 +1,198 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from pass_logging import logger
+
+_CROP_CACHE: dict = {}
+_CROP_CACHE_LOCK = threading.Lock()
+
+
+class GridDefinition:
+    """Geometry of a GRIB grid, read from the message keys without decoding lat/lon fields."""
+
+    REGULAR_KEYS = (
+        "Ni", "Nj",
+        "latitudeOfFirstGridPointInDegrees", "longitudeOfFirstGridPointInDegrees",
+        "latitudeOfLastGridPointInDegrees", "longitudeOfLastGridPointInDegrees",
+        "iDirectionIncrementInDegrees", "jDirectionIncrementInDegrees",
+        "iScansNegatively", "jScansPositively",
+    )
+
+    def __init__(self, grid_type: str, params: dict):
+        self.grid_type = grid_type
+        self.params = params
+
+    @classmethod
+    def from_message(cls, grb) -> "GridDefinition":
+        grid_type = grb["gridType"]
+        if grid_type == "regular_ll":
+            return cls(grid_type, {key: grb[key] for key in cls.REGULAR_KEYS})
+        return cls(grid_type, {"numberOfDataPoints": grb["numberOfDataPoints"], "md5Section3": grb["md5Section3"]})
+
+    @property
+    def is_regular(self) -> bool:
+        return self.grid_type == "regular_ll"
+
+    @property
+    def key(self) -> str:
+        text = self.grid_type + "|" + "|".join(f"{name}={self.params[name]}" for name in sorted(self.params))
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    @property
+    def shape(self) -> tuple:
+        return self.params["Nj"], self.params["Ni"]
+
+    def latitudes(self) -> np.ndarray:
+        """Latitude of every grid row, in the row order of `grb.values`."""
+        p = self.params
+        step = abs(p["jDirectionIncrementInDegrees"])
+        if p["jScansPositively"]:
+            return min(p["latitudeOfFirstGridPointInDegrees"], p["latitudeOfLastGridPointInDegrees"]) \
+                + step * np.arange(p["Nj"])
+        return max(p["latitudeOfFirstGridPointInDegrees"], p["latitudeOfLastGridPointInDegrees"]) \
+            - step * np.arange(p["Nj"])
+
+    def longitudes(self) -> np.ndarray:
+        """Longitude of every grid column, normalised to [-180, 180)."""
+        p = self.params
+        step = abs(p["iDirectionIncrementInDegrees"]) * (-1 if p["iScansNegatively"] else 1)
+        lons = p["longitudeOfFirstGridPointInDegrees"] + step * np.arange(p["Ni"])
+        return (lons + 180.0) % 360.0 - 180.0
+
+
+class CropIndex:
+    """Precomputed crop of one grid to one area: a row/column slice, or a flat index for irregular crops."""
+
+    def __init__(self, shape: tuple, latitude: np.ndarray, longitude: np.ndarray,
+                 rows: slice | None = None, cols: slice | None = None, flat_index: np.ndarray | None = None):
+        self.shape = tuple(shape)
+        self.latitude = latitude
+        self.longitude = longitude
+        self.rows = rows
+        self.cols = cols
+        self._flat_index = flat_index
+
+    @property
+    def is_rectangular(self) -> bool:
+        return self.rows is not None
+
+    @property
+    def size(self) -> int:
+        return self.latitude.size
+
+    @property
+    def index(self) -> np.ndarray:
+        """Flat position of every cropped point in the full field."""
+        if self._flat_index is None:
+            rows = np.arange(self.rows.start, self.rows.stop)
+            cols = np.arange(self.cols.start, self.cols.stop)
+            self._flat_index = (rows[:, None] * self.shape[1] + cols[None, :]).ravel()
+        return self._flat_index
+
+    def apply(self, values: np.ndarray) -> np.ndarray:
+        """Crops a full field (2-D or flat) to a flat array of the area's points."""
+        if self.is_rectangular and values.ndim == 2:
+            return values[self.rows, self.cols].ravel()
+        return values.reshape(-1)[self.index]
+
+    def save(self, path: str) -> None:
+        arrays = {"shape": np.array(self.shape), "latitude": self.latitude, "longitude": self.longitude}
+        if self.is_rectangular:
+            arrays["bounds"] = np.array([self.rows.start, self.rows.stop, self.cols.start, self.cols.stop])
+        else:
+            arrays["flat_index"] = self.index
+
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CropIndex":
+        with np.load(path) as data:
+            if "bounds" in data:
+                r0, r1, c0, c1 = (int(value) for value in data["bounds"])
+                return cls(data["shape"], data["latitude"], data["longitude"], rows=slice(r0, r1), cols=slice(c0, c1))
+            return cls(data["shape"], data["latitude"], data["longitude"], flat_index=data["flat_index"])
+
+
+def bounds_key(bounds) -> tuple:
+    bounds = bounds.get_bounds() if hasattr(bounds, "get_bounds") else bounds
+    return tuple(float(bounds[name]) for name in ("lat_min", "lat_max", "lon_min", "lon_max"))
+
+
+def bounds_mask(latitude: np.ndarray, longitude: np.ndarray, bounds) -> np.ndarray:
+    """Points inside `bounds`, with the same edge tolerance as the crop index."""
+    lat_min, lat_max, lon_min, lon_max = bounds_key(bounds)
+    eps = 1e-9
+    return (latitude >= lat_min - eps) & (latitude <= lat_max + eps) \
+        & (longitude >= lon_min - eps) & (longitude <= lon_max + eps)
+
+
+def _contiguous(positions: np.ndarray) -> slice | None:
+    if positions.size and positions[-1] - positions[0] + 1 == positions.size:
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    return None
+
+
+def build_crop_index(grb, grid: GridDefinition, bounds) -> CropIndex:
+    lat_min, lat_max, lon_min, lon_max = bounds_key(bounds)
+    eps = 1e-9
+
+    if grid.is_regular:
+        lats, lons = grid.latitudes(), grid.longitudes()
+        row_positions = np.flatnonzero((lats >= lat_min - eps) & (lats <= lat_max + eps))
+        col_positions = np.flatnonzero((lons >= lon_min - eps) & (lons <= lon_max + eps))
+        rows, cols = _contiguous(row_positions), _contiguous(col_positions)
+        latitude = np.repeat(lats[row_positions], col_positions.size)
+        longitude = np.tile(lons[col_positions], row_positions.size)
+
+        if rows is not None and cols is not None:
+            return CropIndex(grid.shape, latitude, longitude, rows=rows, cols=cols)
+        flat_index = (row_positions[:, None] * grid.shape[1] + col_positions[None, :]).ravel()
+        return CropIndex(grid.shape, latitude, longitude, flat_index=flat_index)
+
+    all_lats, all_lons = grb.latlons()
+    mask = (all_lats >= lat_min) & (all_lats <= lat_max) & (all_lons >= lon_min) & (all_lons <= lon_max)
+    flat_index = np.flatnonzero(mask)
+    return CropIndex(all_lats.shape, all_lats.ravel()[flat_index], all_lons.ravel()[flat_index],
+                     flat_index=flat_index)
+
+
+def get_crop_index(grb, bounds, cache_folder: str | None = None) -> CropIndex:
+    """Returns the crop of the message's grid to `bounds`, cached in memory and optionally on disk."""
+    grid = GridDefinition.from_message(grb)
+    cache_key = (grid.key, bounds_key(bounds))
+
+    crop = _CROP_CACHE.get(cache_key)
+    if crop is not None:
+        return crop
+
+    with _CROP_CACHE_LOCK:
+        crop = _CROP_CACHE.get(cache_key)
+        if crop is not None:
+            return crop
+
+        path = None
+        if cache_folder:
+            name = hashlib.sha1(repr(cache_key).encode()).hexdigest()
+            path = os.path.join(cache_folder, f"crop_{name}.npz")
+
+        if path and os.path.exists(path):
+            try:
+                crop = CropIndex.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Nie można wczytać indeksu przycięcia {path}: {e}")
+
+        if crop is None:
+            crop = build_crop_index(grb, grid, bounds)
+            if path:
+                os.makedirs(cache_folder, exist_ok=True)
+                crop.save(path)
+                logger.info(f"Zapisano indeks przycięcia: {path}")
+
+        _CROP_CACHE[cache_key] = crop
+        return crop
@@ -1,55 +1,83 @@
-from abc import ABC, abstractmethod
+import importlib
+import threading
+from abc import ABC
+from typing import TYPE_CHECKING
 
-from weather import weather_downloader, weather_extractor, weather_uploader, weather_transformer
+if TYPE_CHECKING:
+    from weather import weather_downloader, weather_extractor, weather_postprocess, weather_transformer, \
+        weather_uploader
 
+_CLASSES: dict = {}
+_CLASSES_LOCK = threading.Lock()
 
-class HandlerWeatherFactory(ABC):
-    """handlerFactory gets, unpacks, uploads depending on source and target"""
 
-    @abstractmethod
-    def get_downloader(self, **kwargs) -> weather_downloader.Downloader:
-        ...
+def load_class(path: str):
+    """'package.module:Class' -> the class; the module (and its pygrib/geopandas/...) is imported on first use."""
+    with _CLASSES_LOCK:
+        if path not in _CLASSES:
+            module_name, _, class_name = path.partition(":")
+            _CLASSES[path] = getattr(importlib.import_module(module_name), class_name)
+        return _CLASSES[path]
 
-    @abstractmethod
-    def get_extractor(self, **kwargs) -> weather_extractor.Extractor:
-        ...
 
-    @abstractmethod
-    def get_transformer(self, **kwargs) -> weather_transformer.Transformer:
-        ...
+class HandlerWeatherFactory(ABC):
+    """handlerFactory gets, unpacks, uploads depending on source and target
 
-    @abstractmethod
-    def get_uploader(self, **kwargs) -> weather_uploader.Uploader:
-        ...
+    STAGES is the registry of the source's stage classes as "module:Class"; a stage missing from it is not used.
+    """
 
+    STAGES: dict = {}
 
-class HandlerIconEuWeather(HandlerWeatherFactory):
-    """Factory for handling ICON-EU weather data."""
+    def stage(self, name: str, config: dict):
+        path = self.STAGES.get(name)
+        return load_class(path)(config=config) if path else None
 
-    def get_downloader(self, **kwargs) -> weather_downloader.Downloader:
-        return weather_downloader.IconEuApiDownloader(config=kwargs["config"])
+    def get_downloader(self, **kwargs) -> "weather_downloader.Downloader":
+        return self.stage("downloader", kwargs["config"])
 
-    def get_extractor(self, **kwargs) -> weather_extractor.Extractor:
-        return weather_extractor.IconEuExtractor(config=kwargs["config"])
+    def get_extractor(self, **kwargs) -> "weather_extractor.Extractor":
+        return self.stage("extractor", kwargs["config"])
 
-    def get_transformer(self, **kwargs) -> weather_transformer.Transformer:
-        return weather_transformer.IconEuTransformer(config=kwargs["config"])
+    def get_transformer(self, **kwargs) -> "weather_transformer.Transformer":
+        return self.stage("transformer", kwargs["config"])
 
-    def get_uploader(self, **kwargs) -> weather_uploader.Uploader:
-        return weather_uploader.IconEUDBUploader(config=kwargs["config"])
+    def get_uploader(self, **kwargs) -> "weather_uploader.Uploader":
+        return self.stage("uploader", kwargs["config"])
 
+    def get_postprocessor(self, **kwargs) -> "weather_postprocess.Postprocessor | None":
+        """Optional stage between transform and upload."""
+        return self.stage("postprocessor", kwargs["config"])
 
-class HandlerOWREGIONWeather(HandlerWeatherFactory):
-    """Factory for handling ICON-EU weather data."""
 
-    def get_downloader(self, **kwargs) -> weather_downloader.Downloader:
-        return weather_downloader.OpenWeatherApiDownloader(config=kwargs["config"])
+class HandlerIconEuWeather(HandlerWeatherFactory):
+    """Factory for handling ICON-EU weather data."""
 
-    def get_extractor(self, **kwargs) -> weather_extractor.Extractor:
-        return weather_extractor.OpenWeatherApiExtractor(config=kwargs["config"])
+    STAGES = {
+        "downloader": "weather.weather_downloader:IconEuApiDownloader",
+        "extractor": "weather.weather_extractor:IconEuExtractor",
+        "transformer": "weather.weather_transformer:IconEuTransformer",
+        "uploader": "weather.weather_uploader:IconEUDBUploader",
+        "postprocessor": "weather.weather_postprocess:IconEuPostprocessor",
+    }
+    IN_MEMORY_STAGES = {
+        "downloader": "weather.weather_downloader:IconEuStreamDownloader",
+        "extractor": "weather.weather_extractor:PassThroughExtractor",
+    }
+
+    def stage(self, name: str, config: dict):
+        if name == "postprocessor" and not config.get("POSTPROCESS"):
+            return None
+        if config.get("IN_MEMORY_PIPELINE") and name in self.IN_MEMORY_STAGES:
+            return load_class(self.IN_MEMORY_STAGES[name])(config=config)
+        return super().stage(name, config)
 
-    def get_transformer(self, **kwargs) -> weather_transformer.Transformer:
-        return weather_transformer.OpenWeatherApiTransformer(config=kwargs["config"])
 
-    def get_uploader(self, **kwargs) -> weather_uploader.Uploader:
-        return weather_uploader.OpenWeatherApiUploader(config=kwargs["config"])
+class HandlerOWREGIONWeather(HandlerWeatherFactory):
+    """Factory for handling OpenWeather data."""
+
+    STAGES = {
+        "downloader": "weather.weather_downloader:OpenWeatherApiDownloader",
+        "extractor": "weather.weather_extractor:OpenWeatherApiExtractor",
+        "transformer": "weather.weather_transformer:OpenWeatherApiTransformer",
+        "uploader": "weather.weather_uploader:OpenWeatherApiUploader",
+    }
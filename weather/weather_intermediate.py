@@ -0,0 +1,204 @@
+"""Columnar intermediate files between IconEuTransformer and IconEUDBUploader.
+
+"arrow": Arrow IPC file, zstd-compressed, float32 columns, no geometry (rebuilt from latitude/longitude);
+         read back batch by batch from a memory map.
+"fgb":   FlatGeobuf through GDAL, kept as an export format.
+"""
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from typing import TYPE_CHECKING
+
+import numpy as np
+import pandas as pd
+
+from weather.weather_tiles import tile_points
+
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+FORMATS: dict = {"arrow": ".arrow", "fgb": ".fgb"}
+BATCH_ROWS: int = 65_536
+
+
+_STEP_FILE = re.compile(r"^(?:combined|derived)_grib_data_\d{10}_\d{3}(?:_(?P<area>[a-z_]+))?\.\w+$")
+
+
+def _area_suffix(area: str | None) -> str:
+    return f"_{area.lower()}" if area else ""
+
+
+def step_file_name(day: str, run_hour: str, step: str, fmt: str, area: str | None = None) -> str:
+    return f"combined_grib_data_{day}{run_hour}_{step}{_area_suffix(area)}{FORMATS[fmt]}"
+
+
+def derived_file_name(day: str, run_hour: str, hour: str, fmt: str, area: str | None = None) -> str:
+    return f"derived_grib_data_{day}{run_hour}_{hour}{_area_suffix(area)}{FORMATS[fmt]}"
+
+
+def is_derived_file(path: str) -> bool:
+    return os.path.basename(path).startswith("derived_grib_data_")
+
+
+def step_area(path: str) -> str | None:
+    """Area of a multi-area step file (its AREAS name), None for a single-area run."""
+    match = _STEP_FILE.match(os.path.basename(path))
+    return match["area"].upper() if match and match["area"] else None
+
+
+def with_geometry(frame: pd.DataFrame) -> "gpd.GeoDataFrame":
+    import geopandas as gpd
+
+    if isinstance(frame, gpd.GeoDataFrame):
+        return frame
+    return gpd.GeoDataFrame(
+        frame, geometry=gpd.points_from_xy(frame["longitude"], frame["latitude"]), crs="EPSG:4326"
+    )
+
+
+def downcast(frame: pd.DataFrame) -> pd.DataFrame:
+    """Drops the geometry and stores floating point columns as float32."""
+    frame = pd.DataFrame(frame).drop(columns="geometry", errors="ignore")
+    floats = frame.select_dtypes("floating").columns
+    return frame.astype({name: np.float32 for name in floats})
+
+
+class StepWriter:
+    """Writes one step file frame by frame; it replaces the existing file only on close().
+
+    Arrow frames are appended as record batches straight away, so a step written in tiles never has to be
+    in memory as a whole; FlatGeobuf is written in one go on close.
+    """
+
+    def __init__(self, path: str, fmt: str = "arrow", batch_rows: int = BATCH_ROWS):
+        self.path = path
+        self.fmt = fmt
+        self.batch_rows = batch_rows
+        self.rows = 0
+        # ukryty plik z tym samym rozszerzeniem (GDAL wybiera po nim format), przenoszony po zapisaniu
+        self.tmp_path = os.path.join(os.path.dirname(path), f".{os.getpid()}.{os.path.basename(path)}")
+        self._frames: list = []
+        self._sink = None
+        self._writer = None
+
+    def write(self, frame: pd.DataFrame) -> None:
+        self.rows += len(frame)
+        if self.fmt == "fgb":
+            self._frames.append(frame)
+            return
+
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(downcast(frame), preserve_index=False)
+        if self._writer is None:
+            self._sink = pa.OSFile(self.tmp_path, "wb")
+            self._writer = pa.ipc.new_file(self._sink, table.schema,
+                                           options=pa.ipc.IpcWriteOptions(compression="zstd"))
+        if table.num_rows:
+            self._writer.write_table(table, max_chunksize=self.batch_rows)
+
+    def close(self) -> int:
+        """Finishes the file and moves it in place; returns the number of rows written."""
+        if self.fmt == "fgb":
+            frame = self._frames[0] if len(self._frames) == 1 else pd.concat(self._frames, ignore_index=True)
+            with_geometry(frame).to_file(self.tmp_path, driver="flatgeobuf")
+            self._frames = []
+        else:
+            self._writer.close()
+            self._sink.close()
+        os.replace(self.tmp_path, self.path)
+        return self.rows
+
+    def abort(self) -> None:
+        """Drops the unfinished file; the existing step file is left as it was."""
+        self._frames = []
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_step(frame: pd.DataFrame, path: str, fmt: str = "arrow", batch_rows: int = BATCH_ROWS) -> None:
+    writer = StepWriter(path, fmt, batch_rows)
+    try:
+        writer.write(frame)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def iter_step_batches(path: str, budget_mb: float | None = None):
+    """Yields the step as DataFrames: one per record batch for Arrow files, the whole file for FlatGeobuf.
+
+    With `budget_mb` Arrow batches are cut further so one of them fits the budget (weather_tiles.tile_points).
+    """
+    if path.endswith(FORMATS["fgb"]):
+        import geopandas as gpd
+
+        yield gpd.read_file(path)
+        return
+
+    import pyarrow as pa
+
+    with pa.memory_map(path, "r") as source:
+        reader = pa.ipc.open_file(source)
+        max_rows = tile_points(budget_mb, len(reader.schema)) if budget_mb else None
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            for offset in range(0, batch.num_rows, max_rows or max(batch.num_rows, 1)):
+                yield (batch.slice(offset, max_rows) if max_rows else batch).to_pandas()
+
+
+def list_step_files(folder: str, fmt: str) -> list:
+    return [
+        os.path.join(folder, filename)
+        for filename in sorted(os.listdir(folder))
+        if filename.endswith(FORMATS[fmt]) and not filename.startswith(".")
+    ]
+
+
+def benchmark_roundtrip(frame: pd.DataFrame, folder: str, repeat: int = 3) -> dict:
+    """Best-of-`repeat` write and read times of one step in every format."""
+    results = {}
+    for fmt in FORMATS:
+        path = os.path.join(folder, f"benchmark{FORMATS[fmt]}")
+        write_s, read_s = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            write_step(frame, path, fmt)
+            write_s.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            rows = sum(len(with_geometry(batch)) for batch in iter_step_batches(path))
+            read_s.append(time.perf_counter() - started)
+
+        results[fmt] = {"rows": rows, "bytes": os.path.getsize(path), "write_s": min(write_s), "read_s": min(read_s)}
+        os.remove(path)
+    return results
+
+
+def synthetic_step(rows: int) -> pd.DataFrame:
+    side = int(np.sqrt(rows))
+    lats, lons = np.meshgrid(49.0 + 0.0625 * np.arange(side), 14.0 + 0.0625 * np.arange(side), indexing="ij")
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "cell_id": np.arange(side * side, dtype=np.int32),
+        "latitude": lats.ravel(),
+        "longitude": lons.ravel(),
+        "Temperature": rng.normal(280, 5, side * side),
+        "Total precipitation rate": rng.gamma(1, 1, side * side),
+        "Soil temperature": rng.normal(282, 3, side * side),
+        "Soil moisture": rng.gamma(2, 10, side * side),
+        "update_on": pd.Timestamp("2025-01-01"),
+    })
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 455_769  # Area.EUROPE
+    with tempfile.TemporaryDirectory() as folder:
+        print(json.dumps(benchmark_roundtrip(synthetic_step(rows), folder), indent=2))
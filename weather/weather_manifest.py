@@ -0,0 +1,118 @@
+import hashlib
+import os
+import re
+import sqlite3
+from datetime import datetime, timezone
+
+ICON_FILE_PATTERN = re.compile(
+    r"_(?P<run_date>\d{8})(?P<run_hour>\d{2})_(?P<step>\d{3})(?:_(?P<level>\d+))?_(?P<variable>[A-Z0-9_]+)\.grib2"
+)
+
+
+def parse_icon_filename(name: str) -> dict:
+    """'..._2025010100_003_0_T_SO.grib2.bz2' -> run_date, run_hour, step, level, variable (empty dict if no match)."""
+    match = ICON_FILE_PATTERN.search(os.path.basename(name))
+    return match.groupdict() if match else {}
+
+
+def file_checksum(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """SQLite record of the artifacts each stage produced (download, extract, transform, upload).
+
+    A stage skips an artifact whose record is "done", whose file still has the recorded size and, when
+    given, whose inputs are unchanged. One connection per call, so threads and worker processes can share it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    stage TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT,
+                    run_date TEXT,
+                    run_hour TEXT,
+                    step TEXT,
+                    variable TEXT,
+                    level TEXT,
+                    size INTEGER,
+                    checksum TEXT,
+                    inputs TEXT,
+                    state TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (stage, name)
+                )
+                """
+            )
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RunManifest":
+        return cls(config.get("MANIFEST_PATH", os.path.join(config["DOWNLOAD_FOLDER_ICON"], "manifest.sqlite")))
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def record(self, stage: str, path: str, run_date: str | None = None, run_hour: str | None = None,
+               step: str | None = None, inputs: str | None = None, checksum: str | None = None,
+               state: str = "done") -> None:
+        """Stores the artifact; run date/hour, step and variable are taken from ICON file names when present."""
+        name = os.path.basename(path)
+        parsed = parse_icon_filename(name)
+        size = os.path.getsize(path) if os.path.exists(path) else None
+        if checksum is None and size is not None:
+            checksum = file_checksum(path)
+
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    stage, name, path,
+                    run_date or parsed.get("run_date"), run_hour or parsed.get("run_hour"),
+                    step or parsed.get("step"), parsed.get("variable"), parsed.get("level"),
+                    size, checksum, inputs, state, datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+
+    def get(self, stage: str, path: str) -> dict | None:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM artifacts WHERE stage = ? AND name = ?", (stage, os.path.basename(path))
+            ).fetchone()
+        return dict(row) if row else None
+
+    def is_done(self, stage: str, path: str, inputs: str | None = None, check_file: bool = True) -> bool:
+        row = self.get(stage, path)
+        if row is None or row["state"] != "done":
+            return False
+        if inputs is not None and row["inputs"] != inputs:
+            return False
+        if check_file:
+            return os.path.exists(path) and os.path.getsize(path) == row["size"]
+        return True
+
+    def artifacts(self, stage: str, run_date: str, run_hour: str, state: str = "done") -> list[dict]:
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT * FROM artifacts WHERE stage = ? AND run_date = ? AND run_hour = ? AND state = ? "
+                "ORDER BY step, name",
+                (stage, run_date, run_hour, state),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def inputs_key(rows: list[dict]) -> str:
+        """Fingerprint of a set of input artifacts, stored with the output that was built from them."""
+        return ",".join(sorted(f"{row['name']}:{row['checksum']}" for row in rows))
@@ -0,0 +1,217 @@
+import concurrent.futures
+import functools
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from typing import Callable
+
+from pass_logging import logger
+from pass_metrics import metrics
+from weather.weather_manifest import parse_icon_filename
+
+_DONE = object()  # koniec strumienia dla jednego wątku etapu
+
+
+class Stage:
+    """One pipeline stage: `func(item)` run by `workers` threads; returning None drops the item.
+
+    A grouped stage calls `func(key, items)` once per key, after every item with that key has either
+    arrived or been dropped upstream. A fan-out stage may return a list, passed on as separate items.
+    """
+
+    def __init__(self, name: str, func: Callable, workers: int = 1, grouped: bool = False, fan_out: bool = False):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.grouped = grouped
+        self.fan_out = fan_out
+        self.items = 0
+        self.dropped = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def account(self, seconds: float, dropped: bool) -> None:
+        with self._lock:
+            self.items += 1
+            self.dropped += dropped
+            self.busy_seconds += seconds
+
+    def summary(self) -> dict:
+        return {
+            "items": self.items,
+            "dropped": self.dropped,
+            "busy_s": round(self.busy_seconds, 2),
+            "busy_per_worker_s": round(self.busy_seconds / self.workers, 2),
+            "workers": self.workers,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class StreamingPipeline:
+    """Moves (key, item) pairs through the stages over bounded queues, one thread pool per stage.
+
+    A full queue blocks the stage that feeds it, so a slow database holds back decoding instead of
+    piling decoded steps up in memory. Dropped items travel on as (key, None) so grouped stages can
+    still close their groups.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 16):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.errors: list = []
+        self.results: list = []
+
+    def run(self, items: list, key: Callable) -> list:
+        """Runs every item through all stages; `key(item)` assigns the group used by grouped stages."""
+        keyed = [(key(item), item) for item in items]
+        expected = Counter(item_key for item_key, _ in keyed)
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = []
+
+        for index, stage in enumerate(self.stages):
+            inbox = queues[index]
+            outbox = queues[index + 1] if index + 1 < len(self.stages) else None
+            if stage.grouped:
+                work = queue.Queue(maxsize=self.queue_size)
+                threads.append(threading.Thread(
+                    target=self._collect, args=(stage, inbox, work, expected), name=f"{stage.name}-collect"
+                ))
+                inbox = work
+            remaining = [stage.workers]
+            for number in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work, args=(stage, inbox, outbox, remaining), name=f"{stage.name}-{number}"
+                ))
+
+        for thread in threads:
+            thread.start()
+
+        started = time.perf_counter()
+        first = self.stages[0]
+        for pair in keyed:
+            self._put(queues[0], pair, first)
+        for _ in range(1 if first.grouped else first.workers):
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+
+        self.log_summary(time.perf_counter() - started)
+        if self.errors:
+            raise self.errors[0]
+        return self.results
+
+    def _work(self, stage: Stage, inbox: queue.Queue, outbox: queue.Queue | None, remaining: list) -> None:
+        while True:
+            pair = inbox.get()
+            if pair is _DONE:
+                break
+            item_key, item = pair
+
+            result = None
+            if item is not None:
+                started = time.perf_counter()
+                try:
+                    result = stage.func(item_key, item) if stage.grouped else stage.func(item)
+                except Exception as e:  # pozostałe kroki przetwarzamy dalej
+                    logger.error(f"Etap {stage.name} nie przetworzył {item_key}: {e!r}")
+                    self.errors.append(e)
+                stage.account(time.perf_counter() - started, dropped=result is None)
+
+            for result in (result if stage.fan_out and isinstance(result, list) else [result]):
+                if outbox is not None:
+                    self._put(outbox, (item_key, result), self.stages[self.stages.index(stage) + 1])
+                elif result is not None:
+                    self.results.append(result)
+
+        with stage._lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            following = self.stages[self.stages.index(stage) + 1]
+            for _ in range(1 if following.grouped else following.workers):
+                outbox.put(_DONE)
+
+    def _collect(self, stage: Stage, inbox: queue.Queue, work: queue.Queue, expected: Counter) -> None:
+        groups: dict = {}
+        arrived = Counter()
+        while True:
+            pair = inbox.get()
+            if pair is _DONE:
+                break
+            item_key, item = pair
+            arrived[item_key] += 1
+            if item is not None:
+                groups.setdefault(item_key, []).append(item)
+            if arrived[item_key] == expected[item_key]:
+                self._put(work, (item_key, groups.pop(item_key, None)), stage)
+
+        for item_key, items in groups.items():  # nie powinno się zdarzyć, ale nie gubimy danych
+            self._put(work, (item_key, items), stage)
+        for _ in range(stage.workers):
+            work.put(_DONE)
+
+    @staticmethod
+    def _put(target: queue.Queue, pair: tuple, stage: Stage) -> None:
+        target.put(pair)  # blokuje przy pełnej kolejce (backpressure)
+        stage.max_queue_depth = max(stage.max_queue_depth, target.qsize())
+
+    def log_summary(self, wall_seconds: float) -> None:
+        slowest = max(stage.busy_seconds / stage.workers for stage in self.stages)
+        for stage in self.stages:
+            metrics.max("queue_depth_max", stage.max_queue_depth, stage=stage.name)
+            metrics.set("stage_busy_seconds", round(stage.busy_seconds, 3), stage=stage.name)
+            logger.info(f"Etap {stage.name}: {stage.summary()}")
+        logger.info(
+            f"Potok zakończony w {wall_seconds:.1f} s "
+            f"(najwolniejszy etap {slowest:.1f} s, suma etapów "
+            f"{sum(stage.busy_seconds / stage.workers for stage in self.stages):.1f} s)"
+        )
+
+
+def forecast_step(item: str) -> str | None:
+    return parse_icon_filename(item).get("step")
+
+
+def run_streaming(downloader, extractor, transformer, uploader, config: dict) -> list:
+    """Streams ICON files through download -> extract -> transform (per step) -> upload.
+
+    Worker counts per stage come from PIPELINE_WORKERS, queue bounds from PIPELINE_QUEUE_SIZE. With
+    EXTRACT_BACKEND="process" the extract threads hand the decompression to a process pool of as many workers.
+    """
+    for component, method in ((downloader, "get_single_file"), (extractor, "extract_single_file"),
+                              (transformer, "transform_step"), (uploader, "upload_single_file")):
+        if not hasattr(component, method):
+            raise ValueError(f"{type(component).__name__} nie obsługuje PIPELINE_MODE='streaming' (brak {method})")
+
+    workers = {
+        "download": config.get("DOWNLOAD_WORKERS", os.cpu_count() * 2),
+        "extract": config.get("EXTRACT_WORKERS", os.cpu_count()),
+        "transform": max(1, os.cpu_count() // 2),
+        "upload": config.get("UPLOAD_WORKERS", 1),
+        **config.get("PIPELINE_WORKERS", {}),
+    }
+    extract, executor = extractor.extract_single_file, None
+    if getattr(extractor, "backend", "thread") == "process":  # wątki etapu czekają na rozpakowanie w procesach
+        executor = concurrent.futures.ProcessPoolExecutor(workers["extract"])
+        extract = functools.partial(extractor.extract_single_file, executor=executor)
+    pipeline = StreamingPipeline(
+        [
+            Stage("download", downloader.get_single_file, workers["download"]),
+            Stage("extract", extract, workers["extract"]),
+            Stage("transform", transformer.transform_step, workers["transform"], grouped=True, fan_out=True),
+            Stage("upload", uploader.upload_single_file, workers["upload"]),
+        ],
+        queue_size=config.get("PIPELINE_QUEUE_SIZE", 16),
+    )
+    links = sorted(downloader.get_links(), key=forecast_step)  # pierwsze kroki kompletne jak najwcześniej
+    logger.info(f"Potok strumieniowy: {len(links)} plików, workers={workers}, "
+                f"rozpakowywanie w {'procesach' if executor else 'wątkach'}")
+    try:
+        return pipeline.run(links, key=forecast_step)
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,201 @@
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from pass_logging import logger
+from pass_metrics import instrumented, metrics
+from weather.weather_areas import area_outputs
+from weather.weather_cube import ForecastCube
+from weather.weather_intermediate import derived_file_name, iter_step_batches, step_area, write_step
+from weather.weather_manifest import RunManifest
+
+
+class Postprocessor(ABC):
+    @abstractmethod
+    def postprocess(self):
+        """derived series computed from a whole transformed run"""
+        ...
+
+
+def deaccumulate(values: np.ndarray, steps, axis: int = 0) -> np.ndarray:
+    """Amounts per interval from values accumulated since run start (ICON TOT_PREC).
+
+    The first interval runs from the start of the run to the first step. Small negative differences
+    left by GRIB packing are clipped to 0; NaN stays NaN.
+    """
+    values = np.moveaxis(np.asarray(values, dtype=np.float32), axis, 0)
+    intervals = np.empty_like(values)
+    intervals[0] = values[0] if int(steps[0]) else 0  # krok 0: nic jeszcze nie spadło
+    np.subtract(values[1:], values[:-1], out=intervals[1:])
+    np.maximum(intervals, 0, out=intervals, where=~np.isnan(intervals))
+    return np.moveaxis(intervals, 0, axis)
+
+
+def interpolate_steps(values: np.ndarray, steps, hours, axis: int = 0) -> np.ndarray:
+    """Linear interpolation along the step axis at `hours` (within the forecast steps), for every point at once."""
+    steps = np.asarray(steps, dtype=np.float64)
+    hours = np.asarray(hours, dtype=np.float64)
+    values = np.moveaxis(np.asarray(values, dtype=np.float32), axis, 0)
+    if steps.size == 1:
+        return np.moveaxis(np.repeat(values, hours.size, axis=0), 0, axis)
+
+    lower = np.clip(np.searchsorted(steps, hours, side="right") - 1, 0, steps.size - 2)
+    weight = ((hours - steps[lower]) / (steps[lower + 1] - steps[lower])).astype(np.float32)
+    weight = weight.reshape(-1, *([1] * (values.ndim - 1)))
+    result = values[lower] * (1 - weight) + values[lower + 1] * weight
+    return np.moveaxis(result, 0, axis)
+
+
+def derive_series(series: dict, steps: list, accumulated: dict, hourly: list) -> tuple:
+    """Derived (hour, point) columns from (step, point) columns of one run.
+
+    Accumulated columns become amounts per interval under their new name (per hour when `hourly` is set:
+    the accumulation is interpolated first, i.e. a constant rate within each forecast interval).
+    Columns listed in `hourly` are interpolated to every hour between the first and last step.
+    Returns (hours, columns), with `interval_hours` giving the length of each interval.
+    """
+    steps = [int(step) for step in steps]
+    hours = list(range(steps[0], steps[-1] + 1)) if hourly else steps
+
+    columns = {}
+    for source, target in accumulated.items():
+        if source in series:
+            values = series[source] if hours == steps else interpolate_steps(series[source], steps, hours)
+            columns[target] = deaccumulate(values, hours)
+    for name in hourly:
+        if name in series:
+            columns[name] = interpolate_steps(series[name], steps, hours)
+
+    columns["interval_hours"] = np.diff(np.asarray(hours, dtype=np.float32), prepend=0)
+    return hours, columns
+
+
+class IconEuPostprocessor(Postprocessor):
+    """Derived series of one ICON run: precipitation per interval and hourly interpolated fields.
+
+    Works on the run's ForecastCube when CUBE_FOLDER has one, otherwise on the transformed step files; every
+    derived hour is written as its own intermediate file and uploaded to DERIVED_TABLE.
+    """
+
+    def __init__(self, config):
+        self.temp_folder = config["TMP_FOLDER"]
+        self.day = config["DATE"]
+        self.run_hour = config["FORECAST_HOUR"]
+        self.run_on = datetime.strptime(f"{self.day}{self.run_hour}", "%Y%m%d%H")
+        self.accumulated: dict = config.get("POSTPROCESS_ACCUMULATED", {"Total precipitation rate": "Total precipitation"})
+        self.hourly: list = config.get("POSTPROCESS_HOURLY", [])
+        self.storage_mode = config.get("STORAGE_MODE", "points")
+        self.intermediate_format = config.get("INTERMEDIATE_FORMAT", "arrow")
+        self.cube_folder: str | None = config.get("CUBE_FOLDER")
+        self.areas: dict = area_outputs(config)
+        self.manifest = RunManifest.from_config(config)
+
+    @instrumented("postprocess")
+    def postprocess(self) -> list:
+        transformed = self.manifest.artifacts("transform", self.day, self.run_hour)
+        if not transformed:
+            logger.info("Brak przetworzonych kroków, pomijam postprocessing")
+            return []
+
+        by_area: dict = {}
+        for row in transformed:
+            by_area.setdefault(step_area(row["path"]), []).append(row)
+        return [output for area, rows in by_area.items() for output in self.postprocess_area(area, rows)]
+
+    def postprocess_area(self, area: str | None, transformed: list) -> list:
+        inputs = RunManifest.inputs_key(transformed)
+        done = [row for row in self.manifest.artifacts("postprocess", self.day, self.run_hour)
+                if step_area(row["path"]) == area]
+        if done and all(row["inputs"] == inputs and os.path.exists(row["path"]) for row in done):
+            logger.info("Serie pochodne już policzone z tych samych kroków, pomijam")
+            metrics.inc("items_skipped_total", len(done), stage="postprocess")
+            return [row["path"] for row in done]
+
+        base, steps, series = self.load_series(transformed, area)
+        if len(steps) < 2 and self.hourly:
+            logger.warning("Za mało kroków prognozy do interpolacji godzinowej")
+        hours, columns = derive_series(series, steps, self.accumulated, self.hourly)
+        if len(columns) == 1:  # tylko interval_hours
+            logger.info(f"Brak kolumn do postprocessingu wśród {sorted(series)}")
+            return []
+
+        os.makedirs(self.temp_folder, exist_ok=True)
+        outputs = []
+        for position, hour in enumerate(hours):
+            frame = base.copy()
+            for name, values in columns.items():
+                frame[name] = values[position]
+            frame["update_on"] = np.datetime64(self.run_on + pd.Timedelta(hours=hour), "ns")
+
+            output_file = os.path.join(
+                self.temp_folder, derived_file_name(self.day, self.run_hour, f"{hour:03d}", self.intermediate_format, area)
+            )
+            write_step(frame, output_file, self.intermediate_format)
+            self.manifest.record("postprocess", output_file, run_date=self.day, run_hour=self.run_hour,
+                                 step=f"{hour:03d}", inputs=inputs)
+            outputs.append(output_file)
+
+        metrics.inc("rows_total", len(base) * len(hours), stage="postprocess")
+        logger.info(f"Serie pochodne {area or ''}: {len(hours)} godzin x {len(base)} punktów, kolumny {sorted(columns)}")
+        return outputs
+
+    def load_series(self, transformed: list, area: str | None = None) -> tuple:
+        """(points frame, steps, {column: (step, point) float32}) of the run, from the cube if there is one."""
+        folder = self.cube_folder and os.path.join(self.cube_folder, f"icon_{self.day}{self.run_hour}")
+        if folder and os.path.exists(os.path.join(folder, "meta.json")):
+            cube = ForecastCube.load(folder)
+            base, steps, series = series_from_cube(cube.sel(bbox=self.areas[area]) if area else cube)
+        else:
+            base, steps, series = series_from_steps([row["path"] for row in transformed], self.run_on)
+        if self.storage_mode != "cells":
+            base = base.drop(columns="cell_id", errors="ignore")
+        return base, steps, series
+
+
+def series_from_cube(cube: ForecastCube) -> tuple:
+    """Every variable of the cube as (step, point) in ForecastCube.to_frame row order."""
+    latitude, longitude = np.meshgrid(cube.latitude, cube.longitude, indexing="ij")
+    order = np.lexsort((longitude.ravel(), latitude.ravel()))
+    base = pd.DataFrame({"cell_id": cube.cell_ids()[order], "latitude": latitude.ravel()[order],
+                         "longitude": longitude.ravel()[order]})
+
+    series = {}
+    for position, variable in enumerate(cube.variables):
+        values = cube.data[position]  # (level, step, latitude, longitude)
+        has_data = ~np.isnan(values).all(axis=(1, 2, 3))
+        level = int(np.argmax(has_data)) if has_data.any() else 0
+        series[cube.parameter_names.get(variable, variable)] = \
+            np.asarray(values[level]).reshape(len(cube.steps), -1)[:, order]
+    return base, cube.steps, series
+
+
+def series_from_steps(paths: list, run_on: datetime) -> tuple:
+    """Stacks the value columns of the step files of one run; every step must cover the same points."""
+    frames = {}
+    for path in paths:
+        frame = pd.concat(list(iter_step_batches(path)), ignore_index=True)
+        frame = pd.DataFrame(frame).drop(columns="geometry", errors="ignore")
+        frames[frame["update_on"].iloc[0]] = frame
+
+    times = sorted(frames)
+    base = frames[times[0]].drop(columns="update_on")
+    keys = [name for name in ("cell_id", "latitude", "longitude") if name in base]
+    base = base[keys]
+
+    for time in times[1:]:
+        if len(frames[time]) != len(base) or not np.array_equal(frames[time]["latitude"].to_numpy(),
+                                                                 base["latitude"].to_numpy()) \
+                or not np.array_equal(frames[time]["longitude"].to_numpy(), base["longitude"].to_numpy()):
+            raise ValueError(f"Krok {time} ma inne punkty niż pierwszy krok, nie można złożyć serii")
+
+    names = [name for name in frames[times[0]].columns if name not in keys and name != "update_on"]
+    series = {
+        name: np.stack([frames[time][name].to_numpy(dtype=np.float32) if name in frames[time]
+                        else np.full(len(base), np.nan, dtype=np.float32) for time in times])
+        for name in names
+    }
+    steps = [int((pd.Timestamp(time) - pd.Timestamp(run_on)) / pd.Timedelta(hours=1)) for time in times]
+    return base.reset_index(drop=True), steps, series
@@ -0,0 +1,371 @@
+"""Daily rollups of the ICON values tables, maintained while the steps are loaded (ROLLUPS).
+
+For a values table T in weather_icon (weather_data_v2, an AREAS table, or the cell values table):
+
+    T_daily                 per cell, UTC day and run: temperature min/max from the steps and the precipitation
+                            sum from the intervals of the derived table (POSTPROCESS)
+    T_daily_regions         per region of ROLLUP_REGIONS (id, geom), day and run: min/max of the cells, mean and
+                            max of their precipitation sums, number of cells
+    T_cell_regions          region of every cell, NULL outside all regions; filled once per new cell
+    T_daily_runs            runs whose upload has completed (Rollups.complete, at the end of a run)
+    T_daily_latest,
+    T_daily_regions_latest  views of the newest completed run only, never of a run still being loaded
+
+`temperature_hours` and `precipitation_hours` are bitmasks of the UTC hours folded into a row (the first day of
+a run is partial). The rows of one step file are staged in a temporary table batch by batch. At the end of the
+file's transaction the temperature or precipitation of the staged cells and days is recomputed from the values
+or derived table the transaction has just updated. A step loaded twice thus changes nothing, a re-transformed
+step leaves no stale min/max behind, and intervals re-derived by post-processing (a late step splits an
+interval in two) are not counted twice. The region rows of the touched days are then recomputed from their
+cells. verify_rollups compares one run with a full recomputation from the values tables.
+"""
+import argparse
+import json
+import sys
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from pass_logging import logger
+from pass_metrics import metrics
+from weather.weather_uploader import copy_rows, lock_name, quote, relation_exists, value_column_name
+
+KEY_TYPES: dict = {"latitude": "real", "longitude": "real", "cell_id": "integer"}
+TOLERANCE: float = 1e-4  # względna, sumy float32 liczone w innej kolejności
+
+_READY: set = set()  # (schema, table) z gotowymi tabelami agregatów
+_READY_LOCK = threading.Lock()
+
+
+class Rollups:
+    """Rollup tables of one values table and the SQL that keeps them up to date."""
+
+    def __init__(self, schema: str, table: str, derived_table: str, keys: list, temperature: str = "Temperature",
+                 precipitation: str = "Total precipitation", regions: str | None = None,
+                 cells_storage: bool = False):
+        self.schema = schema
+        self.table = table
+        self.derived_table = derived_table
+        self.keys = list(keys)  # latitude, longitude | cell_id
+        self.temperature = temperature
+        self.precipitation = precipitation
+        self.regions = regions  # "schema.table" z kolumnami id, geom
+        self.cells_storage = cells_storage  # kolumny wartości po value_column_name, z kolumną run_on
+        self.daily = f"{table}_daily"
+        self.daily_regions = f"{table}_daily_regions"
+        self.cell_regions = f"{table}_cell_regions"
+        self.runs = f"{table}_daily_runs"
+        self.staging = quote(f"staging_{self.daily}")
+
+    @property
+    def tables(self) -> list:
+        tables = [self.daily, self.runs]
+        return tables + [self.daily_regions, self.cell_regions] if self.regions else tables
+
+    def name(self, table: str) -> str:
+        return f"{quote(self.schema)}.{quote(table)}"
+
+    def column(self, name: str) -> str:
+        """Column of a variable in the values tables."""
+        return quote(value_column_name(name) if self.cells_storage else name)
+
+    def _keys(self, alias: str = "") -> str:
+        return ", ".join(f"{alias}{quote(key)}" for key in self.keys)
+
+    def _join(self, left: str, right: str) -> str:
+        return " AND ".join(f"{left}.{quote(key)} = {right}.{quote(key)}" for key in self.keys)
+
+    @property
+    def _staged_columns(self) -> list:
+        """Key columns plus latitude/longitude for the region lookup."""
+        return list(dict.fromkeys(self.keys + ["latitude", "longitude"]))
+
+    def ensure(self, connection) -> None:
+        """Creates the missing tables and views (once per process)."""
+        with _READY_LOCK:
+            if (self.schema, self.table) in _READY:
+                return
+        last = self.daily_regions if self.regions else self.daily
+        if not (relation_exists(connection, self.name(self.runs))
+                and relation_exists(connection, self.name(f"{last}_latest"))):
+            lock_name(connection, self.name(self.daily))
+            keys = ", ".join(f"{quote(key)} {KEY_TYPES[key]} NOT NULL" for key in self.keys)
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {self.name(self.daily)} ({keys}, day date NOT NULL, "
+                f"run_on timestamp NOT NULL, temperature_min real, temperature_max real, temperature_hours integer, "
+                f"precipitation_sum real, precipitation_hours integer, PRIMARY KEY ({self._keys()}, day, run_on))"
+            ))
+            connection.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {self.name(self.runs)} (run_on timestamp PRIMARY KEY, "
+                f"completed_at timestamp NOT NULL)"
+            ))
+            views = [self.daily]
+            if self.regions:
+                connection.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {self.name(self.cell_regions)} ({keys}, region_id integer, "
+                    f"PRIMARY KEY ({self._keys()}))"
+                ))
+                connection.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {self.name(self.daily_regions)} (region_id integer NOT NULL, "
+                    f"day date NOT NULL, run_on timestamp NOT NULL, temperature_min real, temperature_max real, "
+                    f"precipitation_mean real, precipitation_max real, cells integer, "
+                    f"PRIMARY KEY (region_id, day, run_on))"
+                ))
+                views.append(self.daily_regions)
+            for table in views:
+                connection.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS {quote(table + '_run_on')} ON {self.name(table)} (run_on)"
+                ))
+                connection.execute(text(
+                    f"CREATE OR REPLACE VIEW {self.name(table + '_latest')} AS SELECT * FROM {self.name(table)} "
+                    f"WHERE run_on = (SELECT max(run_on) FROM {self.name(self.runs)})"
+                ))
+            logger.info(f"Utworzono tabele agregatów {self.schema}.{self.daily}")
+        with _READY_LOCK:
+            _READY.add((self.schema, self.table))
+
+    def stage(self, connection, frame: pd.DataFrame, derived: bool = False) -> int:
+        """Copies the cells and days one batch touches to the file's staging table: (keys, day).
+
+        Steps give the temperature at `update_on`; derived files the precipitation of the interval ending at
+        `update_on`, counted to the day it falls in. Cells without a value are staged too, as a re-uploaded step
+        may have just removed their value.
+        """
+        if (self.precipitation if derived else self.temperature) not in frame:
+            return 0
+
+        keep = np.ones(len(frame), dtype=bool)
+        times = pd.DatetimeIndex(frame["update_on"])
+        if derived:
+            if "interval_hours" in frame:
+                keep &= frame["interval_hours"].to_numpy() > 0  # krok 0: interwał zerowy
+            times = times - pd.Timedelta(seconds=1)  # opad z (t - Δ, t] należy do dnia sprzed północy t
+
+        rows = pd.DataFrame({key: frame[key].to_numpy()[keep] for key in self._staged_columns})
+        rows["day"] = times[keep].normalize()
+        if rows.empty:
+            return 0
+
+        columns = ", ".join(f"{quote(key)} {KEY_TYPES[key]}" for key in self._staged_columns)
+        connection.execute(text(
+            f"CREATE TEMP TABLE IF NOT EXISTS {self.staging} ({columns}, day date) ON COMMIT DROP"
+        ))
+        copy_rows(connection, rows, self.staging)
+        metrics.inc("rows_total", len(rows), stage="rollup")
+        return len(rows)
+
+    def merge(self, connection, run_on: datetime, derived: bool = False) -> None:
+        """Folds the staged rows of one file into the daily rows of `run_on` and refreshes their regions."""
+        if not relation_exists(connection, self.staging):
+            return
+        if self.regions:
+            self.map_cells(connection)
+
+        self.recompute(connection, run_on, derived)
+        if self.regions:
+            self.refresh_regions(connection, run_on)
+
+    def recompute(self, connection, run_on: datetime, derived: bool = False) -> None:
+        """Sets the temperature (steps) or precipitation (derived files) of the staged cells and days to their
+        aggregate over the values table, as the current transaction sees it."""
+        # po jednej transakcji przebiegu naraz: następna liczy już z wartościami zatwierdzonymi przez tę
+        lock_name(connection, f"{self.name(self.daily)}:{run_on:%Y%m%d%H}")
+        keys = self._keys()
+        if derived:
+            table, value = self.derived_table, self.column(self.precipitation)
+            time = "(v.update_on - interval '1 second')"  # opad z (t - Δ, t] należy do dnia sprzed północy t
+            columns = ["precipitation_sum", "precipitation_hours"]
+            aggregates = f"sum(v.{value})"
+            condition = f" AND v.{self.column('interval_hours')} > 0"
+        else:
+            table, value, time = self.table, self.column(self.temperature), "v.update_on"
+            columns = ["temperature_min", "temperature_max", "temperature_hours"]
+            aggregates = f"min(v.{value}), max(v.{value})"
+            condition = ""
+        aggregates += f", bit_or(CASE WHEN v.{value} IS NOT NULL THEN 1 << extract(hour FROM {time})::int END)"
+        if self.cells_storage:
+            condition += " AND v.run_on = CAST(:run_on AS timestamp)"
+
+        # kolejność kluczy stała, więc równoległe kroki tego samego dnia blokują wiersze w tym samym porządku
+        connection.execute(text(
+            f"INSERT INTO {self.name(self.daily)} AS d ({keys}, day, run_on, {', '.join(columns)}) "
+            f"SELECT {self._keys('v.')}, s.day, CAST(:run_on AS timestamp), {aggregates} "
+            f"FROM (SELECT DISTINCT {keys}, day FROM {self.staging}) s "
+            f"JOIN {self.name(table)} v ON {self._join('v', 's')} AND {time}::date = s.day "
+            f"WHERE v.update_on >= CAST(:run_on AS timestamp){condition} "
+            f"GROUP BY {self._keys('v.')}, s.day ORDER BY {self._keys('v.')}, s.day "
+            f"ON CONFLICT ({keys}, day, run_on) DO UPDATE SET "
+            + ", ".join(f"{column} = EXCLUDED.{column}" for column in columns)
+        ), {"run_on": run_on})
+        connection.execute(text(  # komórki i dni bez żadnej wartości
+            f"DELETE FROM {self.name(self.daily)} d WHERE d.run_on = CAST(:run_on AS timestamp) "
+            f"AND d.temperature_hours IS NULL AND d.precipitation_hours IS NULL "
+            f"AND EXISTS (SELECT 1 FROM {self.staging} s WHERE {self._join('s', 'd')} AND s.day = d.day)"
+        ), {"run_on": run_on})
+
+    def map_cells(self, connection) -> None:
+        """Looks up the region of the staged cells not mapped yet (NULL outside all regions)."""
+        schema, _, table = self.regions.rpartition(".")
+        regions = f"{quote(schema or 'public')}.{quote(table)}"
+        connection.execute(text(
+            f"INSERT INTO {self.name(self.cell_regions)} ({self._keys()}, region_id) "
+            f"SELECT DISTINCT ON ({self._keys('s.')}) {self._keys('s.')}, g.id FROM {self.staging} s "
+            f"LEFT JOIN {regions} g ON ST_Intersects(g.geom, ST_Transform(ST_SetSRID("
+            f"ST_MakePoint(s.longitude, s.latitude), 4326), ST_SRID(g.geom))) "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {self.name(self.cell_regions)} m WHERE {self._join('m', 's')}) "
+            f"ORDER BY {self._keys('s.')}, g.id "
+            f"ON CONFLICT DO NOTHING"
+        ))
+
+    def refresh_regions(self, connection, run_on: datetime) -> None:
+        """Recomputes the region rows of the staged days from their cells."""
+        # po jednej transakcji naraz: zapytanie widzi wtedy wiersze komórek zatwierdzone przez poprzednią
+        lock_name(connection, f"{self.name(self.daily_regions)}:{run_on:%Y%m%d%H}")
+        connection.execute(text(
+            f"INSERT INTO {self.name(self.daily_regions)} AS r (region_id, day, run_on, temperature_min, "
+            f"temperature_max, precipitation_mean, precipitation_max, cells) "
+            f"SELECT m.region_id, d.day, d.run_on, min(d.temperature_min), max(d.temperature_max), "
+            f"avg(d.precipitation_sum), max(d.precipitation_sum), count(*) "
+            f"FROM {self.name(self.daily)} d JOIN {self.name(self.cell_regions)} m ON {self._join('d', 'm')} "
+            f"WHERE m.region_id IS NOT NULL AND d.run_on = CAST(:run_on AS timestamp) "
+            f"AND d.day IN (SELECT DISTINCT day FROM {self.staging}) "
+            f"GROUP BY m.region_id, d.day, d.run_on ORDER BY m.region_id, d.day "
+            f"ON CONFLICT (region_id, day, run_on) DO UPDATE SET temperature_min = EXCLUDED.temperature_min, "
+            f"temperature_max = EXCLUDED.temperature_max, precipitation_mean = EXCLUDED.precipitation_mean, "
+            f"precipitation_max = EXCLUDED.precipitation_max, cells = EXCLUDED.cells"
+        ), {"run_on": run_on})
+
+    def complete(self, connection, run_on: datetime) -> None:
+        """Marks the run as completely loaded; the _latest views switch to it."""
+        connection.execute(text(
+            f"INSERT INTO {self.name(self.runs)} (run_on, completed_at) "
+            f"VALUES (CAST(:run_on AS timestamp), CAST(:completed_at AS timestamp)) "
+            f"ON CONFLICT (run_on) DO UPDATE SET completed_at = EXCLUDED.completed_at"
+        ), {"run_on": run_on, "completed_at": datetime.now()})
+
+    def prune(self, connection, keep_runs: int) -> None:
+        """Deletes the rows of all but the newest `keep_runs` runs."""
+        cutoff = connection.execute(text(
+            f"SELECT run_on FROM (SELECT DISTINCT run_on FROM {self.name(self.daily)}) runs "
+            f"ORDER BY run_on DESC OFFSET :offset LIMIT 1"
+        ), {"offset": max(keep_runs - 1, 0)}).scalar()
+        if cutoff is None:
+            return
+        for table in (self.daily, self.runs, self.daily_regions) if self.regions else (self.daily, self.runs):
+            connection.execute(text(f"DELETE FROM {self.name(table)} WHERE run_on < :cutoff"), {"cutoff": cutoff})
+
+    def expected_sql(self, has_derived: bool) -> str:
+        """CTEs `expected` (cells) and `expected_regions` recomputed from the values tables for :run_on."""
+        keys = self._keys()
+        run_filter = " AND run_on = CAST(:run_on AS timestamp)" if self.cells_storage else ""
+        temperature = self.column(self.temperature)
+        sql = (
+            f"temperature AS ("
+            f"SELECT {keys}, update_on::date AS day, min({temperature}) AS temperature_min, "
+            f"max({temperature}) AS temperature_max, "
+            f"bit_or(1 << extract(hour FROM update_on)::int) AS temperature_hours "
+            f"FROM {self.name(self.table)} "
+            f"WHERE update_on >= CAST(:run_on AS timestamp) AND {temperature} IS NOT NULL{run_filter} "
+            f"GROUP BY {keys}, update_on::date), "
+        )
+        if has_derived:
+            precipitation = self.column(self.precipitation)
+            shifted = "(update_on - interval '1 second')"
+            sql += (
+                f"precipitation AS ("
+                f"SELECT {keys}, {shifted}::date AS day, sum({precipitation}) AS precipitation_sum, "
+                f"bit_or(1 << extract(hour FROM {shifted})::int) AS precipitation_hours "
+                f"FROM {self.name(self.derived_table)} "
+                f"WHERE update_on >= CAST(:run_on AS timestamp) AND {precipitation} IS NOT NULL "
+                f"AND {self.column('interval_hours')} > 0{run_filter} "
+                f"GROUP BY {keys}, {shifted}::date), "
+            )
+        else:
+            sql += (
+                f"precipitation AS (SELECT {keys}, NULL::date AS day, NULL::real AS precipitation_sum, "
+                f"NULL::integer AS precipitation_hours FROM {self.name(self.daily)} WHERE false), "
+            )
+        merged_keys = ", ".join(f"COALESCE(t.{quote(key)}, p.{quote(key)}) AS {quote(key)}" for key in self.keys)
+        sql += (
+            f"expected AS ("
+            f"SELECT {merged_keys}, COALESCE(t.day, p.day) AS day, t.temperature_min, t.temperature_max, "
+            f"t.temperature_hours, p.precipitation_sum, p.precipitation_hours "
+            f"FROM temperature t FULL JOIN precipitation p ON {self._join('t', 'p')} AND t.day = p.day)"
+        )
+        if self.regions:
+            sql += (
+                f", expected_regions AS ("
+                f"SELECT m.region_id, e.day, min(e.temperature_min) AS temperature_min, "
+                f"max(e.temperature_max) AS temperature_max, avg(e.precipitation_sum) AS precipitation_mean, "
+                f"max(e.precipitation_sum) AS precipitation_max, count(*) AS cells "
+                f"FROM expected e JOIN {self.name(self.cell_regions)} m ON {self._join('e', 'm')} "
+                f"WHERE m.region_id IS NOT NULL GROUP BY m.region_id, e.day)"
+            )
+        return sql
+
+    def verify(self, connection, run_on: datetime, tolerance: float = TOLERANCE) -> dict:
+        """Counts the rows of `run_on` that are missing, unexpected or different from a full recomputation.
+
+        In "points" storage the values table keeps only the newest value of every valid time, so only the
+        newest loaded run can be verified there.
+        """
+        has_derived = relation_exists(connection, self.name(self.derived_table))
+        expected = self.expected_sql(has_derived)
+
+        def close(name: str) -> str:
+            return (f"((e.{name} IS NULL AND a.{name} IS NULL) "
+                    f"OR COALESCE(abs(e.{name} - a.{name}) <= :tolerance * greatest(1, abs(e.{name})), false))")
+
+        def compare(actual: str, expected_table: str, join: str, values: list, exact: list) -> dict:
+            same = " AND ".join([close(name) for name in values]
+                                + [f"e.{name} IS NOT DISTINCT FROM a.{name}" for name in exact])
+            row = connection.execute(text(
+                f"WITH {expected}, actual AS (SELECT * FROM {actual} WHERE run_on = CAST(:run_on AS timestamp)) "
+                f"SELECT count(*) FILTER (WHERE a.day IS NULL), count(*) FILTER (WHERE e.day IS NULL), "
+                f"count(*) FILTER (WHERE e.day IS NOT NULL AND a.day IS NOT NULL AND NOT ({same})), count(*) "
+                f"FROM {expected_table} e FULL JOIN actual a ON {join} AND e.day = a.day"
+            ), {"run_on": run_on, "tolerance": tolerance}).one()
+            missing, unexpected, different, rows = (int(value or 0) for value in row)
+            return {"rows": rows, "missing": missing, "unexpected": unexpected, "different": different,
+                    "ok": not (missing or unexpected or different)}
+
+        results = {self.daily: compare(
+            self.name(self.daily), "expected", self._join("e", "a"),
+            ["temperature_min", "temperature_max", "precipitation_sum"],
+            ["temperature_hours", "precipitation_hours"],
+        )}
+        if self.regions:
+            results[self.daily_regions] = compare(
+                self.name(self.daily_regions), "expected_regions", "e.region_id = a.region_id",
+                ["temperature_min", "temperature_max", "precipitation_mean", "precipitation_max"], ["cells"],
+            )
+        return results
+
+
+def verify_rollups(engine, rollups: Rollups, run_on: datetime, tolerance: float = TOLERANCE) -> dict:
+    """Compares the rollups of one run with a full recomputation; {table: counts, "ok": bool}."""
+    with engine.connect() as connection:
+        results = rollups.verify(connection, run_on, tolerance)
+    for table, result in results.items():
+        (logger.info if result["ok"] else logger.warning)(f"Weryfikacja {rollups.schema}.{table}: {result}")
+    return results
+
+
+if __name__ == "__main__":
+    from weather import weather_factories
+    from weather.weather_uploader import IconEUDBUploader
+
+    parser = argparse.ArgumentParser(description="Compares the rollups of one ICON run with a full recomputation.")
+    parser.add_argument("factory", nargs="?", default="FactoryWeatherICONPolandForecast")
+    parser.add_argument("--date", help="YYYYMMDD, domyślnie dzisiaj")
+    parser.add_argument("--hour", default="00", help="godzina przebiegu: 00, 06, 12, 18")
+    args = parser.parse_args()
+
+    config = getattr(weather_factories, args.factory)().config
+    config.update({"ROLLUPS": True, "FORECAST_HOUR": args.hour, **({"DATE": args.date} if args.date else {})})
+    results = IconEUDBUploader(config).verify_rollups()
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if all(result["ok"] for tables in results.values() for result in tables.values()) else 1)
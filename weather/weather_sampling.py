@@ -0,0 +1,166 @@
+import hashlib
+import os
+import threading
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from pass_logging import logger
+from weather.weather_cube import ForecastCube
+
+_SAMPLERS: dict = {}
+_SAMPLERS_LOCK = threading.Lock()
+
+
+class PointSampler:
+    """Precomputed gather of a point set from fields on a regular lat/lon grid.
+
+    Every point keeps the flat indices of its 1 (nearest) or 4 (bilinear) neighbouring grid nodes and their
+    weights; points outside the grid get NaN. Sampling is a gather and a weighted sum per neighbour.
+    """
+
+    def __init__(self, indices: np.ndarray, weights: np.ndarray, grid_shape: tuple):
+        self.indices = indices  # (neighbours, points) pozycje w spłaszczonym polu
+        self.weights = weights  # (neighbours, points), NaN poza siatką
+        self.grid_shape = tuple(int(size) for size in grid_shape)
+
+    @property
+    def size(self) -> int:
+        return self.indices.shape[1]
+
+    @classmethod
+    def build(cls, latitude_axis: np.ndarray, longitude_axis: np.ndarray, lon: np.ndarray, lat: np.ndarray,
+              method: str = "bilinear") -> "PointSampler":
+        ny, nx = latitude_axis.size, longitude_axis.size
+        lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+        fy = _fractional_index(latitude_axis, lat)
+        fx = _fractional_index(longitude_axis, lon)
+        outside = np.isnan(fy) | np.isnan(fx)
+        fy, fx = np.nan_to_num(fy), np.nan_to_num(fx)
+
+        if method == "nearest":
+            indices = (np.rint(fy).astype(np.int64) * nx + np.rint(fx).astype(np.int64))[None, :]
+            weights = np.ones((1, lat.size), dtype=np.float32)
+        elif method == "bilinear":
+            y0 = np.clip(np.floor(fy).astype(np.int64), 0, max(ny - 2, 0))
+            x0 = np.clip(np.floor(fx).astype(np.int64), 0, max(nx - 2, 0))
+            y1, x1 = np.minimum(y0 + 1, ny - 1), np.minimum(x0 + 1, nx - 1)
+            ty, tx = fy - y0, fx - x0
+            indices = np.stack([y0 * nx + x0, y0 * nx + x1, y1 * nx + x0, y1 * nx + x1])
+            weights = np.stack([(1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx]).astype(np.float32)
+        else:
+            raise ValueError(f"Nieznana metoda próbkowania: {method}")
+
+        indices[:, outside] = 0
+        weights[:, outside] = np.nan
+        return cls(indices, weights, (ny, nx))
+
+    def sample(self, values: np.ndarray) -> np.ndarray:
+        """(..., latitude, longitude) -> (..., points); a NaN neighbour is left out and the rest re-weighted."""
+        if values.shape[-2:] != self.grid_shape:
+            raise ValueError(f"Pole {values.shape[-2:]} nie pasuje do siatki próbkowania {self.grid_shape}")
+        lead = values.shape[:-2]
+        flat = np.asarray(values).reshape(-1, self.grid_shape[0] * self.grid_shape[1])
+        result = np.zeros((flat.shape[0], self.size), dtype=np.float32)
+        total = np.zeros_like(result)
+        for indices, weights in zip(self.indices, self.weights):  # jeden sąsiad naraz: ciągłe, małe tablice
+            values = np.take(flat, indices, axis=1)
+            missing = np.isnan(values)
+            if missing.any():
+                result += np.where(missing, 0, values * weights)
+                total += np.where(missing, 0, weights)
+            else:
+                result += values * weights
+                total += weights
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result /= total
+        result[total == 0] = np.nan
+        return result.astype(np.float32).reshape(*lead, self.size)
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, indices=self.indices, weights=self.weights, grid_shape=np.array(self.grid_shape))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PointSampler":
+        with np.load(path) as data:
+            return cls(data["indices"], data["weights"], tuple(data["grid_shape"]))
+
+
+def _fractional_index(axis: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Position of each value on a monotonic axis in grid steps, NaN outside the axis."""
+    positions = np.arange(axis.size, dtype=np.float64)
+    if axis.size > 1 and axis[0] > axis[-1]:
+        axis, positions = axis[::-1], positions[::-1]
+    index = np.interp(values, axis, positions)
+    eps = 1e-9
+    index[(values < axis[0] - eps) | (values > axis[-1] + eps)] = np.nan
+    return index
+
+
+def get_point_sampler(cube: ForecastCube, lon: np.ndarray, lat: np.ndarray, method: str = "bilinear",
+                      cache_folder: str | None = None) -> PointSampler:
+    """Sampler of the points on the cube's grid, cached in memory and optionally on disk."""
+    digest = hashlib.sha1()
+    for array in (cube.latitude, cube.longitude, np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(method.encode())
+    key = digest.hexdigest()
+
+    sampler = _SAMPLERS.get(key)
+    if sampler is not None:
+        return sampler
+
+    with _SAMPLERS_LOCK:
+        sampler = _SAMPLERS.get(key)
+        if sampler is not None:
+            return sampler
+
+        path = os.path.join(cache_folder, f"sampler_{key}.npz") if cache_folder else None
+        if path and os.path.exists(path):
+            try:
+                sampler = PointSampler.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Nie można wczytać wag próbkowania {path}: {e}")
+
+        if sampler is None:
+            sampler = PointSampler.build(cube.latitude, cube.longitude, lon, lat, method)
+            if path:
+                os.makedirs(cache_folder, exist_ok=True)
+                sampler.save(path)
+
+        _SAMPLERS[key] = sampler
+        return sampler
+
+
+def sample_cube(cube: ForecastCube, lon: np.ndarray, lat: np.ndarray, method: str = "bilinear",
+                cache_folder: str | None = None) -> np.ndarray:
+    """Every variable, level and step at the points: (variable, level, step, points) float32."""
+    return get_point_sampler(cube, lon, lat, method, cache_folder).sample(cube.data)
+
+
+def sample_centroids(cube: ForecastCube, centroids, method: str = "bilinear",
+                     cache_folder: str | None = None) -> pd.DataFrame:
+    """Long frame (id, update_on, one column per GRIB parameter) of the cube at `get_centroids` points.
+
+    Like ForecastCube.to_frame, each variable is taken from its first level with data.
+    """
+    lon, lat = centroids.geometry.x.to_numpy(), centroids.geometry.y.to_numpy()
+    sampled = sample_cube(cube, lon, lat, method, cache_folder)
+
+    points, steps = lon.size, len(cube.steps)
+    frame = {
+        "id": np.tile(centroids["id"].to_numpy(), steps),
+        "update_on": np.repeat(np.array([cube.run_on + timedelta(hours=step) for step in cube.steps],
+                                        dtype="datetime64[ns]"), points),
+    }
+    for position, variable in enumerate(cube.variables):
+        values = sampled[position]  # (level, step, points)
+        has_data = ~np.isnan(values).all(axis=(1, 2))
+        level = int(np.argmax(has_data)) if has_data.any() else 0
+        frame[cube.parameter_names.get(variable, variable)] = values[level].reshape(-1)
+    return pd.DataFrame(frame)
@@ -0,0 +1,313 @@
+"""ICON runs as Celery tasks, spread over worker nodes.
+
+One run (factory, date, run hour, config overrides) becomes:
+
+    chord(group(download_file | extract_file per file), plan_steps)
+    plan_steps -> chord(group(transform_step | upload_step per forecast step), postprocess_run | finish_run)
+
+Tasks are routed to three queues whose concurrency is set per worker, e.g.
+
+    celery -A weather.weather_tasks worker -Q network -c 16   # download
+    celery -A weather.weather_tasks worker -Q cpu -c 4        # extract, decode, post-processing
+    celery -A weather.weather_tasks worker -Q db -c 2         # upload, completion of the run
+    celery -A weather.weather_tasks beat                      # runs 00/06/12/18
+
+Tasks hand each other file paths, and every task checks the run manifest first, so all worker nodes must
+see the same files: DOWNLOAD_FOLDER_ICON, TMP_FOLDER, CUBE_FOLDER and the folder of MANIFEST_PATH have to be
+on storage shared by the nodes (NFSv4, CephFS, ... with working file locks for the SQLite manifest), under
+the same paths; relative paths resolve against each worker's working directory. start_run writes a marker
+file of the dispatch to every one of these folders, and the first task of a run on each node checks that it
+sees them all; a node with local folders fails with SharedStorageError instead of missing the files.
+
+Task ids are derived from the run and the file or step, and the manifest check makes a task delivered twice
+or a run started again redo only what is missing. WEATHER_CELERY_EAGER=1 runs everything in-process
+(tests); CELERY_BROKER_URL="memory://" with CELERY_RESULT_BACKEND="cache+memory://" works with an
+in-process worker.
+"""
+import hashlib
+import json
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from celery import Celery, chain, chord, group
+from celery.schedules import crontab
+
+from pass_logging import logger
+from pass_metrics import metrics
+
+QUEUES: dict = {
+    "weather.start_run": "cpu",
+    "weather.download_file": "network",
+    "weather.extract_file": "cpu",
+    "weather.plan_steps": "cpu",
+    "weather.transform_step": "cpu",
+    "weather.upload_step": "db",
+    "weather.postprocess_run": "cpu",
+    "weather.finish_run": "db",  # ładowanie plików pochodnych i agregaty to zapisy do bazy
+}
+RUN_HOURS: tuple = ("00", "06", "12", "18")
+BEAT_FACTORIES: tuple = ("FactoryWeatherICONPolandForecast",)
+PUBLISH_DELAY_HOURS: int = 3  # DWD publikuje ICON-EU ok. 2-3 h po starcie przebiegu
+
+app = Celery("weather")
+app.conf.update(
+    broker_url=os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"),
+    result_backend=os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/1"),  # chord wymaga backendu
+    task_always_eager=os.getenv("WEATHER_CELERY_EAGER", "").lower() in ("1", "true", "yes"),
+    task_eager_propagates=True,
+    task_routes={name: {"queue": queue} for name, queue in QUEUES.items()},
+    task_default_queue="cpu",
+    task_acks_late=True,  # zadanie przerwane razem z workerem wraca do kolejki; zadania są idempotentne
+    task_reject_on_worker_lost=True,
+    worker_prefetch_multiplier=1,  # długie zadania, bez rezerwowania kolejnych
+    task_serializer="json",
+    result_serializer="json",
+    timezone="UTC",
+    beat_schedule={
+        f"{factory}-{run_hour}": {
+            "task": "weather.start_run",
+            "schedule": crontab(hour=int(run_hour) + PUBLISH_DELAY_HOURS, minute=30),
+            "args": (factory,),
+            "kwargs": {"run_hour": run_hour},
+        }
+        for factory in BEAT_FACTORIES for run_hour in RUN_HOURS
+    },
+)
+
+
+def run_key(run: dict) -> str:
+    """Stable name of a run, the prefix of all its task ids."""
+    key = f"{run['factory']}:{run['date']}{run['hour']}"
+    if run.get("overrides"):
+        key += ":" + hashlib.sha1(json.dumps(run["overrides"], sort_keys=True).encode()).hexdigest()[:8]
+    return key
+
+
+def task_id(run: dict, stage: str, name: str) -> str:
+    return f"{run_key(run)}:{stage}:{os.path.basename(name)}"
+
+
+def run_config(run: dict) -> dict:
+    from weather import weather_factories
+
+    factory = getattr(weather_factories, run["factory"])
+    config = {**factory().config, "DATE": run["date"], "FORECAST_HOUR": run["hour"], **run.get("overrides", {})}
+    config["IN_MEMORY_PIPELINE"] = False  # etapy w różnych procesach wymieniają się plikami
+    return config
+
+
+class SharedStorageError(RuntimeError):
+    """This worker does not see the folders of a run as the node that started it (see the module docstring)."""
+
+
+def shared_folders(config: dict) -> list:
+    """Folders every node of a run reads and writes: downloads, steps, cube and manifest."""
+    manifest_path = config.get("MANIFEST_PATH") or os.path.join(config["DOWNLOAD_FOLDER_ICON"], "manifest.sqlite")
+    folders = [config["DOWNLOAD_FOLDER_ICON"], config["TMP_FOLDER"], config.get("CUBE_FOLDER"),
+               os.path.dirname(manifest_path) or "."]
+    return sorted({os.path.abspath(folder) for folder in folders if folder})
+
+
+def _marker(folder: str, token: str) -> str:
+    return os.path.join(folder, f".weather_run_{token}")
+
+
+def mark_shared_storage(config: dict) -> str:
+    """Writes the marker of a new dispatch to the shared folders and returns its token."""
+    token = uuid.uuid4().hex
+    for folder in shared_folders(config):
+        os.makedirs(folder, exist_ok=True)
+        open(_marker(folder, token), "w").close()
+    return token
+
+
+def check_shared_storage(run: dict, config: dict) -> None:
+    """Raises SharedStorageError if a marker of the run's dispatch is missing here (runs without one pass)."""
+    token = run.get("storage")
+    if not token:
+        return
+    missing = [folder for folder in shared_folders(config) if not os.path.exists(_marker(folder, token))]
+    if missing:
+        raise SharedStorageError(
+            f"Węzeł {socket.gethostname()} nie widzi plików przebiegu {run_key(run)} w {', '.join(missing)}: "
+            f"DOWNLOAD_FOLDER_ICON, TMP_FOLDER, CUBE_FOLDER i MANIFEST_PATH muszą leżeć na pamięci wspólnej "
+            f"dla wszystkich węzłów, pod tą samą ścieżką"
+        )
+
+
+def clear_shared_storage(run: dict, config: dict) -> None:
+    if run.get("storage"):
+        for folder in shared_folders(config):
+            if os.path.exists(_marker(folder, run["storage"])):
+                os.remove(_marker(folder, run["storage"]))
+
+
+class RunContext:
+    """Config and stage objects of one run, built lazily once per worker process."""
+
+    def __init__(self, run: dict):
+        from weather import weather_factories
+
+        self.run = run
+        self.config = run_config(run)
+        check_shared_storage(run, self.config)
+        self.handler = getattr(weather_factories, run["factory"]).handler
+        self._components: dict = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str):
+        with self._lock:
+            if name not in self._components:
+                self._components[name] = getattr(self.handler, f"get_{name}")(config=self.config)
+            return self._components[name]
+
+    @property
+    def downloader(self):
+        return self._get("downloader")
+
+    @property
+    def extractor(self):
+        return self._get("extractor")
+
+    @property
+    def transformer(self):
+        return self._get("transformer")
+
+    @property
+    def uploader(self):
+        return self._get("uploader")
+
+    @property
+    def postprocessor(self):
+        return self._get("postprocessor")
+
+
+_CONTEXTS: dict = {}
+_CONTEXTS_LOCK = threading.Lock()
+MAX_CONTEXTS: int = 16
+
+
+def context(run: dict) -> RunContext:
+    key = run_key(run)
+    with _CONTEXTS_LOCK:
+        if key not in _CONTEXTS:
+            if len(_CONTEXTS) >= MAX_CONTEXTS:
+                _CONTEXTS.pop(next(iter(_CONTEXTS)))  # najstarszy przebieg
+            _CONTEXTS[key] = RunContext(run)
+        return _CONTEXTS[key]
+
+
+def make_run(factory: str, run_date: str | None = None, run_hour: str = "00", overrides: dict | None = None) -> dict:
+    """JSON description of one run passed to every task: factory class name, date, run hour, config overrides."""
+    return {
+        "factory": factory,
+        "date": run_date or datetime.now(timezone.utc).strftime("%Y%m%d"),
+        "hour": run_hour,
+        "overrides": overrides or {},
+    }
+
+
+def run_signature(run: dict):
+    """Canvas of one whole run (see the module docstring)."""
+    links = context(run).downloader.get_links()
+    files = group(
+        chain(
+            download_file.si(run, url).set(task_id=task_id(run, "download", url)),
+            extract_file.s(run).set(task_id=task_id(run, "extract", url)),
+        )
+        for url in links
+    )
+    logger.info(f"Przebieg {run_key(run)}: {len(links)} plików")
+    return chord(files, plan_steps.s(run).set(task_id=task_id(run, "plan", "steps")))
+
+
+@app.task(name="weather.start_run")
+def start_run(factory: str, run_date: str | None = None, run_hour: str = "00", overrides: dict | None = None) -> str:
+    """Entry point for beat and the CLI: dispatches the whole run and returns its key."""
+    run = make_run(factory, run_date, run_hour, overrides)
+    run["storage"] = mark_shared_storage(run_config(run))
+    run_signature(run).apply_async()
+    return run_key(run)
+
+
+@app.task(name="weather.download_file", bind=True, max_retries=3, default_retry_delay=600)
+def download_file(self, run: dict, url: str) -> str | None:
+    """Downloads one file; a missing file (run not fully published yet) is retried later, then dropped."""
+    path = context(run).downloader.get_single_file(url)
+    if path is None and self.request.retries < self.max_retries and not self.request.is_eager:
+        raise self.retry()
+    return path
+
+
+@app.task(name="weather.extract_file")
+def extract_file(path: str | None, run: dict) -> str | None:
+    return context(run).extractor.extract_single_file(path) if path else None
+
+
+@app.task(name="weather.plan_steps")
+def plan_steps(extracted: list, run: dict) -> int:
+    """Chord callback of the files: a transform | upload chain per forecast step, then the run's completion."""
+    transformer = context(run).transformer
+    files = [path for path in extracted if path]
+    steps = {
+        hour: [path for path in files if f"_{hour}_" in os.path.basename(path)]
+        for hour in transformer.FORECAST_HOURS
+    }
+    steps = {hour: step_files for hour, step_files in steps.items() if step_files}
+    logger.info(f"Przebieg {run_key(run)}: {len(files)}/{len(extracted)} plików, {len(steps)} kroków")
+
+    chord(
+        group(
+            chain(
+                transform_step.si(run, hour, step_files).set(task_id=task_id(run, "transform", hour)),
+                upload_step.s(run).set(task_id=task_id(run, "upload", hour)),
+            )
+            for hour, step_files in steps.items()
+        ),
+        chain(
+            postprocess_run.s(run).set(task_id=task_id(run, "postprocess", "run")),
+            finish_run.s(run).set(task_id=task_id(run, "finish", "run")),
+        ),
+    ).apply_async()
+    return len(steps)
+
+
+@app.task(name="weather.transform_step")
+def transform_step(run: dict, hour: str, step_files: list) -> str | list | None:
+    return context(run).transformer.transform_step(hour, step_files)
+
+
+@app.task(name="weather.upload_step")
+def upload_step(outputs: str | list | None, run: dict) -> list:
+    """Uploads the step file(s) of one forecast step (one per area with AREAS)."""
+    if outputs is None:
+        return []
+    uploader = context(run).uploader
+    return [uploader.upload_single_file(path) for path in (outputs if isinstance(outputs, list) else [outputs])]
+
+
+@app.task(name="weather.postprocess_run")
+def postprocess_run(uploaded: list, run: dict) -> dict:
+    """Chord callback of the steps: post-processing of the complete run; the upload is left to finish_run."""
+    ctx = context(run)
+    derived = bool(ctx.postprocessor is not None and ctx.postprocessor.postprocess())
+    return {"run": run_key(run), "steps": len(uploaded), "files": sum(len(paths) for paths in uploaded),
+            "derived": derived}
+
+
+@app.task(name="weather.finish_run")
+def finish_run(summary: dict, run: dict) -> dict:
+    """Upload of the derived files, completion of the rollups, and the metrics of this worker."""
+    ctx = context(run)
+    if summary["derived"]:
+        ctx.uploader.upload_data()  # tylko pliki pochodne, kroki są już w manifeście; zamyka też agregaty
+    else:
+        ctx.uploader.complete_rollups()
+    metrics.export(ctx.config, pipeline=run["factory"], run=f"{run['date']}{run['hour']}")
+    clear_shared_storage(run, ctx.config)
+
+    logger.info(f"Przebieg zakończony: {summary}")
+    return summary
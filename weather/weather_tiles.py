@@ -0,0 +1,139 @@
+"""Out-of-core transform of one forecast step in tiles of whole crop rows (TILE_MEMORY_BUDGET_MB).
+
+The cropped fields of a step are spooled as float32 to a scratch file, one field after another. They are read
+back a tile at a time, merged, and written as one record batch of the step file, which the uploader streams
+batch by batch. The peak memory is one full decoded GRIB field plus one tile, whatever the area and the number
+of variables.
+"""
+import os
+import threading
+
+import numpy as np
+
+from pass_logging import logger
+
+# szacunek pamięci jednego punktu kafelka od dekodowania do COPY, z zapasem
+BYTES_PER_VALUE: int = 24  # float32: spool, kolumna po scaleniu, DataFrame, Arrow, tekst COPY
+BYTES_PER_POINT: int = 320  # cell_id, latitude/longitude, update_on, kolejność, punkt shapely, wiersz COPY
+MIN_TILE_POINTS: int = 4_096
+
+
+def tile_points(budget_mb: float, fields: int) -> int:
+    """Points per tile that keep one tile of `fields` variables within the budget through merge and upload."""
+    per_point = fields * BYTES_PER_VALUE + BYTES_PER_POINT
+    return max(MIN_TILE_POINTS, int(budget_mb * 2 ** 20) // per_point)
+
+
+def row_length(latitude: np.ndarray) -> int:
+    """Points in one row of the crop (the leading run of equal latitudes)."""
+    changes = np.flatnonzero(latitude != latitude[0])
+    return int(changes[0]) if changes.size else latitude.size
+
+
+def tile_ranges(size: int, points: int, row_size: int = 1) -> list:
+    """(start, stop) of consecutive tiles of whole rows, each at most `points` long (at least one row)."""
+    step = max(row_size, points // row_size * row_size)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def same_grid(fields: list[dict]) -> bool:
+    first = fields[0]["index"]
+    return all(field["index"] is first or np.array_equal(field["index"], first) for field in fields[1:])
+
+
+def slice_fields(fields: list[dict], start: int, stop: int) -> list[dict]:
+    """Fields of one tile; the fields must share their grid (same_grid)."""
+    return [
+        {**field, "index": field["index"][start:stop], "latitude": field["latitude"][start:stop],
+         "longitude": field["longitude"][start:stop], "values": field["values"][start:stop]}
+        for field in fields
+    ]
+
+
+def field_tiles(fields: list[dict], budget_mb: float):
+    """Yields decoded fields already in memory tile by tile; fields on different grids come as one tile."""
+    if not same_grid(fields):
+        logger.warning(f"Pola kroku ({', '.join(sorted({field['name'] for field in fields}))}) leżą na różnych "
+                       f"siatkach, krok przetwarzany w całości, bez limitu {budget_mb} MB")
+        yield fields
+        return
+    for start, stop in tile_ranges(fields[0]["index"].size, tile_points(budget_mb, len(fields)),
+                                   row_length(fields[0]["latitude"])):
+        yield slice_fields(fields, start, stop)
+
+
+class FieldSpool:
+    """Cropped fields of one step in a scratch file in `folder`, removed on close.
+
+    Only the grid shared by the fields (index, latitude, longitude; cached with the crop index anyway) stays in
+    memory; the values are read back for one tile at a time.
+    """
+
+    ITEM_SIZE: int = np.dtype(np.float32).itemsize
+
+    def __init__(self, folder: str, name: str):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, f".{os.getpid()}.{threading.get_ident()}.{name}.spool")
+        self._file = open(self.path, "w+b")
+        self.fields: list = []  # name, update_on, offset
+        self.index = self.latitude = self.longitude = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.fields)
+
+    @property
+    def size(self) -> int:
+        return 0 if self.index is None else self.index.size
+
+    def add(self, field: dict) -> None:
+        """Appends one decoded field (decode_grib_message) as float32."""
+        if self.index is None:
+            self.index, self.latitude, self.longitude = field["index"], field["latitude"], field["longitude"]
+        elif not (field["index"] is self.index or np.array_equal(field["index"], self.index)):
+            raise ValueError(f"Pole {field['name']} leży na innej siatce niż pozostałe pola kroku")
+
+        self._file.seek(0, os.SEEK_END)
+        self.fields.append({"name": field["name"], "update_on": field["update_on"], "offset": self._file.tell()})
+        np.asarray(field["values"], dtype=np.float32).tofile(self._file)
+
+    def truncate(self, count: int) -> None:
+        """Forgets the fields added after the first `count` (a file that failed half way)."""
+        if count < len(self.fields):
+            self._file.truncate(self.fields[count]["offset"])
+            del self.fields[count:]
+
+    def read(self, start: int, stop: int) -> list[dict]:
+        """Fields of the points start:stop, in the form of decode_grib_message."""
+        self._file.flush()
+        tile = []
+        for field in self.fields:
+            self._file.seek(field["offset"] + start * self.ITEM_SIZE)
+            tile.append({
+                "name": field["name"],
+                "update_on": field["update_on"],
+                "index": self.index[start:stop],
+                "latitude": self.latitude[start:stop],
+                "longitude": self.longitude[start:stop],
+                "values": np.fromfile(self._file, dtype=np.float32, count=stop - start),
+            })
+        return tile
+
+    def tiles(self, budget_mb: float):
+        """Yields the spooled fields tile by tile."""
+        if not self.fields:
+            return
+        for start, stop in tile_ranges(self.size, tile_points(budget_mb, len(self.fields)),
+                                       row_length(self.latitude)):
+            yield self.read(start, stop)
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,14 +1,23 @@
 import bz2
 import os
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import pygrib
 from abc import ABC, abstractmethod
-from shapely.geometry import Point
 from datetime import datetime, timezone, timedelta
+from typing import TYPE_CHECKING
 
 from pass_logging import logger
+from pass_metrics import instrumented, metrics
 from pass_utils import make_parallel
+from weather.weather_areas import area_outputs, decode_bounds
+from weather.weather_cube import ForecastCube
+from weather.weather_grid import bounds_mask, get_crop_index
+from weather.weather_intermediate import StepWriter, step_file_name
+from weather.weather_manifest import RunManifest
+from weather.weather_tiles import FieldSpool, field_tiles, tile_points
+
+if TYPE_CHECKING:
+    import geopandas as gpd
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
@@ -36,72 +45,251 @@ class IconEuTransformer(Transformer):
         self.output_folder = config["DOWNLOAD_FOLDER_ICON"]
         self.temp_folder = config["TMP_FOLDER"]
         self.day = config["DATE"]
+        self.run_hour = config["FORECAST_HOUR"]
         self.FORECAST_HOURS = config["FORECAST_HOURS"]
-        self.area = config["AREA"]
+        self.area = decode_bounds(config)  # przy AREAS: prostokąt obejmujący wszystkie obszary, dekodowany raz
+        self.areas: dict = area_outputs(config)  # nazwa -> granice; każdy obszar we własnym pliku kroku
+        self.decode_mode = config.get("DECODE_MODE", "columnar")  # "columnar" | "records"
+        self.crop_index_folder = config.get(
+            "CROP_INDEX_FOLDER", os.path.join(self.output_folder, "crop_index")
+        )
+        self.storage_mode = config.get("STORAGE_MODE", "points")  # "points" | "cells"
+        self.intermediate_format = config.get("INTERMEDIATE_FORMAT", "arrow")  # "arrow" | "fgb"
+        if self.storage_mode == "cells" and self.decode_mode != "columnar":
+            raise ValueError("STORAGE_MODE='cells' wymaga DECODE_MODE='columnar' (identyfikatory komórek siatki)")
+        self.tile_budget_mb: float | None = config.get("TILE_MEMORY_BUDGET_MB")  # krok w kafelkach wierszy siatki
+        if self.tile_budget_mb and (self.decode_mode != "columnar" or self.intermediate_format != "arrow"):
+            raise ValueError("TILE_MEMORY_BUDGET_MB wymaga DECODE_MODE='columnar' i INTERMEDIATE_FORMAT='arrow'")
+        self.manifest = RunManifest.from_config(config)
+        self.cube_folder: str | None = config.get("CUBE_FOLDER")  # kostka całego przebiegu zamiast dekodowania kroków
+        # filled by IconEuStreamDownloader when the pipeline runs without intermediate files
+        self.decoded_fields = config.setdefault("DECODED_FIELDS", {}) if config.get("IN_MEMORY_PIPELINE") else None
 
     def transform_data(self):
-        downloaded_files: list = [
-            os.path.join(self.output_folder, filename)
-            for filename in os.listdir(self.output_folder)
-            if filename.endswith(".grib2") and self.day in filename
-        ]
-
-        for hour in self.FORECAST_HOURS:
-            all_dataframes = []
-            for file_path in downloaded_files:
-                if hour in file_path:
-
-                    logger.info(f"Przetwarzanie pliku GRIB2: {file_path}")
-                    try:
-                        df = self.transform_single_file(file_path)
-                        all_dataframes.append(df)
-                    except Exception as e:
-                        logger.info(f"Błąd przetwarzania pliku {file_path}: {e}")
-
-            if not all_dataframes:
-                logger.info(f"No valid data to process for hour {hour}")
-                continue
-
-            combined_dataframe = pd.concat(all_dataframes, ignore_index=True)
-            combined_dataframe = combined_dataframe.groupby(['latitude', 'longitude'], as_index=False).first()
-
-            combined_dataframe["geometry"] = combined_dataframe.apply(
-                lambda row: Point(row["longitude"], row["latitude"]), axis=1)
-            gdf = gpd.GeoDataFrame(
-                combined_dataframe,
-                geometry="geometry",
-                crs="EPSG:4326"
-            )
+        if self.decoded_fields is not None:
+            downloaded_files: list = list(self.decoded_fields)
+        else:
+            downloaded_files: list = [
+                row["path"] for row in self.manifest.artifacts("extract", self.day, self.run_hour)
+            ] or [  # pliki sprzed manifestu
+                os.path.join(self.output_folder, filename)
+                for filename in os.listdir(self.output_folder)
+                if filename.endswith(".grib2") and self.day in filename
+            ]
+
+        steps = {
+            hour: [file_path for file_path in downloaded_files if f"_{hour}_" in os.path.basename(file_path)]
+            for hour in self.FORECAST_HOURS
+        }
+
+        cube = None
+        if self.cube_folder and self.decoded_fields is None and not all(
+                self.is_step_done(hour, step_files) for hour, step_files in steps.items()):
+            cube = self.build_cube(downloaded_files)
+
+        for hour, step_files in steps.items():
+            self.transform_step(hour, step_files, cube)
+
+    def step_output(self, hour: str, area: str | None = None) -> str:
+        return os.path.join(self.temp_folder,
+                            step_file_name(self.day, self.run_hour, hour, self.intermediate_format, area))
+
+    def step_outputs(self, hour: str) -> list:
+        """(area, intermediate file) of every output of one step; area is None for a single-area run."""
+        return [(area, self.step_output(hour, area)) for area in self.areas or [None]]
+
+    def step_inputs(self, step_files: list) -> str | None:
+        if self.decoded_fields is not None:
+            return None
+        extracted = [self.manifest.get("extract", file_path) for file_path in step_files]
+        return RunManifest.inputs_key(extracted) if extracted and all(extracted) else None
+
+    def is_step_done(self, hour: str, step_files: list) -> bool:
+        inputs = self.step_inputs(step_files)
+        return bool(inputs) and all(self.manifest.is_done("transform", output_file, inputs=inputs)
+                                    for _, output_file in self.step_outputs(hour))
+
+    @instrumented("transform")
+    def build_cube(self, file_paths: list) -> ForecastCube:
+        """Decodes the whole run once into a memory-mapped ForecastCube in CUBE_FOLDER."""
+        folder = os.path.join(self.cube_folder, f"icon_{self.day}{self.run_hour}")
+        return ForecastCube.from_grib_files(file_paths, self.area, self.crop_index_folder, folder=folder)
+
+    @instrumented("transform")
+    def transform_step(self, hour: str, step_files: list, cube: ForecastCube | None = None) -> str | list | None:
+        """Builds one forecast step from its files, or from the run's cube, and returns the intermediate file
+        (None if nothing decoded); with AREAS, the list of area files cut from the one decoded step."""
+        outputs = self.step_outputs(hour)
+        inputs = self.step_inputs(step_files)
+
+        if self.is_step_done(hour, step_files):
+            logger.info(f"Krok {hour} już przetworzony z tych samych plików, pomijam")
+            metrics.inc("items_skipped_total", stage="transform")
+            return [output_file for _, output_file in outputs] if self.areas else outputs[0][1]
+
+        frames = self.step_tiles(hour, step_files, cube) if self.tile_budget_mb \
+            else self.step_frames(hour, step_files, cube)
+
+        os.makedirs(self.temp_folder, exist_ok=True)
+        writers = [(area, output_file, StepWriter(output_file, self.intermediate_format))
+                   for area, output_file in outputs]  # istniejące pliki zastępowane dopiero przy close()
+        rows = 0
+        try:
+            for frame in frames:
+                if self.storage_mode != "cells" and "cell_id" in frame:
+                    frame = frame.drop(columns="cell_id")
+                rows += len(frame)
+                for area, _, writer in writers:
+                    if area is None:
+                        writer.write(frame)
+                    else:  # wycinek już zdekodowanego kroku, bez ponownego dekodowania
+                        writer.write(frame[bounds_mask(frame["latitude"].to_numpy(), frame["longitude"].to_numpy(),
+                                                       self.areas[area])])
+        except BaseException:
+            for _, _, writer in writers:
+                writer.abort()
+            raise
 
-            logger.info(gdf.head())
+        if not rows:
+            for _, _, writer in writers:
+                writer.abort()
+            logger.info(f"No valid data to process for hour {hour}")
+            return None
 
-            if not os.path.exists(self.temp_folder):
-                os.makedirs(self.temp_folder)
-            output_file = os.path.join(self.temp_folder, f"combined_grib_data_{self.day}_{hour}.fgb")
-            if os.path.exists(output_file):
-                os.remove(output_file)  # rm if exist
-            gdf.to_file(output_file, driver="flatgeobuf")
+        logger.info(f"Krok {hour}: {rows} wierszy, {len(step_files)} plików")
+        metrics.inc("files_total", len(step_files), stage="transform")
 
+        written = []
+        for area, output_file, writer in writers:
+            area_rows = writer.close()
+            if area is not None:
+                logger.info(f"Krok {hour}, obszar {area}: {area_rows} wierszy")
+            metrics.inc("rows_total", area_rows, stage="transform")
+
+            self.manifest.record("transform", output_file, run_date=self.day, run_hour=self.run_hour, step=hour,
+                                 inputs=inputs)
             logger.info(f"Combined data saved to file: {output_file}")
+            written.append(output_file)
+
+        return written if self.areas else written[0]
+
+    def step_frames(self, hour: str, step_files: list, cube: ForecastCube | None = None):
+        """Yields the whole step as one frame (nothing if no field was decoded)."""
+        if cube is not None:
+            gdf = cube.to_frame(int(hour)) if int(hour) in cube.steps else None
+        elif self.decoded_fields is not None:
+            fields = [field for filename in step_files for field in self.decoded_fields.pop(filename, [])]
+            gdf = fields_to_frame(fields) if fields else None
+        elif self.decode_mode == "columnar":
+            gdf = self.transform_step_columnar(step_files)
+        else:
+            gdf = self.transform_step_records(step_files)
+
+        if gdf is not None:
+            yield gdf
+
+    def step_tiles(self, hour: str, step_files: list, cube: ForecastCube | None = None):
+        """Yields the step in tiles of whole grid rows sized to TILE_MEMORY_BUDGET_MB.
+
+        Decoded fields go to a float32 spool file next to the step files first, so only one full GRIB field
+        and one tile are in memory at a time.
+        """
+        if cube is not None:
+            if int(hour) in cube.steps:
+                yield from self.count_tiles(cube.to_frames(int(hour), tile_points(self.tile_budget_mb,
+                                                                                   len(cube.variables))))
+            return
+
+        if self.decoded_fields is not None:
+            fields = [field for filename in step_files for field in self.decoded_fields.pop(filename, [])]
+            if fields:
+                yield from self.count_tiles(fields_to_frame(tile) for tile in field_tiles(fields,
+                                                                                         self.tile_budget_mb))
+            return
+
+        with FieldSpool(self.temp_folder, f"{self.day}{self.run_hour}_{hour}") as spool:
+            for file_path in step_files:
+                logger.info(f"Przetwarzanie pliku GRIB2: {file_path}")
+                spooled = len(spool)
+                try:
+                    self.spool_single_file(file_path, spool)
+                except Exception as e:
+                    spool.truncate(spooled)
+                    logger.info(f"Błąd przetwarzania pliku {file_path}: {e}")
+
+            yield from self.count_tiles(fields_to_frame(tile) for tile in spool.tiles(self.tile_budget_mb))
+
+    @staticmethod
+    def count_tiles(frames):
+        for frame in frames:
+            metrics.inc("tiles_total", stage="transform")
+            yield frame
+
+    def spool_single_file(self, file_path: str, spool: FieldSpool) -> None:
+        import pygrib
+
+        with pygrib.open(file_path) as grbs:
+            for grb in grbs:
+                spool.add(decode_grib_message(grb, self.area, self.crop_index_folder, dtype=np.float32))
+
+    def transform_step_records(self, step_files: list) -> "gpd.GeoDataFrame | None":
+        """Legacy path: one dict per grid point, merged with groupby."""
+        import geopandas as gpd
+        from shapely.geometry import Point
+
+        all_dataframes = []
+        for file_path in step_files:
+            logger.info(f"Przetwarzanie pliku GRIB2: {file_path}")
+            try:
+                df = self.transform_single_file(file_path)
+                all_dataframes.append(df)
+            except Exception as e:
+                logger.info(f"Błąd przetwarzania pliku {file_path}: {e}")
+
+        if not all_dataframes:
+            return None
+
+        combined_dataframe = pd.concat(all_dataframes, ignore_index=True)
+        combined_dataframe = combined_dataframe.groupby(['latitude', 'longitude'], as_index=False).first()
+
+        combined_dataframe["geometry"] = combined_dataframe.apply(
+            lambda row: Point(row["longitude"], row["latitude"]), axis=1)
+        return gpd.GeoDataFrame(combined_dataframe, geometry="geometry", crs="EPSG:4326")
+
+    def transform_step_columnar(self, step_files: list) -> pd.DataFrame | None:
+        """Decodes every file of one step to NumPy columns and merges them by grid index."""
+        fields = []
+        for file_path in step_files:
+            logger.info(f"Przetwarzanie pliku GRIB2: {file_path}")
+            try:
+                fields.extend(self.decode_single_file(file_path))
+            except Exception as e:
+                logger.info(f"Błąd przetwarzania pliku {file_path}: {e}")
+
+        if not fields:
+            return None
+
+        return fields_to_frame(fields)
+
+    def decode_single_file(self, file_path: str) -> list[dict]:
+        import pygrib
+
+        with pygrib.open(file_path) as grbs:
+            return [decode_grib_message(grb, self.area, self.crop_index_folder) for grb in grbs]
 
     def transform_single_file(self, file_path):
+        import pygrib
 
         def process_grib_message(grb):
-            lats, lons = grb.latlons()
-            values = grb.values
+            crop = get_crop_index(grb, self.area, self.crop_index_folder)
             parameter_name = grb.parameterName
             validity_datetime = datetime.strptime(
                 f"{grb.validityDate:08d}{grb.validityTime:04d}", "%Y%m%d%H%M"
             )
-            bounds = self.area  # This is set to `AREA_BOUNDS` from the config
-            lat_min, lat_max = bounds["lat_min"], bounds["lat_max"]
-            lon_min, lon_max = bounds["lon_min"], bounds["lon_max"]
-
-            mask = (lats >= lat_min) & (lats <= lat_max) & (lons >= lon_min) & (lons <= lon_max)
 
-            filtered_lats = lats[mask]
-            filtered_lons = lons[mask]
-            filtered_values = values[mask]
+            filtered_lats = crop.latitude
+            filtered_lons = crop.longitude
+            filtered_values = crop.apply(np.ma.filled(np.ma.asarray(grb.values, dtype=np.float64), np.nan))
 
             return [
                 {
@@ -115,12 +303,94 @@ class IconEuTransformer(Transformer):
 
         with pygrib.open(file_path) as grbs:
             grib_messages = list(grbs)
-            results = make_parallel(process_grib_message, grib_messages)
+            results = make_parallel(process_grib_message, grib_messages, backend="inline")  # bez zagnieżdżonej puli
 
         data_records = [record for result in results for record in result]  # splaszczania do df
 
         return pd.DataFrame(data_records)
 
 
+def decode_grib_message(grb, bounds: dict, cache_folder: str | None = None, dtype=np.float64) -> dict:
+    """Crops one GRIB message to `bounds`; `index` is the flat position of each kept point in the full field.
+
+    `dtype` applies to the cropped values only, the full field is decoded as float64 by pygrib anyway.
+    """
+    crop = get_crop_index(grb, bounds, cache_folder)
+    values = np.ma.filled(np.ma.asarray(grb.values, dtype=np.float64), np.nan)
+
+    return {
+        "name": grb.parameterName,
+        "update_on": datetime.strptime(f"{grb.validityDate:08d}{grb.validityTime:04d}", "%Y%m%d%H%M"),
+        "index": crop.index,
+        "latitude": crop.latitude,
+        "longitude": crop.longitude,
+        "values": crop.apply(values).astype(dtype, copy=False),
+    }
+
+
+def merge_fields(fields: list[dict]) -> dict:
+    """Merges decoded fields by grid index into wide columns (same result as groupby(...).first()).
+
+    `cell_id` is the flat index in the full grid, a stable id of the grid cell.
+    """
+    first = fields[0]
+    if all(field["index"] is first["index"] or np.array_equal(field["index"], first["index"])
+           for field in fields[1:]):
+        index, latitude, longitude = first["index"], first["latitude"], first["longitude"]
+        positions = [None] * len(fields)
+    else:
+        index, first_seen = np.unique(np.concatenate([field["index"] for field in fields]), return_index=True)
+        latitude = np.concatenate([field["latitude"] for field in fields])[first_seen]
+        longitude = np.concatenate([field["longitude"] for field in fields])[first_seen]
+        positions = [np.searchsorted(index, field["index"]) for field in fields]
+
+    columns = {"cell_id": index.astype(np.int32), "latitude": latitude, "longitude": longitude}
+    for field, position in zip(fields, positions):
+        values = field["values"]
+        if position is not None:
+            values = np.full(index.size, np.nan)
+            values[position] = field["values"]
+
+        if field["name"] in columns:
+            current = columns[field["name"]]
+            columns[field["name"]] = np.where(np.isnan(current), values, current)
+        else:
+            columns[field["name"]] = values
+
+    columns["update_on"] = np.full(index.size, np.datetime64(first["update_on"], "ns"))
+
+    order = np.lexsort((columns["longitude"], columns["latitude"]))
+    return {name: column[order] for name, column in columns.items()}
+
+
+def fields_to_frame(fields: list[dict]) -> pd.DataFrame:
+    """Wide frame of one step; the geometry is added only by formats that store it."""
+    return pd.DataFrame(merge_fields(fields))
+
+
+def iter_grib_messages(chunks):
+    """Splits a stream of GRIB bytes into whole messages, buffering at most one message at a time."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer.extend(chunk)
+        while True:
+            start = buffer.find(b"GRIB")
+            if start < 0:
+                del buffer[:-3]  # a header may be split across chunks
+                break
+            if start:
+                del buffer[:start]
+            if len(buffer) < 16:
+                break
+
+            edition = buffer[7]
+            length = int.from_bytes(buffer[8:16], "big") if edition == 2 else int.from_bytes(buffer[4:7], "big")
+            if len(buffer) < length:
+                break
+
+            yield bytes(buffer[:length])
+            del buffer[:length]
+
+
 if __name__ == "__main__":
     pass
@@ -1,24 +1,32 @@
 import os
+import re
+import threading
+import time
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import sqlalchemy
-from sqlalchemy import create_engine
+from sqlalchemy import text
 from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import TYPE_CHECKING
 
+from pass_config import db_engine
 from pass_logging import logger
+from pass_metrics import instrumented, metrics
+from pass_utils import make_parallel
+from weather.weather_intermediate import (is_derived_file, iter_step_batches, list_step_files, step_area,
+                                          step_file_name, with_geometry)
+from weather.weather_manifest import RunManifest
 
-from dotenv import load_dotenv
-import os
-
-from pass_utils import connect_to_db
+if TYPE_CHECKING:
+    from weather.weather_rollups import Rollups
 
-load_dotenv('../.env')
+ICON_TABLE_KEY: list = ["latitude", "longitude", "update_on"]
+OW_TABLE_KEY: list = ["id_geom", "update_time"]
+CELL_TABLE_KEY: list = ["cell_id"]
+VALUES_TABLE_KEY: list = ["cell_id", "update_on"]
 
-db_name: str = os.getenv('DB_NAME')
-db_user: str = os.getenv('DB_USER')
-db_password: str = os.getenv('DB_PASSWORD')
-db_port: str = os.getenv('DB_PORT')
-db_host: str = os.getenv('DB_HOST')
+_KNOWN_CELLS: dict = {}  # (schema, table) -> posortowane cell_id już zapisane w bazie
+_KNOWN_CELLS_LOCK = threading.Lock()
 
 
 class Uploader(ABC):
@@ -31,9 +39,18 @@ class Uploader(ABC):
 class OpenWeatherApiUploader(Uploader):
     def __init__(self, config):
         self.config = config
-        self.db_connection = connect_to_db(db_name, db_user, db_password, db_port, db_host)
+        self.backend: str = config.get("UPLOAD_BACKEND", "to_sql")  # "to_sql" | "copy"
+        self.db_connection = db_engine()
 
     def upload_data(self) -> None:
+        if self.backend == "copy":
+            started = time.perf_counter()
+            with self.db_connection.begin() as connection:
+                rows = copy_upsert(connection, self.config['TMP_DF'], 'weather_ow', 'weather_OW', OW_TABLE_KEY)
+            metrics.inc("rows_total", rows, stage="upload")
+            log_rate("weather_ow.weather_OW", rows, time.perf_counter() - started)
+            return
+
         self.config['TMP_DF'].to_sql(
             name='weather_OW',
             schema='weather_ow',
@@ -47,25 +64,452 @@ class IconEUDBUploader(Uploader):
     def __init__(self, config):
         self.output_folder = config["DOWNLOAD_FOLDER_ICON"]
         self.temp_folder = config["TMP_FOLDER"]
+        self.backend: str = config.get("UPLOAD_BACKEND", "to_postgis")  # "to_postgis" | "copy"
+        self.workers: int = config.get("UPLOAD_WORKERS", 1)
+        self.partition_by_day: bool = config.get("PARTITION_BY_DAY", False)
+        self.storage_mode: str = config.get("STORAGE_MODE", "points")  # "points" | "cells"
+        self.cells_table: str = config.get("CELLS_TABLE", "grid_cells")
+        self.values_table: str = config.get("VALUES_TABLE", "weather_values")
+        self.derived_table: str = config.get("DERIVED_TABLE", "weather_data_derived")  # serie z postprocessingu
+        self.area_tables: dict = config.get("AREAS") or {}  # obszar -> tabela (weather_data_v2 lub tabela wartości)
+        self.day: str = config["DATE"]
+        self.run_hour: str = config["FORECAST_HOUR"]
+        self.run_on = datetime.strptime(f"{self.day}{self.run_hour}", "%Y%m%d%H")
+        self.manifest = RunManifest.from_config(config)
+        self.intermediate_format: str = config.get("INTERMEDIATE_FORMAT", "arrow")  # "arrow" | "fgb"
+        self.engine = db_engine()
+        self.rollup_settings: dict | None = {  # dzienne agregaty aktualizowane przy ładowaniu kroków
+            "temperature": config.get("ROLLUP_TEMPERATURE", "Temperature"),
+            "precipitation": config.get("ROLLUP_PRECIPITATION", "Total precipitation"),
+            "regions": config.get("ROLLUP_REGIONS"),
+        } if config.get("ROLLUPS") else None
+        self.rollup_keep_runs: int = config.get("ROLLUP_KEEP_RUNS", 8)
+        self._rollups: dict = {}
+        self._rollups_lock = threading.Lock()
+        # budżet TILE_MEMORY_BUDGET_MB dzielony między równolegle ładowane kroki
+        self.batch_budget_mb: float | None = config["TILE_MEMORY_BUDGET_MB"] / max(self.workers, 1) \
+            if config.get("TILE_MEMORY_BUDGET_MB") else None
 
     """Uploader for database."""
 
     def upload_data(self) -> None:
-        """Uploads data to database."""
+        """Uploads data to database, each file (forecast step) in its own transaction."""
+
+        transformed = self.manifest.artifacts("transform", self.day, self.run_hour)
+        if transformed:
+            files = [
+                row["path"] for row in transformed + self.manifest.artifacts("postprocess", self.day, self.run_hour)
+                if not self.manifest.is_done("upload", row["path"], inputs=row["checksum"], check_file=False)
+            ]
+        else:  # kroki zapisane bez manifestu
+            prefix = step_file_name(self.day, self.run_hour, "", self.intermediate_format).rsplit(".", 1)[0]
+            files = [file for file in list_step_files(self.temp_folder, self.intermediate_format)
+                     if os.path.basename(file).startswith(prefix)]
+        logger.info(f"Kroki do załadowania: {len(files)}")
+        make_parallel(self.upload_single_file, items=files, workers=self.workers)
+
+        self.complete_rollups()
+
+        tables = [self.cells_table] if self.storage_mode == "cells" else []
+        for area in self.area_tables or [None]:
+            tables += [self.target_table(area=area), self.target_table(derived=True, area=area)]
+            rollups = self.rollups(area)
+            tables += rollups.tables if rollups is not None else []
+        log_table_sizes(self.engine, "weather_icon", tables)
+
+    @instrumented("upload")
+    def upload_single_file(self, file: str) -> str:
+        """Streams the step batch by batch inside one transaction."""
+        derived = is_derived_file(file)
+        transformed = self.manifest.get("postprocess" if derived else "transform", file)
+        if transformed and self.manifest.is_done("upload", file, inputs=transformed["checksum"], check_file=False):
+            logger.info(f"Krok już załadowany, pomijam: {file}")
+            metrics.inc("items_skipped_total", stage="upload")
+            return file
+
+        started = time.perf_counter()
+        rows = 0
+        new_cells = []
+        area = step_area(file)
+        table = self.target_table(derived, area)
+        rollups = self.rollups(area)
+
+        with self.engine.begin() as connection:  # błąd w jednym kroku wycofuje tylko ten krok
+            for batch in iter_step_batches(file, self.batch_budget_mb):
+                rows += len(batch)
+
+                if self.storage_mode == "cells":
+                    frame, key = values_frame(batch, self.run_on), VALUES_TABLE_KEY
+                else:
+                    frame, key = batch, ICON_TABLE_KEY
+
+                if self.partition_by_day:
+                    self.ensure_partitions(frame, table, key)
+
+                if self.storage_mode == "cells":
+                    new_cells.append(register_cells(connection, batch, "weather_icon", self.cells_table))
+                    copy_upsert(connection, frame, "weather_icon", table, key)
+                elif self.backend == "copy":
+                    gdf = with_geometry(frame)
+                    copy_upsert(connection, gdf, "weather_icon", table, key, geometry_column=gdf.geometry.name)
+                else:
+                    with_geometry(frame).to_postgis(table, schema="weather_icon", con=connection,
+                                                    if_exists="append", index=False)
+
+                if rollups is not None:
+                    rollups.stage(connection, batch, derived)
+
+            if rollups is not None:  # wiersze agregatów zablokowane tylko na koniec transakcji kroku
+                rollups.merge(connection, self.run_on, derived)
+
+        for cell_ids in new_cells:
+            remember_cells("weather_icon", self.cells_table, cell_ids)
+
+        self.manifest.record("upload", file, run_date=self.day, run_hour=self.run_hour,
+                             step=transformed and transformed["step"],
+                             checksum=transformed and transformed["checksum"],
+                             inputs=transformed and transformed["checksum"])
+
+        metrics.inc("rows_total", rows, stage="upload")
+        log_rate(file, rows, time.perf_counter() - started)
+        logger.info(f"Data successfully saved to database: {file}")
+        return file
+
+    def target_table(self, derived: bool = False, area: str | None = None) -> str:
+        if area is not None:  # AREAS: każdy obszar we własnej tabeli, cell_id i grid_cells wspólne
+            return f"{self.area_tables[area]}_derived" if derived else self.area_tables[area]
+        if self.storage_mode == "cells":
+            return f"{self.values_table}_derived" if derived else self.values_table
+        return self.derived_table if derived else "weather_data_v2"
+
+    def rollups(self, area: str | None = None) -> "Rollups | None":
+        """Rollups of the area's values table (None without ROLLUPS); the tables are created on first use."""
+        if self.rollup_settings is None:
+            return None
+        with self._rollups_lock:
+            if area not in self._rollups:
+                from weather.weather_rollups import Rollups
+
+                rollups = Rollups("weather_icon", self.target_table(area=area), self.target_table(True, area),
+                                  CELL_TABLE_KEY if self.storage_mode == "cells" else ICON_TABLE_KEY[:2],
+                                  cells_storage=self.storage_mode == "cells", **self.rollup_settings)
+                with self.engine.begin() as connection:
+                    rollups.ensure(connection)
+                self._rollups[area] = rollups
+            return self._rollups[area]
+
+    def complete_rollups(self) -> None:
+        """Marks this run as completely loaded (the _latest views switch to it) and keeps the rollups of the
+        newest ROLLUP_KEEP_RUNS runs; call it only once every step of the run is uploaded."""
+        for area in self.area_tables or [None]:
+            rollups = self.rollups(area)
+            if rollups is not None:
+                with self.engine.begin() as connection:
+                    rollups.complete(connection, self.run_on)
+                    rollups.prune(connection, self.rollup_keep_runs)
+
+    def verify_rollups(self) -> dict:
+        """{area: verify_rollups result} for this run."""
+        from weather.weather_rollups import verify_rollups
+
+        return {area or "": verify_rollups(self.engine, self.rollups(area), self.run_on)
+                for area in self.area_tables or [None]}
+
+    def ensure_partitions(self, frame: pd.DataFrame, table: str, key: list) -> None:
+        """Creates the table and day partitions in a short transaction of their own."""
+        with self.engine.begin() as connection:
+            ensure_table(connection, frame, "weather_icon", table, key, partition_column="update_on")
+            ensure_daily_partitions(connection, "weather_icon", table, frame["update_on"])
+
+
+def value_column_name(name: str) -> str:
+    """'Total precipitation rate' -> 'total_precipitation_rate'"""
+    return re.sub(r"\W+", "_", name).strip("_").lower()
+
+
+def values_frame(batch: pd.DataFrame, run_on: datetime) -> pd.DataFrame:
+    """Value rows of the cell storage: (cell_id, update_on, run_on, variables as float32), no geometry."""
+    frame = pd.DataFrame(batch).drop(columns=["latitude", "longitude", "geometry"], errors="ignore")
+    frame = frame.rename(columns={
+        name: value_column_name(name) for name in frame.columns if name not in ("cell_id", "update_on")
+    })
+    frame["cell_id"] = frame["cell_id"].astype(np.int32)
+    frame["run_on"] = run_on
+    floats = frame.select_dtypes("floating").columns
+    frame[floats] = frame[floats].astype(np.float32)
+    return frame
+
+
+def register_cells(connection, batch: pd.DataFrame, schema: str, table: str) -> np.ndarray:
+    """Inserts the cells not yet stored in schema.table and returns their ids (once per cell id).
+
+    The points are built only for the new cells; in a run over known cells no geometry is built at all.
+    """
+    cell_ids = batch["cell_id"].to_numpy(dtype=np.int64)
+
+    with _KNOWN_CELLS_LOCK:
+        known = _KNOWN_CELLS.get((schema, table))
+    if known is None:
+        known = np.empty(0, dtype=np.int64)
+        if relation_exists(connection, f"{quote(schema)}.{quote(table)}"):
+            known = np.sort(np.fromiter(
+                connection.execute(text(f"SELECT cell_id FROM {quote(schema)}.{quote(table)}")).scalars(),
+                dtype=np.int64,
+            ))
+        remember_cells(schema, table, known)
+
+    new = ~np.isin(cell_ids, known)
+    if not new.any():
+        return np.empty(0, dtype=np.int64)
+
+    cells = with_geometry(pd.DataFrame(batch.loc[new, ["cell_id", "latitude", "longitude"]])).rename_geometry("geom")
+    cells = cells.astype({"cell_id": np.int32, "latitude": np.float32, "longitude": np.float32})
+    copy_upsert(connection, cells, schema, table, CELL_TABLE_KEY, geometry_column="geom", on_conflict="nothing")
+    logger.info(f"Zarejestrowano {new.sum()} nowych komórek siatki w {schema}.{table}")
+    return cell_ids[new]
+
+
+def remember_cells(schema: str, table: str, cell_ids: np.ndarray) -> None:
+    with _KNOWN_CELLS_LOCK:
+        known = _KNOWN_CELLS.get((schema, table), np.empty(0, dtype=np.int64))
+        _KNOWN_CELLS[(schema, table)] = np.union1d(known, cell_ids)
+
+
+def log_table_sizes(engine, schema: str, tables: list) -> None:
+    with engine.connect() as connection:
+        for table in tables:
+            name = f"{quote(schema)}.{quote(table)}"
+            if not relation_exists(connection, name):
+                continue
+            table_size, index_size = connection.execute(
+                text("SELECT pg_table_size(to_regclass(:name)), pg_indexes_size(to_regclass(:name))"),
+                {"name": name},
+            ).one()
+            logger.info(f"{schema}.{table}: tabela {table_size / 1e6:.1f} MB, indeksy {index_size / 1e6:.1f} MB")
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_type(column: pd.Series) -> str:
+    if column.dtype.name == "geometry":  # GeometryDtype, bez importu geopandas
+        return "geometry(Point, 4326)"
+    kind = column.dtype.kind
+    if kind == "f":
+        return "real" if column.dtype.itemsize == 4 else "double precision"
+    if kind in "iu":
+        return "integer" if column.dtype.itemsize <= 4 else "bigint"
+    if kind == "b":
+        return "boolean"
+    if kind == "M":
+        return "timestamp"
+    return "text"
+
 
-        for file in [
-            os.path.join(self.temp_folder, filename)
-            for filename in os.listdir(self.temp_folder)
-            if filename.endswith(".fgb")
-        ]:
-            gdf = gpd.read_file(file)
-            engine = connect_to_db(db_name, db_user, db_password, db_port, db_host)
-            logger.info(gdf.head())
-            gdf.to_postgis(f"weather_data_v2", schema="weather_icon", con=engine, if_exists="append",
-                           index=False)
+def relation_exists(connection, name: str) -> bool:
+    return connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
 
-            logger.info(f"Data successfully saved to database: {file}")
+
+def lock_name(connection, name: str) -> None:
+    """Serialises DDL on `name` between concurrent uploads until the transaction ends."""
+    connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+
+
+class DuplicateKeysError(Exception):
+    """An existing table has rows sharing the upsert key, so its unique index cannot be built.
+
+    Tables filled by the old append-only uploads (to_postgis/to_sql) keep the duplicates of re-runs; they are
+    removed once with deduplicate_table (python -m weather.weather_uploader deduplicate ...).
+    """
+
+    def __init__(self, target: str, key_columns: list, duplicates: int):
+        self.target = target
+        self.key_columns = key_columns
+        self.duplicates = duplicates
+        schema, table = (name.strip('"') for name in target.split(".", 1))
+        super().__init__(
+            f"{target}: {duplicates} kluczy ({', '.join(key_columns)}) występuje wielokrotnie, nie można założyć "
+            f"indeksu unikalnego dla UPLOAD_BACKEND='copy'. Usuń duplikaty raz: python -m weather.weather_uploader "
+            f"deduplicate {schema} {table} --key {','.join(key_columns)}"
+        )
+
+
+def ensure_table(connection, frame: pd.DataFrame, schema: str, table: str, key_columns: list,
+                 partition_column: str | None = None) -> None:
+    """Creates the target table from the frame's dtypes if missing, plus the unique key the upsert needs.
+
+    Only missing objects are created, so loads into an existing table take no DDL locks.
+    """
+    target = f"{quote(schema)}.{quote(table)}"
+    index = f"{quote(schema)}.{quote(table + '_upsert_key')}"
+    if relation_exists(connection, target) and relation_exists(connection, index):
+        return
+
+    lock_name(connection, target)
+    columns = ", ".join(f"{quote(name)} {sql_type(frame[name])}" for name in frame.columns)
+    partitioning = f" PARTITION BY RANGE ({quote(partition_column)})" if partition_column else ""
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {target} ({columns}){partitioning}"))
+    ensure_upsert_key(connection, schema, table, key_columns)
+
+
+def ensure_upsert_key(connection, schema: str, table: str, key_columns: list) -> None:
+    """Builds the unique index of the upsert key; raises DuplicateKeysError if the rows already break it."""
+    if relation_exists(connection, f"{quote(schema)}.{quote(table + '_upsert_key')}"):
+        return
+    target = f"{quote(schema)}.{quote(table)}"
+    duplicates = count_duplicate_keys(connection, target, key_columns)
+    if duplicates:
+        raise DuplicateKeysError(target, key_columns, duplicates)
+    connection.execute(text(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {quote(table + '_upsert_key')} "
+        f"ON {target} ({', '.join(quote(name) for name in key_columns)})"
+    ))
+
+
+def count_duplicate_keys(connection, target: str, key_columns: list) -> int:
+    """Number of keys stored more than once; rows with a NULL key part do not conflict, as in the index."""
+    keys = ", ".join(quote(name) for name in key_columns)
+    not_null = " AND ".join(f"{quote(name)} IS NOT NULL" for name in key_columns)
+    return connection.execute(text(
+        f"SELECT count(*) FROM (SELECT 1 FROM {target} WHERE {not_null} GROUP BY {keys} HAVING count(*) > 1) d"
+    )).scalar()
+
+
+def deduplicate_table(connection, schema: str, table: str, key_columns: list) -> int:
+    """One-off migration of a table filled by appends: keeps the last stored row of every key (the newest
+    load) and deletes the others; returns the number of deleted rows. The upsert key is built afterwards
+    (ensure_upsert_key, or the next copy upload)."""
+    target = f"{quote(schema)}.{quote(table)}"
+    keys = ", ".join(quote(name) for name in key_columns)
+    not_null = " AND ".join(f"{quote(name)} IS NOT NULL" for name in key_columns)
+
+    lock_name(connection, target)
+    deleted = connection.execute(text(
+        f"DELETE FROM {target} WHERE (tableoid, ctid) IN ("
+        f"SELECT tableoid, ctid FROM (SELECT tableoid, ctid, row_number() OVER "
+        f"(PARTITION BY {keys} ORDER BY ctid DESC) AS position FROM {target} WHERE {not_null}) d "
+        f"WHERE position > 1)"  # ctid: kolejność dopisywania w tabeli zasilanej tylko przez append
+    )).rowcount
+    logger.info(f"Usunięto {deleted} zduplikowanych wierszy z {target} (klucz {keys})")
+    return deleted
+
+
+def ensure_daily_partitions(connection, schema: str, table: str, timestamps: pd.Series) -> None:
+    """Creates the missing one-day range partitions of a table partitioned by `update_on`."""
+    target = f"{quote(schema)}.{quote(table)}"
+    is_partitioned = connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name))"),
+        {"name": target},
+    ).scalar()
+    if not is_partitioned:
+        logger.warning(f"Tabela {target} nie jest partycjonowana, pomijam tworzenie partycji")
+        return
+
+    for day in pd.to_datetime(timestamps).dt.normalize().unique():
+        partition = f"{quote(schema)}.{quote(f'{table}_p{day:%Y%m%d}')}"
+        if relation_exists(connection, partition):
+            continue
+        lock_name(connection, partition)
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {target} "
+            f"FOR VALUES FROM ('{day:%Y-%m-%d}') TO ('{day + pd.Timedelta(days=1):%Y-%m-%d}')"
+        ))
+
+
+class CsvStream:
+    """Read-only file object that renders a frame to CSV `chunk_rows` rows at a time, for COPY FROM STDIN."""
+
+    def __init__(self, frame: pd.DataFrame, chunk_rows: int = 50_000):
+        self._chunks = (
+            frame.iloc[start:start + chunk_rows].to_csv(index=False, header=False)
+            for start in range(0, len(frame), chunk_rows)
+        )
+        self._buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    readline = read
+
+
+def copy_rows(connection, frame: pd.DataFrame, table: str) -> None:
+    """COPY of the frame's columns into `table` (a quoted name), rendered to CSV in chunks."""
+    columns = ", ".join(quote(name) for name in frame.columns)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", CsvStream(frame))
+    cursor.close()
+
+
+def copy_upsert(connection, frame: pd.DataFrame, schema: str, table: str, key_columns: list,
+                geometry_column: str | None = None, on_conflict: str = "update") -> int:
+    """Loads a frame with COPY into a staging table and merges it into schema.table on `key_columns`.
+
+    Geometries are sent as hex EWKB. The staging table is a temporary table (never WAL-logged),
+    private to the connection and dropped on commit, so concurrent uploads do not collide.
+    """
+    if frame.empty:
+        return 0
+
+    frame = pd.DataFrame(frame)
+    ensure_table(connection, frame, schema, table, key_columns)
+    if geometry_column:
+        import shapely
+
+        frame[geometry_column] = shapely.to_wkb(
+            shapely.set_srid(frame[geometry_column].to_numpy(), 4326), hex=True, include_srid=True
+        )
+
+    target = f"{quote(schema)}.{quote(table)}"
+    staging = quote(f"staging_{table}")
+    columns = ", ".join(quote(name) for name in frame.columns)
+    keys = ", ".join(quote(name) for name in key_columns)
+    updates = ", ".join(
+        f"{quote(name)} = EXCLUDED.{quote(name)}" for name in frame.columns if name not in key_columns
+    )
+
+    connection.execute(text(
+        f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP"
+    ))
+    connection.execute(text(f"TRUNCATE {staging}"))  # kolejna partia tego samego kroku w tej transakcji
+    copy_rows(connection, frame, staging)
+
+    connection.execute(text(
+        f"INSERT INTO {target} ({columns}) "
+        f"SELECT DISTINCT ON ({keys}) {columns} FROM {staging} "
+        f"ON CONFLICT ({keys}) DO " + (f"UPDATE SET {updates}" if updates and on_conflict == "update" else "NOTHING")
+    ))
+    return len(frame)
+
+
+def log_rate(name: str, rows: int, seconds: float) -> None:
+    logger.info(f"Załadowano {rows} wierszy z {name} w {seconds:.2f} s ({rows / seconds if seconds else 0:.0f} wierszy/s)")
 
 
 if __name__ == "__main__":
-    pass
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintenance of the upload tables.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    deduplicate = commands.add_parser("deduplicate", help="usuwa duplikaty klucza i zakłada indeks unikalny")
+    deduplicate.add_argument("schema")
+    deduplicate.add_argument("table")
+    deduplicate.add_argument("--key", default=",".join(ICON_TABLE_KEY), help="kolumny klucza po przecinku")
+    args = parser.parse_args()
+
+    engine = db_engine()
+    with engine.begin() as connection:
+        deduplicate_table(connection, args.schema, args.table, args.key.split(","))
+    with engine.begin() as connection:
+        lock_name(connection, f"{quote(args.schema)}.{quote(args.table)}")
+        ensure_upsert_key(connection, args.schema, args.table, args.key.split(","))